@@ -3,8 +3,9 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap as lsc
 from pathlib import Path
 import pandas as pd
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
-from numpy.random import uniform
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              PolarizedDetector)
 from math import floor
 
 # This script simulates the use of polarized photobleaching light to
@@ -61,18 +62,6 @@ def make_animation_frame(my_fluorophores, output_name, output_dir, frame_number,
     plt.savefig(output_path, bbox_inches='tight', dpi=300)
     plt.close(fig)
 
-def get_xy_emission_counts(population, initial_state, final_state,
-                           start_time_ns=0):
-    x, y, z, t = population.get_xyzt_at_transitions(initial_state, final_state)
-    # to only look at counts from the most recent event, set a start time > 0
-    idx = t > start_time_ns
-    x_t = x[idx]; y_t = y[idx]
-    p_x, p_y = x_t**2, y_t**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(x_t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    return sum(in_channel_x), sum(in_channel_y)
-
 # Some path setup
 cwd = Path(__file__).parents[0]
 out_dir = cwd.parents[3] / 'tumbling_temp' / 'photobleaching' / 'dots_on_a_sphere'
@@ -118,9 +107,12 @@ for dtime in diffusion_times:
                            probabilities=[0.95, 0.05])
             a = Fluorophores(1e4,
                              diffusion_time=dtime,
-                             state_info=state_info)
+                             state_info=state_info,
+                             record_transitions=False) # Constant memory
+            # Count emissions as they happen
+            detector = PolarizedDetector('excited_singlet', 'ground')
+            a.add_detector(detector)
             print('Photobleaching', end='')
-            x_cts, y_cts = get_xy_emission_counts(a, 'excited_singlet', 'ground')
             if animating:
                 x_cdf = []; y_cdf = []; time_list = []
             # Let's bleach out a stripe while recording counts
@@ -131,20 +123,16 @@ for dtime in diffusion_times:
                                   polarization_xyz=(0, 1, 0))
                 if i % 100 == 0: print('.', end='')
                 if i % 10 == 0:
-                    x, y = get_xy_emission_counts(a, 'excited_singlet', 'ground',
-                                                  start_time_ns = (i-10)*10)
-                    x_cts += x; y_cts += y
                     if animating and i<1500:
                         make_animation_frame(a, out_name, out_dir, int(i/10),
                                              states=['excited_singlet', 'ground'],
                                              cmaps=[greensE, graysG])
-                        x_cdf.append(x_cts); y_cdf.append(y_cts)
+                        x_cdf.append(detector.counts_x)
+                        y_cdf.append(detector.counts_y)
                         time_list.append(i*10)
                 a.time_evolve(10) # should be pretty much fully decayed from singlet
                 a.delete_fluorophores_in_state('bleached')
-            x, y = get_xy_emission_counts(a, 'excited_singlet', 'ground',
-                                          start_time_ns = 9990*10) # get last cycle
-            x_cts += x; y_cts += y
+            x_cts, y_cts = detector.counts_x, detector.counts_y
             df = pd.DataFrame({'diffusion_time_ns': dtime,
                                'saturation': sat,
                                'counts_x': x_cts,
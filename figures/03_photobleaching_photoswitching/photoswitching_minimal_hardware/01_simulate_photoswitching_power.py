@@ -3,7 +3,9 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap as lsc
 from pathlib import Path
 import pandas as pd
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              PolarizedDetector)
 from numpy.random import uniform
 from math import floor
 
@@ -22,18 +24,6 @@ from math import floor
 # case where a labelled antibody is mixed with a clinical sample &
 # protein complex sizes are determined.
 
-def get_xy_emission_counts(population, initial_state, final_state,
-                           start_time_ns=0):
-    x, y, z, t = population.get_xyzt_at_transitions(initial_state, final_state)
-    # to only look at counts from the most recent event, set a start time > 0
-    idx = t > start_time_ns
-    x_t = x[idx]; y_t = y[idx]
-    p_x, p_y = x_t**2, y_t**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(x_t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    return sum(in_channel_x), sum(in_channel_y)
-
 # Some path setup
 cwd = Path(__file__).parents[0]
 out_dir = cwd.parents[3] / 'tumbling_temp' / 'photoswitching' / 'dots_on_a_sphere'
@@ -60,7 +50,6 @@ for dtime in diffusion_times:
                 if sat == 1.25 and dtime in [750, 6e3] and rep==0:
                     animating = True 
                     x_cdf = []; y_cdf = []; time_list = []
-                    x_cts = 0; y_cts = 0
                     # set up the figure we will put points on
                     # outside the time_evolve loop so points accumulate
                     fig = plt.figure(figsize=(6, 6))
@@ -93,10 +82,15 @@ for dtime in diffusion_times:
                                probabilities=[0.98, 0.02])
                 n, _ = state_info.n_and_lifetime('inactive_ground')
                 assert n[0] == 0 # check that inactive ground is index 0
+                # The animation plots individual emissions, so it needs
+                # every transition recorded. Otherwise, we just count.
                 a = Fluorophores(n_fluor,
                                  diffusion_time=dtime,
                                  state_info=state_info,
-                                 initial_state=0) # assume we inactivated first
+                                 initial_state=0, # assume we inactivated first
+                                 record_transitions=animating)
+                detector = PolarizedDetector('active_excited', 'active_ground')
+                a.add_detector(detector)
                 print('Recording', end='')
                 # Perpendicular activation and excitation/off-switching
                 for i in range(10000):
@@ -138,10 +132,7 @@ for dtime in diffusion_times:
                         xe, ye, ze = a.get_xyz_for_state('active_excited')
                         mole = ax.scatter(xe, ye, ze, s=10, c='#39ff14') 
                         # track the summed counts in each channel for the CDF
-                        x, y = get_xy_emission_counts(a, 'active_excited',
-                                                      'active_ground',
-                                                      start_time_ns=(i*10)-500)
-                        x_cts += x; y_cts += y
+                        x_cts, y_cts = detector.counts_x, detector.counts_y
                         x_cdf.append(x_cts); y_cdf.append(y_cts)
                         output_path = out_dir/(
                             out_name+'_frame{:04d}.png'.format(int(i/50)))
@@ -150,8 +141,7 @@ for dtime in diffusion_times:
                         time_list.append(i*10)
                     a.time_evolve(10)
                 # Get the total summed counts
-                x_total, y_total = get_xy_emission_counts(a, 'active_excited',
-                                                          'active_ground')
+                x_total, y_total = detector.counts_x, detector.counts_y
                 df = pd.DataFrame({'diffusion_time_ns': dtime,
                                    'saturation': sat,
                                    'counts_x': x_total,
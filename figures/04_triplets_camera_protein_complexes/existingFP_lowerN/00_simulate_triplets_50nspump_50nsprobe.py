@@ -2,9 +2,10 @@ from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap as lsc
-from numpy.random import uniform
 import pandas as pd
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              detect_photons)
 
 # This script simulates the use of a pump probe pulse scheme (i.e.
 # camera system) to measure protein interactions in cells. We track how
@@ -21,17 +22,6 @@ from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
 # yield (50%) and many molecules to extract a "true" picture of the
 # polarization decay.
 
-def get_xy_emission_counts(population, initial_state, final_state, time_cutoff=0):
-    x, y, z, t = population.get_xyzt_at_transitions(initial_state, final_state)
-    # threshold based on time before summing to remove singlets
-    trip_idx = t > time_cutoff
-    x_t = x[trip_idx]; y_t = y[trip_idx]
-    p_x, p_y = x_t**2, y_t**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(x_t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    return sum(in_channel_x), sum(in_channel_y)
-
 print("Pump Probe: Triplets with Small-ish Proteins")
 current = Path(__file__).parents[0]
 diffusion_times_ns = [450, 900, 3000]
@@ -71,8 +61,9 @@ for diff in diffusion_times_ns:
                                   intensity=0.25, polarization_xyz=(1, 0, 0))
                 a.time_evolve(5)
             a.time_evolve(50)# allow newly generated singlets enough time to emit
-            x, y = get_xy_emission_counts(a, 'excited_singlet', 'ground',
-                                          time_cutoff=150) # 50 ns illum, 50 ns decay
+            x, y, z, t = a.get_xyzt_at_transitions('excited_singlet', 'ground')
+            # 50 ns illum, 50 ns decay
+            x, y = detect_photons(x, y, z, t, time_edges=(150, np.inf))[0]
             result = pd.DataFrame({'x': x,
                                    'y': y,
                                    'diff_time_ns': diff,
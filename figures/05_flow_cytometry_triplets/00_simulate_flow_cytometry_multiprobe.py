@@ -2,8 +2,10 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import pandas as pd
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
-from numpy.random import uniform
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              PulseSequence,
+                                              detect_photons)
 from math import sin, cos
 
 # This code simulates a sequence of pulses on a flow cytometer at
@@ -16,18 +18,6 @@ from math import sin, cos
 # we model all of the delays sequentially on one fluorophores object
 # with a given rotational correlation time.)
 
-def get_xy_emission_counts(population, initial_state, final_state,
-                           start_time_ns=0):
-    x, y, z, t = population.get_xyzt_at_transitions(initial_state, final_state)
-    # to only look at counts from the most recent event, set a start time > 0
-    trip_idx = t > start_time_ns
-    x_t = x[trip_idx]; y_t = y[trip_idx]
-    p_x, p_y = x_t**2, y_t**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(x_t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    return sum(in_channel_x), sum(in_channel_y)
-
 # Some path setup
 current_dir = Path(__file__).parents[0]
 
@@ -37,6 +27,36 @@ delay_list = [100, 200, 400, 800, 1600, 3200, 6400] # matches camera-based
 laser_separation_ns = 10000 # interval between probe laser and next pump
 nrep = 12
 
+# The same pulse sequence is used for every simulation
+sequence = PulseSequence()
+for i, delay in enumerate(delay_list):
+    for x in range(10): # pump pulse, 50 ns duration
+        sequence.phototransition('ground', 'excited_singlet',
+                                 intensity=2, # saturate to generate many singlets
+                                 polarization_xyz=(0, 1, 0))
+        sequence.time_evolve(5)
+    sequence.time_evolve(delay)
+    # get any emissions in the 50 ns after the start of the probe pulse
+    sequence.readout('probe %d' % (i+1), 'excited_singlet', 'ground',
+                     duration=50)
+    # Circularly polarized probe (or our approximation to circular
+    # polarization). Circular is preferable to linear here because it
+    # will clean up more of the triplets before the next pulse. These 8
+    # back-to-back pulses get combined into a single pulse when the
+    # sequence runs.
+    for o in ((1, 0, 0), (0, 1, 0), (1, 1, 0), (1, -1, 0),
+              (sin(np.pi/8), cos(np.pi/8), 0),
+              (sin(3*np.pi/8), cos(3*np.pi/8), 0),
+              (sin(13*np.pi/8), cos(13*np.pi/8), 0),
+              (sin(15*np.pi/8), cos(15*np.pi/8), 0)):
+        sequence.phototransition('excited_triplet', 'excited_singlet',
+                                 intensity=1,
+                                 polarization_xyz=o)
+    sequence.time_evolve(50) # let emissions occur
+    # Move the cell down the flow cell to the next laser stage
+    if i < (len(delay_list) - 1):
+        sequence.time_evolve(laser_separation_ns)
+
 # Let's begin the simulations
 print("Simulation: Flow Cytometry with Triplets (Multi-pump, multi-probe)")
 results_list = []
@@ -54,40 +74,11 @@ for dtime in diffusion_times:
         a = Fluorophores(1e6,
                          diffusion_time=dtime,
                          state_info=state_info)
+        readouts = a.execute(sequence)
         x_list = []; y_list = []
-        time = 0
-        for i, delay in enumerate(delay_list):
-            print('Pump %d' % (i+1), 'Duration 50  ns')
-            for x in range(10): # pump pulse, 50 ns duration           
-                a.phototransition('ground', 'excited_singlet',
-                                  intensity=2, # saturate to generate many singlets
-                                  polarization_xyz=(0, 1, 0))
-                a.time_evolve(5); time+=5
-                print('.', end='')
-            print('\nTime evolving delay of %d ns' % delay)
-            a.time_evolve(delay); time+=delay
-            print('Probe %d' % (i+1))
-            # Circularly polarized probe (or our approximation to
-            # circular polarization). Circular is preferable to linear
-            # here because it will clean up more of the triplets before
-            # the next pulse.
-            for o in ((1, 0, 0), (0, 1, 0), (1, 1, 0), (1, -1, 0),
-                      (sin(np.pi/8), cos(np.pi/8), 0),
-                      (sin(3*np.pi/8), cos(3*np.pi/8), 0),
-                      (sin(13*np.pi/8), cos(13*np.pi/8), 0),
-                      (sin(15*np.pi/8), cos(15*np.pi/8), 0)):
-                a.phototransition('excited_triplet', 'excited_singlet',
-                                  intensity=1,
-                                  polarization_xyz=o)
-            a.time_evolve(50); time+=50 # let emissions occur
-            # get any emissions since the start of the last probe pulse
-            x, y = get_xy_emission_counts(a, 'excited_singlet', 'ground',
-                                          start_time_ns=time-50)
-            x_list.append(x); y_list.append(y) 
-            # Move the cell down the flow cell to the next laser stage
-            if i < (len(delay_list) - 1):
-                print('\nMoving to the next laser')
-                a.time_evolve(laser_separation_ns); time+=laser_separation_ns
+        for i in range(len(delay_list)):
+            x, y = detect_photons(*readouts['probe %d' % (i+1)][:3])
+            x_list.append(x); y_list.append(y)
         # record the output
         df = pd.DataFrame({'diffusion_time_ns': dtime,
                            'delay_ns': delay_list,
@@ -97,5 +88,3 @@ for dtime in diffusion_times:
         results_list.append(df)
 results = pd.concat(results_list, ignore_index=True)
 results.to_csv('flow_cytometry_circ_probe_12reps.csv')
-                           
-
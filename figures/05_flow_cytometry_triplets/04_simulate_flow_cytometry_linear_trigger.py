@@ -2,8 +2,9 @@ import numpy as np
 import matplotlib.pyplot as plt
 from pathlib import Path
 import pandas as pd
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
-from numpy.random import uniform
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              detect_photons)
 from math import sin, cos
 
 # This code simulates a sequence of pulses on a flow cytometer at
@@ -16,18 +17,6 @@ from math import sin, cos
 # we model all of the delays sequentially on one fluorophores object
 # with a given rotational correlation time.)
 
-def get_xy_emission_counts(population, initial_state, final_state,
-                           start_time_ns=0):
-    x, y, z, t = population.get_xyzt_at_transitions(initial_state, final_state)
-    # to only look at counts from the most recent event, set a start time > 0
-    trip_idx = t > start_time_ns
-    x_t = x[trip_idx]; y_t = y[trip_idx]
-    p_x, p_y = x_t**2, y_t**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(x_t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    return sum(in_channel_x), sum(in_channel_y)
-
 # Some path setup
 current_dir = Path(__file__).parents[0]
 
@@ -73,8 +62,10 @@ for dtime in diffusion_times:
                               polarization_xyz=(1, 0, 0))
             a.time_evolve(50); time+=50 # let emissions occur
             # get any emissions since the start of the last probe pulse
-            x, y = get_xy_emission_counts(a, 'excited_singlet', 'ground',
-                                          start_time_ns=time-50)
+            # (older emissions were already covered by our last read)
+            x, y, z, t = a.get_xyzt_at_transitions('excited_singlet', 'ground',
+                                                  since_last_read=True)
+            x, y = detect_photons(x, y, z, t, time_edges=(time-50, np.inf))[0]
             x_list.append(x); y_list.append(y) 
             # Move the cell down the flow cell to the next laser stage
             if i < (len(delay_list) - 1):
@@ -1,6 +1,26 @@
 #!/usr/bin/python
+import abc
+import copy
+import csv
+import functools
+import hashlib
+import heapq
+import inspect
+import io
+import itertools
+import json
+import multiprocessing
+import os
 import numpy as np
 from numpy.random import uniform, exponential, normal
+try: # Optional, but it makes diffusive steps much faster
+    from numba import njit
+except ImportError:
+    njit = None
+try: # Optional; EnsembleFluorophores() falls back to its own _expm()
+    from scipy.linalg import expm
+except ImportError:
+    expm = None
 
 """
 Time-resolved fluorescence anisotropy decay (TR-FA) is a powerful
@@ -25,34 +45,2815 @@ The purpose of this module is to simulate this type of measurement. We
 model the orientation and "photostate" of an ensemble of molecules. You
 can define your own photophysics with a FluorophoreStateInfo() object, and
 then model time evolution (tumbling, spontaneous transitions) and
-light-driven state transitions with a Fluorophores() object.
+light-driven state transitions with a Fluorophores() object. A whole
+experiment (pulses, delays, readout windows) can also be described up
+front with a PulseSequence() object, which Fluorophores.execute() runs
+as efficiently as it can. detect_photons() turns the orientations of
+emitting molecules into counts in polarized detection channels, and
+Detector() objects, like PolarizedDetector(), tally emissions as they
+happen, so long experiments don't need to keep a record of every
+transition. Molecules don't interact, so a
+ParallelFluorophores() object can split one big population across
+several processes, and run_sweep() runs a whole grid of independent
+simulations on a process pool. If all you need are ensemble averages
+(populations, <x^2>, expected polarized counts), EnsembleFluorophores()
+computes them deterministically, with no Monte Carlo noise, from the
+same FluorophoreStateInfo() and the same pulses.
+
+One Fluorophores() object can also hold a mixture of species (e.g.
+complexes of different sizes), each with its own diffusion time and,
+optionally, its own photophysics; detectors and transition records can
+be read out per species or in total.
+
+Fluorophores() can time evolve with one of two engines, which give the
+same statistics: the default 'sorted' engine processes molecules in
+order of their transition times, and the 'event' engine uses a priority
+queue to only touch molecules with a spontaneous transition in the
+current time window. Either way, orientations are updated lazily:
+molecules that sit idle don't tumble until somebody needs to know their
+orientation (a phototransition, a spontaneous transition, or a read).
+
+Every random draw comes from a numpy.random.Generator. Fluorophores()
+and Orientations() take a 'seed' (an int, a SeedSequence, or a
+Generator); with the default seed=None, they seed themselves from
+numpy's global random state, so np.random.seed() still makes a run
+reproducible. The lower-level functions take an optional 'rng'.
 
 [1] doi.org/10.1007/978-0-387-46312-4_11
 [2] patents.google.com/patent/US20210247315A1
 [3] doi.org/10.1038/s41587-022-01489-7
 """
 
-class Fluorophores:
+class Fluorophores:
+    """
+    An example usage, showing photoactivation and photoexcitation:
+
+    state_info = FluorophoreStateInfo()
+    state_info.add('inactive')
+    state_info.add('active')
+    state_info.add('excited', lifetime=2, final_states='active')
+
+    f = Fluorophores(
+        number_of_molecules=6,
+        diffusion_time=20,
+        state_info=state_info)
+    f.phototransition('inactive', 'active',
+                      intensity=10, polarization_xyz=(0, 0, 1))
+    f.delete_fluorophores_in_state('inactive')
+    f.phototransition('active', 'excited',
+                      intensity=10, polarization_xyz=(0, 0, 1))
+    f.time_evolve(1)
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'active')
+    print(len(t) "spontaneous 'excited'->'active' transition(s) occured")
+
+    The per-molecule arrays (f.states, f.transition_times, f.id,
+    f.species and the orientations) are views into buffers that
+    deleting and sorting molecules rewrite in place. An array you hold
+    on to across a call like time_evolve() or
+    delete_fluorophores_in_state() can end up holding other molecules'
+    data, so copy it (e.g. f.states.copy()) if you need to keep it.
+    """
+    def __init__(
+        self,
+        number_of_molecules,
+        diffusion_time,
+        initial_orientations='uniform',
+        state_info=None,
+        initial_state=0,
+        engine='sorted',
+        record_transitions=True,
+        precision='double',
+        seed=None,
+        species=None,
+        ):        
+        assert engine in ('sorted', 'event')
+        self.engine = engine
+        self.rng = _generator(seed) # Shared with our orientations
+        # 'compact' precision roughly halves memory use, for very large
+        # populations: 1-byte states, 4-byte ids, and single-precision
+        # orientations. Times stay double precision, since they
+        # accumulate over a whole experiment.
+        assert precision in ('double', 'compact')
+        self.precision = precision
+        self._orientations = Orientations(
+            number_of_molecules,
+            diffusion_time,
+            initial_orientations,
+            dtype='float32' if precision == 'compact' else 'float64',
+            seed=self.rng)
+        self.t = 0.0 # The current time. Orientations can lag behind this.
+        self._synced = None # (t, n) when everybody was last caught up
+        if state_info is None: # Default to the simplest photophysics
+            state_info = FluorophoreStateInfo()
+            state_info.add('ground')
+            state_info.add('excited', lifetime=1, final_states='ground')
+        # A mixture of species shares one set of states, but each
+        # species can have its own photophysics: 'state_info' can be a
+        # list, one per species. Only lifetimes and branching
+        # probabilities may differ, so which transitions are possible
+        # (and which states are stable) is the same for everybody.
+        if isinstance(state_info, FluorophoreStateInfo):
+            state_info = [state_info]
+        self.species_state_info = list(state_info)
+        state_info = self.state_info = self.species_state_info[0]
+        for other in self.species_state_info:
+            assert isinstance(other, FluorophoreStateInfo)
+            assert ([s.name for s in other.list] ==
+                    [s.name for s in state_info.list])
+            assert np.array_equal(other.branch_indptr,
+                                  state_info.branch_indptr)
+            assert np.array_equal(other.branch_final_states,
+                                  state_info.branch_final_states)
+            assert np.array_equal(np.isinf(other.lifetimes),
+                                  np.isinf(state_info.lifetimes))
+        self._lifetimes = np.stack( # Shape (species, states)
+            [other.lifetimes for other in self.species_state_info])
+
+        assert initial_state in state_info # Also raises an exception if invalid
+        n = self._orientations.n
+        if precision == 'compact':
+            assert len(state_info) <= 2**8 and n <= 2**32
+        self.states = np.full(n, state_info[initial_state].n,
+                              dtype='uint8' if precision == 'compact' else 'uint')
+        # 'species' labels each molecule 0, 1, 2...; give each species
+        # its own diffusion time with a per-molecule 'diffusion_time'.
+        # None means everybody is the same species.
+        if species is None:
+            assert len(self.species_state_info) == 1
+            self.species = None
+        else:
+            self.species = np.asarray(species).astype(
+                'uint32' if precision == 'compact' else 'int')
+            assert self.species.shape == (n,)
+            assert self.species.min() >= 0
+            if len(self.species_state_info) > 1:
+                assert self.species.max() < len(self.species_state_info)
+        self.transition_times = self.rng.exponential(
+            self._species_lifetimes(self.species, self.states))
+
+        # The order of molecules isn't preserved, so we give them unique id's:
+        self.id = np.arange(
+            n, dtype='uint32' if precision == 'compact' else 'int')
+
+        # We record molecular orientation and time for each spontaneous
+        # transition. We use this information to simulate measurements,
+        # since spontaneous transitions (e.g. excited->ground) are often
+        # associated with emitting light:
+        self.record_transitions = record_transitions
+        self.transition_events = {k: [] for k in (
+            'x', 'y', 'z', 't', 'initial_state', 'final_state', 'id')}
+        if self.species is not None:
+            self.transition_events['species'] = []
+        self._num_transition_events = 0
+        self._last_read = {} # (initial, final, species): number read
+        # For long experiments, that record grows without bound. If all
+        # we want is (say) photon counts, detectors can tally them as
+        # they happen, and we can set 'record_transitions' to False:
+        self.detectors = []
+        return None
+
+    def _species_lifetimes(self, species, states):
+        # Lifetimes of molecules of 'species' in 'states':
+        if len(self.species_state_info) == 1: # Same photophysics for all
+            return self._lifetimes[0, states]
+        return self._lifetimes[species, states]
+
+    def add_detector(self, detector):
+        """Feed every future spontaneous transition to 'detector', a
+        Detector() object such as a PolarizedDetector()."""
+        assert isinstance(detector, Detector)
+        assert detector.species is None or self.species is not None
+        detector._bind(self.state_info, self.rng)
+        self.detectors.append(detector)
+        return None
+
+    @property
+    def orientations(self):
+        # Reading every orientation means we have to bring every
+        # molecule up to the current time first, a diffusive step for
+        # everybody who's behind. Molecules only fall behind when time
+        # passes, so reading again at the same time (and population)
+        # is free. Use len(f) if all you need is how many there are.
+        now = (self.t, len(self.id))
+        if self._synced != now:
+            self._orientations.propagate_to(self.t)
+            self._synced = now
+        return self._orientations
+
+    def __len__(self):
+        return len(self.id)
+
+    def phototransition(
+        self,
+        initial_state, # Integer or string
+        final_states,  # Integer/string or iterable of integers/strings
+        state_probabilities=None, # None, or arraylike of floats
+        intensity=1,                # Saturation units
+        polarization_xyz=(0, 0, 1), # Only the direction matters
+        ):
+        if len(self.id) == 0: return None # No molecules, don't bother
+        self._phototransition(*_sanitize_phototransition(
+            self.state_info, initial_state, final_states, state_probabilities,
+            intensity, polarization_xyz))
+        return None
+
+    def _phototransition(
+        self,
+        initial_state,  # Integer
+        final_states,   # 1D array of integers
+        lifetimes,      # 1D array of floats, one per final state
+        state_probabilities, # None, or 1D array of floats that sums to 1
+        fields,         # Shape (k, 3): sqrt(intensity) * polarization_xyz
+        ):
+        # A linearly polarized pulse of light, oriented in an arbitrary
+        # direction, drives molecules to change their state. The
+        # 'effective intensity' for each molecule varies like the square
+        # of the cosine of the angle between the light's polarization
+        # direction and the molecular orientation. Several back-to-back
+        # pulses act like one pulse whose effective intensity is the sum
+        # of theirs, so 'fields' can hold more than one row.
+        i = np.flatnonzero(self.states == initial_state) # Who's in this state?
+        o = self._orientations # Temporary short nickname
+        o.propagate_to(self.t, i) # Only these orientations matter
+        x, y, z = o.x[i], o.y[i], o.z[i]
+        effective_intensity = np.zeros(len(i))
+        for px, py, pz in fields:
+            effective_intensity += (px*x + py*y + pz*z)**2 # Dot product
+        selection_prob = 1 - 2**(-effective_intensity) # Saturation units
+        selected = self.rng.uniform(0, 1, len(selection_prob)) <= selection_prob
+        # Every photoselected molecule now changes to a new state. If
+        # multiple 'final_states' are specified, the new state is
+        # randomly selected according to 'state_probabilities'. New
+        # 'transition_times' are randomly drawn for each new state from
+        # an exponential distribution given by 'lifetimes'.
+        t = np.full(np.count_nonzero(selected), self.t) # The current time
+        tr_t = self.transition_times[i] # A copy of relevant transition times
+        if state_probabilities is None:
+            which_state = np.zeros(t.shape, dtype='intp')
+        else:
+            # One uniform draw each, looked up in the cumulative
+            # probabilities:
+            cdf = np.cumsum(state_probabilities)
+            cdf[-1] = 1 # No roundoff past the last state
+            which_state = np.searchsorted(
+                cdf, self.rng.uniform(0, 1, t.shape), 'right')
+        ss = self.states[i] # A copy of the relevant states
+        ss[selected] = final_states[which_state]
+        self.states[i] = ss
+        if len(self.species_state_info) > 1: # Lifetimes depend on species
+            lifetimes = self._species_lifetimes(
+                self.species[i[selected]], ss[selected])
+        else:
+            lifetimes = lifetimes[which_state]
+        tr_t[selected] = t + self.rng.exponential(lifetimes)
+        self.transition_times[i] = tr_t
+        return None
+
+    def time_evolve(self, delta_t):
+        assert delta_t > 0
+        if len(self.id) == 0: # No molecules, but the clock still runs
+            self.t += delta_t
+            return None
+        if self.engine == 'event':
+            return self._time_evolve_event_driven(delta_t)
+        o = self._orientations # Local nickname
+        target_time = self.t + delta_t
+        self._sort_by(self.transition_times)
+        while True:
+            # Which molecules make a spontaneous transition before
+            # 'target_time'? Since we're sorted by transition time, it's
+            # the first few:
+            n = np.searchsorted(self.transition_times, target_time, 'right')
+            if n == 0: break # Nobody else changes state; we're done.
+            transitioning = np.arange(n)
+            # Update their orientations, and record their transitions.
+            # Everybody else's orientation can wait.
+            o.propagate_to(self.transition_times[transitioning], transitioning)
+            self._spontaneous_transition(transitioning)
+            # Only those first few got new transition times, so we don't
+            # need to re-sort everybody:
+            self._merge_sorted_head(n)
+        self.t = target_time
+        return None
+
+    def _time_evolve_event_driven(self, delta_t):
+        # Instead of re-sorting every molecule each time somebody makes
+        # a transition, we keep a priority queue of the molecules that
+        # will make a spontaneous transition before 'target_time', keyed
+        # by their transition times. We only touch molecules whose
+        # transitions fall in the current time window ("bucket"),
+        # diffusing each one from its last update directly to its
+        # transition time. Everybody else just waits.
+        o = self._orientations # Local nickname
+        target_time = self.t + delta_t
+        queue = _CalendarQueue(self.t, self._bucket_width(delta_t))
+        pending = np.flatnonzero(self.transition_times <= target_time)
+        queue.push(pending, self.transition_times[pending])
+        while len(queue) > 0:
+            bucket_end, idx = queue.pop()
+            while idx.size > 0:
+                o.propagate_to(self.transition_times[idx], idx)
+                self._spontaneous_transition(idx)
+                # Which molecules have another transition coming up soon?
+                t = self.transition_times[idx]
+                later = (bucket_end <= t) & (t <= target_time)
+                queue.push(idx[later], t[later])
+                idx = idx[(t < bucket_end) & (t <= target_time)] # This window
+        self.t = target_time
+        return None
+
+    def _bucket_width(self, delta_t):
+        # Short-lived states set the natural time scale for event
+        # windows; if nothing is short-lived, one window will do.
+        lifetimes = self._lifetimes
+        lifetimes = lifetimes[np.isfinite(lifetimes)]
+        return min(lifetimes.min(), delta_t) if lifetimes.size > 0 else delta_t
+
+    def _spontaneous_transition(self, transitioning):
+        # 'transitioning' indexes molecules which have reached their
+        # transition times. Record their orientations and times, then
+        # randomly choose their new states and new transition times.
+        o = self._orientations # Local nickname
+        initial_states = self.states[transitioning] # Copy of states that change
+        t = o.t[transitioning]
+        x, y, z = o.x[transitioning], o.y[transitioning], o.z[transitioning]
+        ids = self.id[transitioning]
+        # Everybody picks a final state in one go, whatever their
+        # initial state (or, if photophysics differ, one go per species):
+        r = self.rng.uniform(0, 1, len(t))
+        species = (None if self.species is None
+                   else self.species[transitioning])
+        if len(self.species_state_info) == 1:
+            final_states, lifetimes = self.state_info.branch(initial_states, r)
+        else:
+            final_states = np.empty(len(t), dtype='uint')
+            lifetimes = np.empty(len(t))
+            for k, state_info in enumerate(self.species_state_info):
+                mine = (species == k)
+                final_states[mine], lifetimes[mine] = state_info.branch(
+                    initial_states[mine], r[mine])
+        final_states = final_states.astype(initial_states.dtype, copy=False)
+        self.states[          transitioning] = final_states
+        self.transition_times[transitioning] = t + self.rng.exponential(
+            lifetimes)
+        if self.record_transitions:
+            e = self.transition_events # Local nickname
+            for k, v in (('x', x), ('y', y), ('z', z), ('t', t),
+                         ('initial_state', initial_states),
+                         ('final_state', final_states), ('id', ids),
+                         ('species', species)):
+                if k in e:
+                    e[k].append(v)
+            self._num_transition_events += len(t)
+        for detector in self.detectors:
+            detector.record(x, y, z, t, initial_states, final_states,
+                            species, ids)
+        return None
+
+    def get_xyz_for_state(self, state):
+        assert state in self.state_info
+        state = self.state_info[state].n # Ensure int
+        idx = np.flatnonzero(self.states == state)
+        o = self._orientations # Local nickname
+        o.propagate_to(self.t, idx) # Bring them up to the current time
+        return o.x[idx], o.y[idx], o.z[idx]
+
+    def get_xyzt_at_transitions(self, initial_state, final_state,
+                                since_last_read=False, species=None,
+                                replicates=None):
+        """Orientations and times of every recorded transition from
+        'initial_state' to 'final_state' (only by molecules of
+        'species', if it's not None).
+
+        If 'replicates' is an integer k, also return which of k
+        replicates each transition belongs to (see replicate_index()),
+        so one big run can stand in for k smaller ones.
+
+        If 'since_last_read' is True, only return the transitions that
+        happened since the last 'since_last_read' read of this pair of
+        states (and species). This costs time proportional to the number
+        of new transitions, not the whole history, so it's the right
+        choice for reading out one window after another.
+        """
+        assert initial_state in self.state_info
+        assert final_state in self.state_info
+        assert self.record_transitions, "Transitions aren't being recorded"
+        assert species is None or self.species is not None
+        initial_state = self.state_info[initial_state].n # Ensure int
+        final_state   = self.state_info[  final_state].n # Ensure int
+        if since_last_read:
+            e = self._unread_transition_events(
+                (initial_state, final_state, species))
+        else:
+            # We built 'self.transition_events' by appending 1D numpy
+            # arrays to lists. Now's a good time to join each list of
+            # arrays into a single array:
+            if len(self.transition_events['t']) > 1:
+                for k, v in self.transition_events.items():
+                    self.transition_events[k] = [np.concatenate(v)]
+            e = {k: v[0] if len(v) > 0 else np.zeros(0)
+                 for k, v in self.transition_events.items()}
+        # Select only the records that correspond to a particular transition:
+        tr = (e['initial_state'] == initial_state) & (
+              e[  'final_state'] == final_state)
+        if species is not None:
+            tr &= (e['species'] == species)
+        if replicates is not None:
+            return (e['x'][tr], e['y'][tr], e['z'][tr], e['t'][tr],
+                    replicate_index(e['id'][tr], replicates))
+        return e['x'][tr], e['y'][tr], e['z'][tr], e['t'][tr]
+
+    def _unread_transition_events(self, key):
+        # Every transition has an index into the full record, in the
+        # order it was recorded. Which ones haven't we read yet, for
+        # this (initial_state, final_state, species)?
+        first = self._last_read.get(key, 0)
+        self._last_read[key] = self._num_transition_events
+        # Walk backwards through the list of recorded arrays, until we
+        # reach the first unread transition. We don't touch the rest.
+        e = self.transition_events # Local nickname
+        num_arrays, start = 0, self._num_transition_events
+        while start > first:
+            num_arrays += 1
+            start -= len(e['t'][-num_arrays])
+        if num_arrays == 0: # Nothing new
+            return {k: np.zeros(0) for k in e}
+        return {k: np.concatenate([v[-num_arrays][first - start:]] +
+                                  v[len(v) - num_arrays + 1:])
+                for k, v in e.items()}
+
+    def delete_fluorophores_in_state(self, state):
+        if len(self.id) == 0: return None # No molecules, don't bother
+        assert state in self.state_info
+        state = self.state_info[state].n # Convert to int
+        self._rearrange(self.states != state)
+        return None
+
+    def execute(self, sequence, replicates=None):
+        """Run a PulseSequence(), starting from the current time.
+
+        Returns a dict of {name: (x, y, z, t)}, one entry per readout
+        window in the sequence, like get_xyzt_at_transitions() but
+        restricted to transitions inside the window. If 'replicates' is
+        an integer k, each entry is (x, y, z, t, replicate) instead.
+        """
+        assert isinstance(sequence, PulseSequence)
+        start_time = self.t
+        populated = np.bincount(self.states, minlength=len(self.state_info))
+        for op, *args in sequence.compile(self.state_info,
+                                          np.flatnonzero(populated)):
+            if op == 'pulse':
+                if len(self.id) > 0:
+                    self._phototransition(*args)
+            elif op == 'evolve':
+                self.time_evolve(*args)
+            elif op == 'advance': # Nobody can change state; just wait.
+                self.t += args[0]
+            elif op == 'delete':
+                self.delete_fluorophores_in_state(*args)
+        readouts = {}
+        for name, initial_state, final_state, start, stop in sequence.readouts:
+            xyzt = self.get_xyzt_at_transitions(initial_state, final_state,
+                                                replicates=replicates)
+            t = xyzt[3]
+            w = (start_time + start <= t) & (t < start_time + stop)
+            readouts[name] = tuple(a[w] for a in xyzt)
+        return readouts
+
+    def split_by_delay(self, delays, sequence, replicates=None):
+        """Run PulseSequence() 'sequence' (e.g. a probe) once per delay,
+        starting 'delays[g]' after now, each on its own share of the
+        molecules. Molecules are dealt out to the delays at random, in
+        equal shares, so every share holds molecules from every
+        replicate (see replicate_index()).
+
+        Real probes are destructive, so each delay should see its own
+        molecules. Splitting one population gives every delay
+        independent molecules, unlike fork(), whose copies start out
+        identical. This is a convenience, not a speedup: it costs about
+        the same as running each delay on its own population.
+
+        Returns a list, one dict per delay, like execute(sequence,
+        replicates) returns. Each
+        share draws from its own generator, spawned from ours, and
+        records only its own transitions; our molecules, our record of
+        transitions, and our random stream are left as they were.
+        """
+        delays = np.asarray(delays, dtype='float').ravel()
+        assert len(delays) > 0 and np.all(delays >= 0)
+        # Not by id: replicate_index() splits by id, so a share of
+        # every len(delays)-th id would miss most replicates.
+        deal, *rngs = self.rng.spawn(len(delays) + 1)
+        group = deal.permutation(len(self.id)) % len(delays)
+        readouts = []
+        for g, (delay, rng) in enumerate(zip(delays, rngs)):
+            share = self._copy(rng, group == g, history=False)
+            share.detectors = []
+            if delay > 0:
+                share.time_evolve(delay)
+            readouts.append(share.execute(sequence, replicates))
+        return readouts
+
+    def fork(self, seed=None):
+        """A copy of this object as it is now, which evolves
+        independently from here on, drawing from its own 'seed' (see
+        _generator()). Run a shared start (e.g. a pump) once, then fork
+        off each of several endings (e.g. probe delays).
+
+        The copy gets its own molecules and copies of our detectors.
+        Recorded transitions are never modified once recorded, so the
+        record so far is shared, not copied.
+        """
+        return self._copy(_generator(seed))
+
+    def _copy(self, rng, selection=None, history=True):
+        # A copy of the molecules picked by the boolean mask 'selection'
+        # (default: everybody), drawing from 'rng'. With history=False,
+        # the copy starts with an empty record of transitions.
+        new = copy.copy(self)
+        o = new._orientations = copy.copy(self._orientations)
+        new.rng = o.rng = rng
+        new._set_columns([c.copy() if selection is None else c[selection]
+                          for c in self._columns()])
+        new.transition_events = {
+            k: list(v) if history else []
+            for k, v in self.transition_events.items()}
+        new._num_transition_events = (
+            self._num_transition_events if history else 0)
+        new._last_read = dict(self._last_read) if history else {}
+        new.detectors = []
+        for detector in self.detectors:
+            new.add_detector(copy.deepcopy(detector))
+        return new
+
+    def snapshot(self):
+        """Everything needed to pick up where we left off, as a dict of
+        numpy arrays; see from_snapshot() and save(). Detectors aren't
+        included.
+        """
+        o = self._orientations # Local nickname
+        e = self.transition_events # Local nickname
+        snapshot = {k: np.array(v) for k, v in (
+            ('engine', self.engine),
+            ('precision', self.precision),
+            ('record_transitions', self.record_transitions),
+            ('t', self.t),
+            ('rng_state', json.dumps(self.rng.bit_generator.state)),
+            ('state_names', [s.name for s in self.state_info.list]),
+            ('lifetimes', self._lifetimes),
+            ('branch_indptr', self.state_info.branch_indptr),
+            ('branch_final_states', self.state_info.branch_final_states),
+            ('branch_probabilities', [s.branch_probabilities
+                                      for s in self.species_state_info]),
+            ('diffusion_time', o.diffusion_time),
+            ('states', self.states),
+            ('transition_times', self.transition_times),
+            ('id', self.id),
+            ('x', o.x), ('y', o.y), ('z', o.z), ('orientation_t', o.t),
+            ('num_transition_events', self._num_transition_events),
+            ('last_read', [(i, f, -1 if s is None else s, n)
+                           for (i, f, s), n in self._last_read.items()]),
+            )}
+        if self.species is not None:
+            snapshot['species'] = self.species.copy()
+        # Join each list of recorded arrays, like get_xyzt_at_transitions()
+        # does; nobody modifies them, so we can share them as-is:
+        if len(e['t']) > 1:
+            for k, v in e.items():
+                e[k] = [np.concatenate(v)]
+        for k, v in e.items():
+            snapshot['event_' + k] = v[0] if len(v) > 0 else np.zeros(0)
+        return snapshot
+
+    @classmethod
+    def from_snapshot(cls, snapshot, seed=None):
+        """Rebuild a Fluorophores() object from snapshot(). With
+        seed=None, it carries on with the snapshot's random stream, so
+        it does exactly what the original would have done."""
+        s = snapshot # Local nickname
+        self = cls.__new__(cls)
+        self.engine = str(s['engine'])
+        self.precision = str(s['precision'])
+        self.record_transitions = bool(s['record_transitions'])
+        self.t = float(s['t'])
+        if seed is None:
+            self.rng = np.random.default_rng()
+            self.rng.bit_generator.state = json.loads(str(s['rng_state']))
+        else:
+            self.rng = _generator(seed)
+        # Rebuild each species' photophysics from its branching matrix:
+        names = [str(name) for name in s['state_names']]
+        indptr, finals = s['branch_indptr'], s['branch_final_states']
+        self.species_state_info = []
+        for lifetimes, probabilities in zip(s['lifetimes'],
+                                            s['branch_probabilities']):
+            state_info = FluorophoreStateInfo()
+            for n, name in enumerate(names):
+                row = slice(indptr[n], indptr[n+1])
+                state_info.add(name, lifetimes[n],
+                               [names[f] for f in finals[row]],
+                               probabilities[row])
+            self.species_state_info.append(state_info)
+        self.state_info = self.species_state_info[0]
+        self._lifetimes = np.stack(
+            [other.lifetimes for other in self.species_state_info])
+        o = self._orientations = Orientations.__new__(Orientations)
+        o.rng = self.rng
+        o.dtype = 'float32' if self.precision == 'compact' else 'float64'
+        o.diffusion_time = np.array(s['diffusion_time'])
+        self.species = np.array(s['species']) if 'species' in s else None
+        columns = [np.array(s[k]) for k in (
+            'states', 'transition_times', 'id',
+            'x', 'y', 'z', 'orientation_t')]
+        if self.species is not None:
+            columns.append(self.species)
+        if o.diffusion_time.shape == columns[0].shape:
+            columns.append(o.diffusion_time)
+        self._set_columns(columns)
+        self._num_transition_events = int(s['num_transition_events'])
+        self.transition_events = {
+            k[len('event_'):]: ([np.array(s[k])]
+                                if self._num_transition_events > 0 else [])
+            for k in s if k.startswith('event_')}
+        self._last_read = {(i, f, None if sp == -1 else sp): n
+                           for i, f, sp, n in s['last_read'].tolist()}
+        self.detectors = []
+        return self
+
+    def save(self, filename):
+        """Save snapshot() to an .npz file, for load()."""
+        np.savez(filename, **self.snapshot())
+        return None
+
+    @classmethod
+    def load(cls, filename, seed=None):
+        """Load a Fluorophores() object saved with save()."""
+        with np.load(filename) as snapshot:
+            return cls.from_snapshot(snapshot, seed)
+
+    def _sort_by(self, x):
+        x = np.asarray(x)
+        assert x.shape == self.id.shape
+        x_is_sorted = np.all(x[1:] >= x[:-1]) # np.diff() chokes on inf - inf
+        if x_is_sorted:
+            return None
+        idx = np.argsort(x)
+        self._rearrange(idx)
+        return idx
+
+    def _merge_sorted_head(self, k):
+        # The first 'k' molecules have new transition times, and the
+        # rest are still sorted. Sort the first 'k' among themselves,
+        # then merge them into the rest. Molecules past the last
+        # insertion point don't move, so we only shuffle up to there.
+        tt = self.transition_times # Local nickname
+        head = np.argsort(tt[:k], kind='stable')
+        # Where each of the sorted head lands in the merged order:
+        landing = np.searchsorted(tt[k:], tt[:k][head], 'right')
+        landing += np.arange(k)
+        m = landing[-1] + 1
+        idx = np.empty(m, dtype=head.dtype)
+        stays_put = np.ones(m, dtype=bool)
+        stays_put[landing] = False
+        idx[landing] = head
+        idx[stays_put] = np.arange(k, m)
+        self._permute_head(idx)
+        return None
+
+    def _columns(self):
+        # Every per-molecule array, all in the same order.
+        o = self._orientations # Local nickname
+        columns = [self.states, self.transition_times, self.id,
+                   o.x, o.y, o.z, o.t]
+        if self.species is not None:
+            columns.append(self.species)
+        if o.diffusion_time.shape == (o.n,):
+            columns.append(o.diffusion_time)
+        return columns
+
+    def _permute_head(self, idx):
+        # Gather molecules 'idx' into the first len(idx) slots, in
+        # place, through one scratch buffer that's freed when we return.
+        # Everybody after those slots stays put.
+        m = len(idx)
+        columns = self._columns()
+        scratch = np.empty(m * max(c.itemsize for c in columns), 'uint8')
+        for c in columns:
+            out = scratch[:m*c.itemsize].view(c.dtype)
+            np.take(c, idx, out=out, mode='clip')
+            c[:m] = out
+        return None
+
+    def _rearrange(self, selection):
+        # Keep (and reorder) the molecules picked by 'selection', either
+        # a boolean mask or an array of indices. Each per-molecule array
+        # is shuffled through one temporary scratch buffer and written back
+        # into its own memory, so deleting or sorting allocates nothing
+        # per array; the live population is just the leading slice.
+        selection = np.asarray(selection)
+        if selection.dtype == bool and selection.all():
+            return None # Nobody to delete
+        columns = self._columns()
+        m = (np.count_nonzero(selection) if selection.dtype == bool
+             else len(selection))
+        if m < self._capacity() // 4:
+            # Mostly gone (e.g. after heavy bleaching): copy the
+            # survivors into right-sized arrays, and let the big buffers
+            # go, instead of carrying them around forever.
+            self._set_columns([c[selection] for c in columns])
+            return None
+        if selection.dtype == bool and njit is not None:
+            # Deleting keeps everybody in order, so Numba can slide the
+            # survivors down in place without any scratch at all:
+            for c in columns:
+                _compact_in_place(c, selection)
+        else:
+            if selection.dtype == bool:
+                selection = np.flatnonzero(selection)
+            self._permute_head(selection)
+        self._set_columns([c[:m] for c in columns])
+        return None
+
+    def _capacity(self):
+        # How many molecules our buffers have room for; the live
+        # population is the leading len(self.id) of them.
+        base = self.id.base
+        return len(self.id) if base is None else base.size
+
+    def _set_columns(self, columns):
+        # The inverse of _columns(): point our attributes at 'columns'.
+        o = self._orientations # Local nickname
+        (self.states, self.transition_times, self.id,
+         o.x, o.y, o.z, o.t, *rest) = columns
+        if self.species is not None:
+            self.species = rest.pop(0)
+        if rest:
+            o.diffusion_time = rest[0]
+        o.n = len(self.id)
+        self._synced = None # New arrays; check them on the next read
+        return None
+
+def _compact_in_place(column, keep):
+    # Stable in-place deletion: copy each kept entry down over the gaps.
+    w = 0
+    for i in range(len(keep)):
+        if keep[i]:
+            column[w] = column[i]
+            w += 1
+    return w
+
+if njit is not None:
+    _compact_in_place = njit(nogil=True)(_compact_in_place)
+
+def _sanitize_phototransition(
+    state_info,
+    initial_state,
+    final_states,
+    state_probabilities,
+    intensity,
+    polarization_xyz,
+    ):
+    # Convert the arguments of Fluorophores.phototransition() to the
+    # arguments of Fluorophores._phototransition()
+    assert initial_state in state_info
+    initial_state = state_info[initial_state].n # Ensure int
+    final_states, lifetimes = state_info.n_and_lifetime(final_states)
+    if final_states.shape == (1,):
+        assert state_probabilities is None
+    else:
+        state_probabilities = np.asarray(state_probabilities, 'float')
+        assert state_probabilities.shape == final_states.shape
+        assert np.all(state_probabilities > 0)
+        state_probabilities /= state_probabilities.sum() # Sums to 1
+    assert intensity > 0
+    polarization_xyz = np.asarray(polarization_xyz, dtype='float')
+    assert polarization_xyz.shape == (3,)
+    polarization_xyz /= np.linalg.norm(polarization_xyz) # Unit vector
+    fields = np.sqrt(intensity) * polarization_xyz.reshape(1, 3)
+    return initial_state, final_states, lifetimes, state_probabilities, fields
+
+def _test_fluorophores_speed(n=int(1e6)):
+    import time
+    t = []
+    for i in range(10):
+        start = time.perf_counter()
+        f = Fluorophores(number_of_molecules=n, diffusion_time=1)
+        end = time.perf_counter()
+        t.append(end-start)
+    print('\n%0.1f nanoseconds per'%(1e9*np.mean(t) / len(f)),
+          "fluorophore created by Fluorophores()")
+
+    f = Fluorophores(number_of_molecules=n, diffusion_time=1)
+    start = time.perf_counter()
+    f.phototransition('ground', 'excited')
+    end = time.perf_counter()
+    t = end - start
+    print('%0.1f nanoseconds per'%(1e9*t / len(f)),
+          "fluorophore phototransitioning")
+    
+    # time_evolve() only propagates molecules that change state, and
+    # leaves everybody else for later, so we time it together with a
+    # readout that brings every molecule up to date:
+    dt = 5
+    f = Fluorophores(number_of_molecules=100, diffusion_time=1)
+    f.phototransition('ground', 'excited')
+    f.time_evolve(dt); f.orientations # Warm up Numba, if we have it
+    for excite in (False, True):
+        f = Fluorophores(number_of_molecules=n, diffusion_time=1)
+        if excite:
+            f.phototransition('ground', 'excited')
+        start = time.perf_counter()
+        f.time_evolve(dt)
+        o = f.orientations # Forces propagation
+        end = time.perf_counter()
+        t = end - start
+        assert np.all(o.t == f.t)
+        print('%0.1f nanoseconds per'%(1e9*t / o.n),
+              "fluorophore time evolving for %0.1f diffusion times"%(
+                  dt/o.diffusion_time),
+              "(%s)"%('with fluorescence' if excite else 'in the dark'))
+    # Once everybody's caught up, reading again is free:
+    start = time.perf_counter()
+    for i in range(1000):
+        assert f.orientations.n == len(f) == n
+    end = time.perf_counter()
+    print('%0.1f microseconds per repeated read of f.orientations'%(
+        1e6*(end - start) / 1000))
+    assert (end - start) / 1000 < t / 100
+    return None
+
+def _test_fluorophores_anisotropy_decay_plot(n=int(1e8)):
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print("Matplotlib import failed; no graphical test of Fluorophores()")
+        return None
+
+    print("\nSimulating classic anisotropy decay...", sep='', end='')
+    f = Fluorophores(n, diffusion_time=1, precision='compact')
+    f.phototransition('ground', 'excited',
+                      intensity=0.05, polarization_xyz=(1,0,0))
+    while len(f.id) > 0:
+        print('.', sep='', end='')
+        f.delete_fluorophores_in_state('ground')
+        f.time_evolve(0.3)
+    print("done.")
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+    bins = np.linspace(0, 3, 200)
+    bin_centers = (bins[1:] + bins[:-1])/2
+    # We only need counts, so skip the per-photon random draws:
+    hist_x, hist_y = detect_photons(x, y, z, t, time_edges=bins,
+                                    method='binned').T
+
+    print("Saving results in test_classic_anisotropy_decay.png...", end='')
+    plt.figure()
+    plt.plot(bin_centers, hist_x, '.-', label=r'$\parallel$ polarization')
+    plt.plot(bin_centers, hist_y, '.-', label=r'$\perp$ polarization')
+    plt.title(
+        "Simulation of classic time-resolved anisotropy decay\n" +
+        r"$\tau_f$=%0.1f, $\tau_d$=%0.1f"%(f.state_info['excited'].lifetime,
+                                           f.orientations.diffusion_time))
+    plt.xlabel(r"Time (t/$\tau_f$)")
+    plt.ylabel("Photons per time bin")
+    plt.legend(); plt.grid('on')
+    plt.savefig("test_classic_anisotropy_decay.png"); plt.close()
+    print("done.")
+    return None
+
+def _test_fluorophores_engines(n=int(1e6)):
+    import time
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited_singlet', lifetime=2,
+                   final_states=['ground', 'excited_triplet'],
+                   probabilities=[0.99, 0.01])
+    state_info.add('excited_triplet', lifetime=1e6, final_states='ground')
+    print()
+    for engine in ('sorted', 'event'):
+        f = Fluorophores(n, diffusion_time=450, state_info=state_info,
+                         engine=engine)
+        start = time.perf_counter()
+        for i in range(10):
+            f.phototransition('ground', 'excited_singlet', intensity=0.25,
+                              polarization_xyz=(0, 1, 0))
+            f.time_evolve(5)
+        f.delete_fluorophores_in_state('ground')
+        f.time_evolve(1000)
+        end = time.perf_counter()
+        x, y, z, t = f.get_xyzt_at_transitions('excited_singlet', 'ground')
+        print('%0.1f nanoseconds per'%(1e9*(end - start) / n),
+              "fluorophore for a pump-and-wait with engine='%s'"%(engine))
+        print("  %i singlet emissions, <x^2>=%0.4f, <y^2>=%0.4f"%(
+            len(t), np.mean(x**2), np.mean(y**2)))
+    return None
+
+def _test_branching(n=int(1e6), batch_size=1000):
+    import time
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('singlet', lifetime=1, final_states=['ground', 'triplet'],
+                   probabilities=[0.9, 0.1])
+    state_info.add('triplet', lifetime=100,
+                   final_states=['ground', 'singlet', 'bleached'],
+                   probabilities=[0.7, 0.2, 0.1])
+    state_info.add('bleached')
+    assert np.array_equal(state_info.branch_indptr, [0, 1, 3, 6, 7])
+    assert not state_info.branch_probabilities.flags.writeable # Compiled
+    rng = np.random.default_rng(0)
+    initial_states = rng.integers(0, 4, n).astype('uint')
+    batches = range(0, n, batch_size) # Time evolution branches in batches
+    # One np.random.choice() per initial state, like we used to:
+    start = time.perf_counter()
+    for b in batches:
+        batch = initial_states[b:b+batch_size]
+        for state in state_info.list:
+            count = np.count_nonzero(batch == state.n)
+            final_states, _ = state_info.n_and_lifetime(state.final_states)
+            final_states[rng.choice(len(final_states), count,
+                                    p=state.probabilities)]
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per molecule'%(1e9*(end - start)/n),
+          'branching with np.random.choice()')
+    start = time.perf_counter()
+    final_states, lifetimes = [], []
+    for b in batches:
+        batch = initial_states[b:b+batch_size]
+        f, l = state_info.branch(batch, rng.uniform(0, 1, len(batch)))
+        final_states.append(f), lifetimes.append(l)
+    end = time.perf_counter()
+    final_states = np.concatenate(final_states)
+    lifetimes = np.concatenate(lifetimes)
+    print('%0.1f nanoseconds per molecule'%(1e9*(end - start)/n),
+          'branching with FluorophoreStateInfo.branch()')
+    for state in state_info.list:
+        mine = (initial_states == state.n)
+        finals, expected_lifetimes = state_info.n_and_lifetime(
+            state.final_states)
+        counts = [np.count_nonzero(final_states[mine] == f) for f in finals]
+        expected = state.probabilities * np.count_nonzero(mine)
+        assert np.all(np.abs(counts - expected) < 5*np.sqrt(expected) + 1)
+        assert sum(counts) == np.count_nonzero(mine) # Nobody goes astray
+        for f, lifetime in zip(finals, expected_lifetimes):
+            assert np.all(lifetimes[mine & (final_states == f)] == lifetime)
+    return None
+
+def _test_seeding(n=int(1e4)):
+    # Same seed, same run, whatever the engine; np.random.seed() works
+    # too, for code that doesn't pass seeds around.
+    def run(engine, seed):
+        f = Fluorophores(n, diffusion_time=3, engine=engine, seed=seed)
+        d = PolarizedDetector('excited', 'ground')
+        f.add_detector(d)
+        for i in range(10):
+            f.phototransition('ground', 'excited', intensity=0.5,
+                              polarization_xyz=(1, 0, 0))
+            f.time_evolve(2)
+        x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+        return np.concatenate((x, y, z, t, [d.counts_x, d.counts_y]))
+    for engine in ('sorted', 'event'):
+        assert np.array_equal(run(engine, 1), run(engine, 1))
+        assert not np.array_equal(run(engine, 1), run(engine, 2))
+        np.random.seed(3); a = run(engine, None)
+        np.random.seed(3); b = run(engine, None)
+        assert np.array_equal(a, b)
+    seed = np.random.SeedSequence(4)
+    assert np.array_equal(run('sorted', seed), run('sorted', seed))
+    print("Same seed, same results, for both engines")
+    return None
+
+def _test_since_last_read(n=int(1e5), cycles=300):
+    import time
+    # Read out one window after another, two ways:
+    for since_last_read in (False, True):
+        np.random.seed(0)
+        f = Fluorophores(n, diffusion_time=3)
+        read_time, counts = 0, []
+        for i in range(cycles):
+            f.phototransition('ground', 'excited', intensity=0.05)
+            f.time_evolve(10)
+            start = time.perf_counter()
+            x, y, z, t = f.get_xyzt_at_transitions(
+                'excited', 'ground', since_last_read=since_last_read)
+            if not since_last_read:
+                x = x[t > f.t - 10]
+            read_time += time.perf_counter() - start
+            counts.append(len(x))
+        print('%0.1f nanoseconds per fluorophore'%(1e9*read_time/n),
+              'reading %i windows with since_last_read=%s'%(
+                  cycles, since_last_read))
+        if since_last_read:
+            assert counts == previous_counts
+        previous_counts = counts
+    return None
+
+def _test_incremental_sort(n=int(1e5), cycles=5):
+    import time
+    # A few molecules blink on and off many times, while most sit in
+    # the ground state. Re-sorting everybody after every batch of
+    # transitions, vs. merging just the molecules that transitioned:
+    class FullySorted(Fluorophores):
+        def _merge_sorted_head(self, k):
+            self._sort_by(self.transition_times)
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('on', lifetime=0.2, final_states='off')
+    state_info.add('off', lifetime=0.2, final_states='on')
+    f = Fluorophores(100, diffusion_time=3, state_info=state_info)
+    f.phototransition('ground', 'on') # Compile Numba before timing
+    f.time_evolve(1)
+    for cls in (FullySorted, Fluorophores):
+        np.random.seed(0)
+        f = cls(n, diffusion_time=3, state_info=state_info, engine='sorted')
+        start = time.perf_counter()
+        for i in range(cycles):
+            f.phototransition('ground', 'on', intensity=0.002)
+            f.time_evolve(20)
+        end = time.perf_counter()
+        tt = f.transition_times
+        assert np.all(tt[1:] >= tt[:-1])
+        assert len(np.unique(f.id)) == n
+        x, y, z, t = f.get_xyzt_at_transitions('on', 'off')
+        print('%0.1f nanoseconds per fluorophore'%(1e9*(end - start)/n),
+              'with %s (%i blinks)'%(cls.__name__, len(t)))
+    return None
+
+def _test_fork(n=int(2e5), delays=(100, 200, 400, 800, 1600, 3200, 6400)):
+    import tempfile
+    import time
+    # A pump-probe sweep: every probe delay starts with the same pump.
+    triplet_qy = 0.1
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited_singlet', lifetime=2,
+                   final_states=['ground', 'excited_triplet'],
+                   probabilities=[1 - triplet_qy, triplet_qy])
+    state_info.add('excited_triplet', lifetime=1e4, final_states='ground')
+    def pump(f):
+        for i in range(10):
+            f.phototransition('ground', 'excited_singlet', intensity=0.25,
+                              polarization_xyz=(0, 1, 0))
+            f.time_evolve(5)
+        f.delete_fluorophores_in_state('ground')
+    def probe(f, delay):
+        f.time_evolve(delay)
+        start_time = f.t
+        for i in range(10):
+            f.phototransition('excited_triplet', 'excited_singlet',
+                              intensity=0.25, polarization_xyz=(1, 0, 0))
+            f.time_evolve(5)
+        f.time_evolve(50)
+        x, y, z, t = f.get_xyzt_at_transitions('excited_singlet', 'ground')
+        return detect_photons(x, y, z, t, time_edges=(start_time, np.inf),
+                              rng=f.rng)[0]
+    probe(Fluorophores(1000, 900, state_info=state_info), 100) # Warm up
+    # Pump from scratch for every delay...
+    start = time.perf_counter()
+    from_scratch = []
+    for i, delay in enumerate(delays):
+        f = Fluorophores(n, diffusion_time=900, state_info=state_info,
+                         seed=i)
+        pump(f)
+        from_scratch.append(probe(f, delay))
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore per delay, pumping every time'%(
+        1e9*(end - start) / (n*len(delays))))
+    # ...or pump once, and fork off each delay:
+    start = time.perf_counter()
+    f = Fluorophores(n, diffusion_time=900, state_info=state_info, seed=0)
+    pump(f)
+    states, times = f.states.copy(), f.transition_times.copy()
+    forked = [probe(f.fork(seed=i), delay) for i, delay in enumerate(delays)]
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore per delay, pumping once'%(
+        1e9*(end - start) / (n*len(delays))))
+    assert np.array_equal(f.states, states) # Forks don't touch the parent
+    assert np.array_equal(f.transition_times, times)
+    for a, b in zip(from_scratch, forked):
+        assert np.all(abs(a - b) < 5*np.sqrt(a + b + 1))
+    print('Probe counts (x, y) by delay:', *forked)
+    # The same seed, the same fork:
+    assert np.array_equal(probe(f.fork(seed=1), 100),
+                          probe(f.fork(seed=1), 100))
+    # A saved snapshot carries on exactly as the original would have:
+    f.get_xyzt_at_transitions('excited_singlet', 'ground',
+                              since_last_read=True)
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, 'snapshot.npz')
+        f.save(filename)
+        g = Fluorophores.load(filename)
+    assert np.array_equal(probe(f, 300), probe(g, 300))
+    for a, b in zip(f.get_xyzt_at_transitions('excited_singlet', 'ground',
+                                              since_last_read=True),
+                    g.get_xyzt_at_transitions('excited_singlet', 'ground',
+                                              since_last_read=True)):
+        assert np.array_equal(a, b)
+    print('Forks and snapshots behave')
+    return None
+
+def _test_split_by_delay(n=int(2e5), delays=(100, 200, 400, 800, 1600, 3200,
+                                              6400)):
+    import time
+    triplet_qy = 0.1
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited_singlet', lifetime=2,
+                   final_states=['ground', 'excited_triplet'],
+                   probabilities=[1 - triplet_qy, triplet_qy])
+    state_info.add('excited_triplet', lifetime=1e4, final_states='ground')
+    def pump(f):
+        for i in range(10):
+            f.phototransition('ground', 'excited_singlet', intensity=0.25,
+                              polarization_xyz=(0, 1, 0))
+            f.time_evolve(5)
+        f.delete_fluorophores_in_state('ground')
+    def probe(delay=None):
+        seq = PulseSequence()
+        if delay is not None:
+            seq.time_evolve(delay)
+        seq.readout('probe', 'excited_singlet', 'ground')
+        for i in range(10):
+            seq.phototransition('excited_triplet', 'excited_singlet',
+                                intensity=0.25, polarization_xyz=(1, 0, 0))
+            seq.time_evolve(5)
+        seq.time_evolve(50)
+        return seq
+    def counts(readout):
+        x, y, z, t = readout['probe']
+        return np.array([np.sum(x**2), np.sum(y**2)]) # Expected counts
+    f = Fluorophores(1000, 900, state_info=state_info) # Warm up
+    pump(f)
+    f.execute(probe(max(delays)))
+    # A fresh population of 'n' molecules for each delay...
+    start = time.perf_counter()
+    from_scratch = []
+    for i, delay in enumerate(delays):
+        f = Fluorophores(n, diffusion_time=900, state_info=state_info,
+                         seed=i)
+        pump(f)
+        from_scratch.append(counts(f.execute(probe(delay))))
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore per delay, from scratch'%(
+        1e9*(end - start) / (n*len(delays))))
+    # ...or one population, split into 'n' molecules per delay:
+    start = time.perf_counter()
+    f = Fluorophores(n*len(delays), diffusion_time=900,
+                     state_info=state_info, seed=len(delays))
+    pump(f)
+    states, times = f.states.copy(), f.transition_times.copy()
+    num_events = f._num_transition_events
+    rng_state = f.rng.bit_generator.state
+    split = [counts(r) for r in f.split_by_delay(delays, probe())]
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore per delay, with'%(
+        1e9*(end - start) / (n*len(delays))), 'split_by_delay()')
+    print('Probe <x^2>, <y^2> sums by delay:',
+          *(np.round(c).astype('int') for c in split))
+    for a, b in zip(from_scratch, split):
+        assert np.all(abs(a - b) < 5*np.sqrt(a + b + 1))
+    assert np.array_equal(f.states, states) # We're left as we were
+    assert np.array_equal(f.transition_times, times)
+    assert f._num_transition_events == num_events
+    assert f.rng.bit_generator.state == rng_state
+    # Every share holds every replicate, even when the number of
+    # replicates and the number of delays have a common factor:
+    for k in (len(delays), 2*len(delays)):
+        for readout in f.split_by_delay(delays, probe(), replicates=k):
+            x, y, z, t, replicate = readout['probe']
+            per_replicate = np.bincount(replicate, minlength=k)
+            assert len(per_replicate) == k and np.all(per_replicate > 0)
+            assert per_replicate.min() > per_replicate.mean() / 2
+    # With just one delay, the one share is everybody:
+    expected = counts(f.fork(seed=0).execute(probe(100)))
+    observed = counts(f.split_by_delay([100], probe())[0])
+    assert np.all(abs(observed - expected) < 5*np.sqrt(observed + expected))
+    return None
+
+def _test_in_place_compaction(n=int(1e5), cycles=1000):
+    import time, tracemalloc
+    # A photobleaching-style loop: excite, wait, delete the bleached.
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited', lifetime=1, final_states=['ground', 'bleached'],
+                   probabilities=[0.999, 0.001])
+    state_info.add('bleached')
+    np.random.seed(0)
+    f = Fluorophores(n, diffusion_time=np.linspace(1, 2, n),
+                     state_info=state_info, record_transitions=False)
+    original_dt = f._orientations.diffusion_time.copy()
+    delete_time, peak = 0, 0
+    for i in range(cycles):
+        f.phototransition('ground', 'excited', intensity=0.1)
+        f.time_evolve(5)
+        if i == 0: # Don't time Numba's compilation
+            f.delete_fluorophores_in_state('bleached')
+            continue
+        tracemalloc.start()
+        start = time.perf_counter()
+        f.delete_fluorophores_in_state('bleached')
+        delete_time += time.perf_counter() - start
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    o = f._orientations
+    # Nobody's data got mixed up with anybody else's:
+    assert np.all(f.states != state_info['bleached'].n)
+    assert np.all(o.diffusion_time == original_dt[f.id])
+    assert len(np.unique(f.id)) == o.n == len(o.x) == len(f.transition_times)
+    assert np.allclose(o.x**2 + o.y**2 + o.z**2, 1)
+    print('%0.1f nanoseconds per fluorophore'%(1e9*delete_time/(n*cycles)),
+          'per delete_fluorophores_in_state(),',
+          '%i survivors, peak allocation %0.2f bytes/molecule'%(o.n, peak/n))
+    # Once everybody's gone, the clock still runs, for both engines:
+    for engine in ('sorted', 'event'):
+        f = Fluorophores(10, diffusion_time=1, engine=engine)
+        f.delete_fluorophores_in_state('ground')
+        f.time_evolve(3)
+        f.time_evolve(4)
+        assert f.t == 7 and len(f.id) == 0
+    # After heavy bleaching, the survivors move into smaller buffers:
+    f = Fluorophores(int(1e4), diffusion_time=np.linspace(1, 2, int(1e4)),
+                     state_info=state_info)
+    f.phototransition('ground', 'bleached', intensity=100)
+    ids = f.id[f.states != state_info['bleached'].n]
+    f.delete_fluorophores_in_state('bleached')
+    assert 0 < len(f) < 1e4/4 and f._capacity() == len(f)
+    assert np.array_equal(f.id, ids)
+    assert np.allclose(f._orientations.diffusion_time, 1 + f.id/(1e4 - 1))
+    return None
+
+def detect_photons(
+    x, y, z,
+    t=None,
+    time_edges=None,
+    axes=((1, 0, 0), (0, 1, 0)),
+    numerical_aperture=None,
+    refractive_index=1.33,
+    optical_axis=(0, 0, 1),
+    method='exact',
+    bins=128,
+    chunk_size=2**20,
+    rng=None,
+    ):
+    """Simulate polarized detection of photons emitted by dipoles with
+    orientations 'x', 'y', 'z' (e.g. from get_xyzt_at_transitions()).
+
+    Each photon lands in at most one channel; channel 'k' has a
+    polarizer along 'axes[k]'. If 'numerical_aperture' is None, a
+    photon lands in channel 'k' with probability (axes[k] . dipole)**2,
+    like the paraxial model we've always used. Otherwise, we integrate
+    the dipole's emission over the collection cone of an objective
+    looking along 'optical_axis' (the polarizer axes must be
+    perpendicular to it), so the probabilities are the fraction of all
+    emitted photons that reach each channel (doi.org/10.1016/S0006-
+    3495(79)85271-6).
+
+    Returns an integer array of counts, shape (number of channels,). If
+    'time_edges' is given, photons emitted at times 't' are also binned
+    into time windows, and the shape is (number of windows, number of
+    channels).
+
+    With the default method='exact', every photon gets its own random
+    draw. If we only need counts, method='binned' sorts photons into a
+    grid of 'bins' cells per channel, by their channel probabilities,
+    and draws each cell's channel totals all at once, from a multinomial
+    with the cell's mean probabilities. For two channels with Numba,
+    the sorting is one compiled pass with no per-photon random numbers,
+    several times faster than 'exact' for lots of photons (less so
+    with hundreds of time windows, where the grid outgrows the cache);
+    otherwise it's no faster, so don't bother. The grid has
+    bins**(number of channels) cells per time window, so keep it
+    modest if there are many of either.
+
+    'binned' is an approximation: expected counts are exact, but the
+    photons in a cell don't quite share one set of probabilities, and
+    pretending they do adds a variance of at most 1/(4*bins**2) per
+    photon to each count. That's about 1e-5 per photon for bins=128,
+    negligible next to the binomial variance, p*(1-p) per photon.
+
+    Random draws come from 'rng', a numpy.random.Generator (default:
+    numpy's global random state).
+    """
+    rng = np.random if rng is None else rng
+    assert method in ('exact', 'binned')
+    x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+    assert x.shape == y.shape == z.shape and x.ndim == 1
+    # Orientations from precision='compact' are float32, and their
+    # lengths can be off by ~1e-7:
+    eps = max(np.finfo(np.result_type(a, 0.)).eps for a in (x, y, z))
+    max_p = 1 + max(1e-9, 100*eps)
+    axes = np.asarray(axes, dtype='float').reshape(-1, 3)
+    axes = axes / np.linalg.norm(axes, axis=1, keepdims=True)
+    # The probability of each channel is a quadratic form in the
+    # dipole orientation, q_k = d^T Q_k d:
+    if numerical_aperture is None:
+        Q = np.einsum('ki,kj->kij', axes, axes)
+    else:
+        assert 0 < numerical_aperture <= refractive_index
+        o = np.asarray(optical_axis, dtype='float')
+        o = o / np.linalg.norm(o)
+        assert np.allclose(axes @ o, 0), "Polarizers must be perpendicular"
+        c = np.cos(np.arcsin(numerical_aperture / refractive_index))
+        k_parallel = 3/32 * (5 - 3*c - c**2 - c**3)
+        k_perpendicular = 1/32 * (1 - c)**3
+        k_axial = 1/8 * (2 - 3*c + c**3)
+        perpendicular = np.cross(o, axes)
+        Q = (k_parallel      * np.einsum('ki,kj->kij', axes, axes) +
+             k_perpendicular * np.einsum('ki,kj->kij',
+                                         perpendicular, perpendicular) +
+             k_axial         * np.outer(o, o))
+    # Like a train of pulses in Fluorophores._phototransition(), each
+    # quadratic form is a sum of squared dot products, one per
+    # eigenvector of Q_k, scaled by sqrt(eigenvalue):
+    fields = []
+    for Q_k in Q:
+        w, v = np.linalg.eigh(Q_k)
+        keep = w > 1e-12 * w.max()
+        fields.append((np.sqrt(w[keep]) * v[:, keep]).T)
+    num_channels = len(axes)
+    if time_edges is None:
+        num_windows = 1
+    else:
+        time_edges = np.asarray(time_edges, dtype='float')
+        assert time_edges.ndim == 1 and len(time_edges) > 1
+        assert np.all(time_edges[1:] > time_edges[:-1])
+        num_windows = len(time_edges) - 1
+        t = np.asarray(t)
+        assert t.shape == x.shape
+    # We work in chunks, so memory use stays bounded no matter how many
+    # photons there are.
+    if method == 'exact':
+        counts = np.zeros((num_windows + 1) * (num_channels + 1), dtype='int')
+    else:
+        num_cells = bins**num_channels
+        totals = np.zeros((num_windows + 1) * num_cells, dtype='int')
+        p_sums = np.zeros((num_channels, len(totals)))
+    compiled = method == 'binned' and njit is not None and num_channels == 2
+    if compiled:
+        # Each cell's total and probability sums share one row, so a
+        # photon touches one cache line instead of three:
+        sums = np.zeros((len(totals), 1 + num_channels))
+    for start in range(0, len(x), chunk_size):
+        s = slice(start, start + chunk_size)
+        xs, ys, zs = x[s], y[s], z[s]
+        if time_edges is None:
+            window = 0
+        else:
+            window = _window_index(t[s], time_edges)
+        # For 'exact', each photon gets one uniform random number, which
+        # picks a channel (or "lost", channel number 'num_channels')
+        # from the cumulative probabilities. For 'binned', no random
+        # numbers yet; we just sort photons into grid cells by their
+        # channel probabilities.
+        if compiled:
+            # One compiled pass, with no per-photon temporaries:
+            largest_p = _bin_photons(xs, ys, zs, np.atleast_1d(window), Q,
+                                     bins, sums)
+            assert largest_p <= max_p, "Too many photons"
+            continue
+        if method == 'exact':
+            r = rng.uniform(0, 1, len(xs))
+            channel = np.zeros(len(xs), dtype='intp')
+        else:
+            cell, p = np.zeros(len(xs), dtype='intp'), []
+        cumulative_p = np.zeros(len(xs))
+        for f in fields:
+            p_k = np.zeros(len(xs))
+            for px, py, pz in f:
+                p_k += (px*xs + py*ys + pz*zs)**2
+            cumulative_p += p_k
+            if method == 'exact':
+                channel += (r >= cumulative_p)
+            else:
+                cell = cell*bins + np.minimum(p_k*bins, bins - 1).astype('intp')
+                p.append(p_k)
+        assert np.all(cumulative_p <= max_p), "Too many photons"
+        # One bincount tallies every window and channel (or cell) at once
+        if method == 'exact':
+            which = window * (num_channels + 1) + channel
+            counts += np.bincount(which, minlength=len(counts))
+        else:
+            which = window * num_cells + cell
+            totals += np.bincount(which, minlength=len(totals))
+            for p_sum, p_k in zip(p_sums, p):
+                p_sum += np.bincount(which, weights=p_k, minlength=len(totals))
+    if compiled:
+        totals, p_sums = sums[:, 0].astype('int'), sums[:, 1:].T
+    if method == 'binned':
+        # The photons in a cell have (almost) the same channel
+        # probabilities, so their channel totals are (almost) a
+        # multinomial draw, using the cell's mean probabilities. We draw
+        # it as a chain of binomials, one per channel.
+        occupied = np.flatnonzero(totals)
+        remaining = totals[occupied]
+        mean_p = p_sums[:, occupied] / remaining
+        remaining_p = np.ones(len(occupied))
+        counts = np.zeros((num_windows + 1, num_channels + 1), dtype='int')
+        for k, p_k in enumerate(mean_p):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                conditional_p = np.clip(p_k / remaining_p, 0, 1)
+            conditional_p[remaining_p <= 0] = 0
+            counts_k = rng.binomial(remaining, conditional_p)
+            remaining -= counts_k
+            remaining_p -= p_k
+            counts[:, k] = np.bincount(occupied // num_cells, weights=counts_k,
+                                       minlength=num_windows + 1)
+    # Drop the "lost" channel and the "outside every window" window:
+    counts = counts.reshape(num_windows + 1, num_channels + 1)[:-1, :-1]
+    return counts[0] if time_edges is None else counts
+
+def _window_index(t, time_edges):
+    # Which window each time falls in, like searchsorted(time_edges, t,
+    # 'right') - 1, but with num_windows for "outside every window".
+    # Binary search on unsorted times is slow (~50 ns each), so for
+    # evenly spaced edges (e.g. np.linspace()) we divide instead, and
+    # fix up the few times that rounding puts next door.
+    num_windows = len(time_edges) - 1
+    span = time_edges[-1] - time_edges[0]
+    step = np.diff(time_edges)
+    if not (np.isfinite(span) and np.allclose(step, span/num_windows,
+                                              rtol=1e-9, atol=0)):
+        window = np.searchsorted(time_edges, t, 'right') - 1
+        window[(window < 0) | (window >= num_windows)] = num_windows
+        return window
+    if njit is not None:
+        window = np.empty(len(t), dtype='intp')
+        _even_window_index(t, time_edges, window)
+        return window
+    window = np.floor((t - time_edges[0]) * (num_windows / span))
+    window = np.fmin(np.fmax(window, 0), num_windows - 1).astype('intp')
+    window -= (t < time_edges[window])
+    window += (t >= time_edges[window + 1])
+    window[~((time_edges[0] <= t) & (t < time_edges[-1]))] = num_windows
+    return window
+
+def _even_window_index(t, time_edges, window):
+    # _window_index() for evenly spaced edges, for Numba.
+    num_windows = len(time_edges) - 1
+    start, stop = time_edges[0], time_edges[-1]
+    scale = num_windows / (stop - start)
+    for i in range(len(t)):
+        ti = t[i]
+        if not (start <= ti < stop): # Including NaN
+            window[i] = num_windows
+            continue
+        w = min(max(int((ti - start) * scale), 0), num_windows - 1)
+        if ti < time_edges[w]:
+            w -= 1
+        elif ti >= time_edges[w + 1]:
+            w += 1
+        window[i] = w
+    return None
+
+if njit is not None:
+    _even_window_index = njit(nogil=True)(_even_window_index)
+
+def _bin_photons(x, y, z, window, Q, bins, sums):
+    # The 'binned' part of detect_photons() for two channels, for Numba:
+    # add each photon to its grid cell's row of 'sums': the photon
+    # count, then the sums of each channel's probability. Returns the largest total probability
+    # we saw. The channels' quadratic forms live in local variables,
+    # which is several times faster than looping over channels.
+    a0, a1, a2 = Q[0, 0, 0], Q[0, 1, 1], Q[0, 2, 2]
+    a3, a4, a5 = 2*Q[0, 0, 1], 2*Q[0, 0, 2], 2*Q[0, 1, 2]
+    b0, b1, b2 = Q[1, 0, 0], Q[1, 1, 1], Q[1, 2, 2]
+    b3, b4, b5 = 2*Q[1, 0, 1], 2*Q[1, 0, 2], 2*Q[1, 1, 2]
+    num_cells = bins*bins
+    one_window = len(window) == 1
+    max_p = 0.0
+    for i in range(len(x)):
+        xi, yi, zi = x[i], y[i], z[i]
+        xx, yy, zz, xy, xz, yz = xi*xi, yi*yi, zi*zi, xi*yi, xi*zi, yi*zi
+        p0 = a0*xx + a1*yy + a2*zz + a3*xy + a4*xz + a5*yz
+        p1 = b0*xx + b1*yy + b2*zz + b3*xy + b4*xz + b5*yz
+        if p0 + p1 > max_p:
+            max_p = p0 + p1
+        which = (window[0 if one_window else i]*num_cells +
+                 min(int(p0*bins), bins - 1)*bins + min(int(p1*bins), bins - 1))
+        sums[which, 0] += 1
+        sums[which, 1] += p0
+        sums[which, 2] += p1
+    return max_p
+
+if njit is not None:
+    _bin_photons = njit(nogil=True)(_bin_photons)
+
+def _test_detect_photons(n=int(1e7)):
+    import time
+    x, y, z = uniform_orientations(n)
+    t = exponential(1, n)
+    # The per-photon boolean masks we used to use:
+    start = time.perf_counter()
+    p_x, p_y = x**2, y**2 # Probabilities of landing in channel x or y
+    r = uniform(0, 1, size=len(x))
+    in_channel_x = (r < p_x)
+    in_channel_y = (p_x <= r) & (r < p_x + p_y)
+    counts_x, counts_y = sum(in_channel_x), sum(in_channel_y)
+    end = time.perf_counter()
+    print('\n%0.1f nanoseconds per photon with boolean masks'%(
+        1e9*(end - start)/n))
+    start = time.perf_counter()
+    counts = detect_photons(x, y, z)
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per photon with detect_photons()'%(
+        1e9*(end - start)/n))
+    detect_photons(x[:10], y[:10], z[:10], method='binned') # Warm up Numba
+    start = time.perf_counter()
+    binned_counts = detect_photons(x, y, z, method='binned')
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per photon with'%(1e9*(end - start)/n),
+          "detect_photons(method='binned')" +
+          (" (Numba import failed; no faster)" if njit is None else ""))
+    # Isotropic emitters: each channel should catch 1/3 of the photons
+    for c in (counts_x, counts_y, *counts, *binned_counts):
+        assert abs(c - n/3) < 6 * np.sqrt(n * (1/3) * (2/3))
+    edges = np.linspace(0, 3, 7)
+    expected = n/3 * (np.exp(-edges[:-1]) - np.exp(-edges[1:]))
+    for method in ('exact', 'binned'):
+        counts = detect_photons(x, y, z, t, edges, method=method)
+        assert counts.shape == (6, 2)
+        assert np.all(abs(counts - expected[:, None]) <
+                      6 * np.sqrt(expected[:, None]))
+    # Windows are looked up by division when the edges are evenly
+    # spaced, which must agree with a binary search, right up to and
+    # including the edges themselves:
+    for e in (np.linspace(0, 3, 200), np.arange(0.1, 3, 0.1), edges**2,
+              np.array([0, 0.5, np.inf])):
+        times = np.concatenate([t[:10000], e, np.nextafter(e, -np.inf),
+                                np.nextafter(e, np.inf), [np.nan]])
+        expected = np.searchsorted(e, times, 'right') - 1
+        expected[(expected < 0) | (expected >= len(e) - 1)] = len(e) - 1
+        assert np.array_equal(_window_index(times, e), expected)
+    # Lots of windows, like an anisotropy decay histogram:
+    edges = np.linspace(0, 3, 200)
+    detect_photons(x[:10], y[:10], z[:10], t[:10], edges,
+                   method='binned', bins=32) # Warm up Numba
+    for method in ('exact', 'binned'):
+        start = time.perf_counter()
+        detect_photons(x, y, z, t, edges, method=method, bins=32)
+        end = time.perf_counter()
+        print('%0.1f nanoseconds per photon with'%(1e9*(end - start)/n),
+              "detect_photons(method='%s') in %i time windows"%(
+                  method, len(edges) - 1))
+    # Binning shouldn't change the noise either. Photons from a
+    # photoselected (anisotropic) population, many times over:
+    # (With 1000 repeats, each standard deviation is good to ~2%, so
+    # rtol=0.15 is ~5 sigma.)
+    f = Fluorophores(int(1e4), diffusion_time=1)
+    f.phototransition('ground', 'excited', intensity=0.5)
+    x, y, z = f.get_xyz_for_state('excited')
+    exact = [detect_photons(x, y, z) for i in range(1000)]
+    binned = [detect_photons(x, y, z, method='binned') for i in range(1000)]
+    for a, b in ((exact, binned), (np.std(exact, 0), np.std(binned, 0))):
+        assert np.allclose(np.mean(a, 0), np.mean(b, 0), rtol=0.15)
+    # ...including through an objective, in time windows:
+    edges = (0, 0.5, np.inf)
+    t = exponential(1, len(x))
+    exact = [detect_photons(x, y, z, t, edges, numerical_aperture=1.2)
+             for i in range(100)]
+    binned = [detect_photons(x, y, z, t, edges, numerical_aperture=1.2,
+                             method='binned') for i in range(100)]
+    assert np.allclose(np.mean(exact, 0), np.mean(binned, 0), rtol=0.05)
+    if njit is not None: # The compiled pass tallies like numpy would
+        bins, axes = 16, np.eye(3)[:2]
+        sums = np.zeros((2*bins**2, 3))
+        window = (t > 0.5).astype('intp')
+        _bin_photons(x, y, z, window, np.einsum('ki,kj->kij', axes, axes),
+                     bins, sums)
+        cell = (window*bins**2 + np.minimum(x**2*bins, bins - 1).astype(int)*bins
+                + np.minimum(y**2*bins, bins - 1).astype(int))
+        assert np.array_equal(sums[:, 0], np.bincount(cell, minlength=len(sums)))
+        assert np.allclose(sums[:, 1], np.bincount(cell, x**2, len(sums)))
+        assert np.allclose(sums[:, 2], np.bincount(cell, y**2, len(sums)))
+    # Compact-precision (float32) orientations aren't quite unit length:
+    x32, y32, z32 = (a.astype('float32') for a in (x, y, z))
+    for method in ('exact', 'binned'):
+        detect_photons(x32, y32, z32, t, edges, method=method)
+    # Collection through an objective: compare to a numerical
+    # integral of a dipole's emission over the collection cone.
+    for na in (0.5, 1.2):
+        theta = np.linspace(0, np.arcsin(na / 1.33), 1001)
+        phi = np.linspace(0, 2*np.pi, 2001)
+        T, P = np.meshgrid(theta, phi, indexing='ij')
+        e_theta = (np.cos(T)*np.cos(P), np.cos(T)*np.sin(P), -np.sin(T))
+        e_phi = (-np.sin(P), np.cos(P), 0)
+        for dipole in np.eye(3):
+            d_theta = sum(d*e for d, e in zip(dipole, e_theta))
+            d_phi = sum(d*e for d, e in zip(dipole, e_phi))
+            field_x = d_theta*np.cos(P) - d_phi*np.sin(P) # After the lens
+            integrand = 3/(8*np.pi) * field_x**2 * np.sin(T)
+            expected = np.trapezoid(np.trapezoid(integrand, phi), theta)
+            m = 10**6
+            counts = detect_photons(*(np.full(m, d) for d in dipole),
+                                    axes=(1, 0, 0), numerical_aperture=na)
+            assert abs(counts[0] - m*expected) < 6*np.sqrt(m*expected) + 1
+    print("detect_photons() matches the expected counts")
+    return None
+
+def replicate_index(ids, replicates):
+    """Which of 'replicates' independent replicates each molecule
+    belongs to, given its 'id'.
+
+    Molecules start out independent of each other, so splitting them by
+    id % replicates gives the same statistics as 'replicates' separate
+    runs of 1/replicates as many molecules. The split doesn't depend on
+    the run, so you can choose 'replicates' after the fact.
+    """
+    assert int(replicates) >= 1
+    return np.asarray(ids).astype('int') % int(replicates)
+
+def bootstrap(
+    replicate_counts,
+    statistic=None,
+    n_resamples=1000,
+    confidence=0.95,
+    rng=None,
+    ):
+    """Bootstrap confidence interval from a table of per-replicate
+    counts, shape (replicates, ...), e.g. from a Detector() with
+    'replicates' set.
+
+    Each resample draws replicates with replacement and sums them, like
+    the total of one run; 'statistic' maps a total to whatever we want
+    an interval for (default: the total itself). Returns the 'low' and
+    'high' ends of the interval.
+    """
+    rng = np.random if rng is None else rng
+    counts = np.asarray(replicate_counts)
+    k = counts.shape[0]
+    if statistic is None:
+        statistic = lambda total: total
+    # How many times each resample picks each replicate, shape
+    # (n_resamples, k). A matrix product then sums every resample at
+    # once, without making copies of the table:
+    picks = rng.choice(k, size=(n_resamples, k))
+    multiplicity = np.zeros((n_resamples, k), dtype='int')
+    np.add.at(multiplicity, (np.arange(n_resamples)[:, None], picks), 1)
+    totals = (multiplicity @ counts.reshape(k, -1)).reshape(
+        (n_resamples,) + counts.shape[1:])
+    values = np.array([statistic(total) for total in totals])
+    alpha = 100 * (1 - confidence) / 2
+    low, high = np.percentile(values, (alpha, 100 - alpha), axis=0)
+    return low, high
+
+class Detector(abc.ABC):
+    """Tallies 'initial_state'->'final_state' transitions (e.g. photon
+    emissions) as they happen, between 'start_time' and 'stop_time'.
+    If 'species' isn't None, only molecules of that species count.
+
+    If 'replicates' is an integer k, every tally gets a leading axis of
+    length k: molecules are split into k independent replicates by
+    replicate_index(), so one big run gives replicate-to-replicate
+    error bars (e.g. via bootstrap()).
+
+    Register a detector with Fluorophores.add_detector(). Detector()
+    itself is abstract: subclasses decide what to tally by overriding
+    _accumulate(), reset() and _merge().
+    """
+    def __init__(self, initial_state, final_state,
+                 start_time=0, stop_time=np.inf, species=None,
+                 replicates=None):
+        assert start_time < stop_time
+        assert replicates is None or int(replicates) >= 1
+        self.initial_state = initial_state
+        self.final_state = final_state
+        self.species = species
+        self.replicates = None if replicates is None else int(replicates)
+        self.start_time = start_time
+        self.stop_time = stop_time
+        self.rng = None # Set by _bind(); None means the global state
+        self.reset()
+        return None
+
+    def _bind(self, state_info, rng=None):
+        # State names are only meaningful relative to a state_info:
+        assert self.initial_state in state_info
+        assert self.final_state in state_info
+        self._transition = (state_info[self.initial_state].n,
+                            state_info[self.final_state].n)
+        # Draw from the same stream as the molecules we watch:
+        self.rng = rng
+        return None
+
+    def record(self, x, y, z, t, initial_states, final_states,
+               species=None, ids=None):
+        initial_state, final_state = self._transition
+        selected = ((initial_states == initial_state) &
+                    (final_states   == final_state) &
+                    (self.start_time <= t) & (t < self.stop_time))
+        if self.species is not None:
+            selected &= (species == self.species)
+        if np.any(selected):
+            replicate = None
+            if self.replicates is not None:
+                replicate = replicate_index(ids[selected], self.replicates)
+            self._accumulate(x[selected], y[selected], z[selected],
+                             t[selected], replicate)
+        return None
+
+    @abc.abstractmethod
+    def _accumulate(self, x, y, z, t, replicate=None):
+        # Tally the selected transitions. 'replicate' is None unless
+        # self.replicates is set.
+        pass
+
+    @abc.abstractmethod
+    def reset(self):
+        # Zero the tallies.
+        pass
+
+    @abc.abstractmethod
+    def _merge(self, other):
+        # Add the tallies of 'other', a copy of us (e.g. from a shard).
+        pass
+
+class PolarizedDetector(Detector):
+    """Counts photons in an 'x' and a 'y' polarization channel. Each
+    photon lands in channel x with probability x**2, in channel y with
+    probability y**2, or is lost. 'method' is passed to detect_photons().
+    """
+    def __init__(self, initial_state, final_state,
+                 start_time=0, stop_time=np.inf, method='exact', species=None,
+                 replicates=None):
+        assert method in ('exact', 'binned')
+        self.method = method
+        Detector.__init__(self, initial_state, final_state,
+                          start_time, stop_time, species, replicates)
+        return None
+
+    def _accumulate(self, x, y, z, t, replicate=None):
+        if replicate is None:
+            counts_x, counts_y = detect_photons(x, y, z, method=self.method,
+                                                rng=self.rng)
+            self.counts_x += int(counts_x)
+            self.counts_y += int(counts_y)
+        else: # Replicates are just another set of "time windows"
+            counts = detect_photons(
+                x, y, z, t=replicate, time_edges=np.arange(self.replicates + 1),
+                method=self.method, rng=self.rng)
+            self.counts_x += counts[:, 0]
+            self.counts_y += counts[:, 1]
+        return None
+
+    def reset(self):
+        if self.replicates is None:
+            self.counts_x, self.counts_y = 0, 0
+        else:
+            self.counts_x = np.zeros(self.replicates, dtype='int')
+            self.counts_y = np.zeros(self.replicates, dtype='int')
+        return None
+
+    def _merge(self, other):
+        self.counts_x += other.counts_x
+        self.counts_y += other.counts_y
+        return None
+
+class TimeHistogramDetector(Detector):
+    """Histograms transition times into bins with edges 'bin_edges'."""
+    def __init__(self, initial_state, final_state, bin_edges, species=None,
+                 replicates=None):
+        self.bin_edges = np.asarray(bin_edges, dtype='float')
+        assert self.bin_edges.ndim == 1 and len(self.bin_edges) > 1
+        assert np.all(self.bin_edges[1:] > self.bin_edges[:-1])
+        Detector.__init__(self, initial_state, final_state,
+                          start_time=self.bin_edges[0],
+                          stop_time=self.bin_edges[-1], species=species,
+                          replicates=replicates)
+        return None
+
+    def _accumulate(self, x, y, z, t, replicate=None):
+        which_bin = np.searchsorted(self.bin_edges, t, 'right') - 1
+        if replicate is not None: # One flat histogram for all replicates
+            which_bin = which_bin + replicate * (len(self.bin_edges) - 1)
+        self.counts += np.bincount(
+            which_bin, minlength=self.counts.size).reshape(self.counts.shape)
+        return None
+
+    def reset(self):
+        shape = (len(self.bin_edges) - 1,)
+        if self.replicates is not None:
+            shape = (self.replicates,) + shape
+        self.counts = np.zeros(shape, dtype='int')
+        return None
+
+    def _merge(self, other):
+        self.counts += other.counts
+        return None
+
+def _test_detectors(n=int(1e6)):
+    import time
+    try:
+        Detector('excited', 'ground')
+    except TypeError: # Abstract; only subclasses can be made
+        pass
+    else:
+        raise AssertionError("Detector() shouldn't be instantiable")
+    edges = np.linspace(0, 10, 11)
+    # The same experiment, with and without recording transitions:
+    counts = []
+    for record_transitions in (True, False):
+        f = Fluorophores(n, diffusion_time=3,
+                         record_transitions=record_transitions)
+        d = PolarizedDetector('excited', 'ground', start_time=1)
+        h = TimeHistogramDetector('excited', 'ground', edges)
+        f.add_detector(d)
+        f.add_detector(h)
+        start = time.perf_counter()
+        for i in range(10):
+            f.phototransition('ground', 'excited', intensity=0.05,
+                              polarization_xyz=(1, 0, 0))
+            f.time_evolve(1)
+        end = time.perf_counter()
+        print('%0.1f nanoseconds per fluorophore with'%(1e9*(end-start)/n),
+              'record_transitions=%s'%(record_transitions),
+              '(%i x counts, %i y counts)'%(d.counts_x, d.counts_y))
+        counts.append(h.counts)
+        if record_transitions: # Compare to the usual post-processing
+            x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+            assert np.array_equal(h.counts, np.histogram(t, edges)[0])
+            assert len(t[t >= 1]) >= d.counts_x + d.counts_y
+        else:
+            assert len(f.transition_events['t']) == 0
+    print('Time histograms:', *counts, sep='\n')
+    return None
+
+def _test_replicates(k=12, n=int(1e5)):
+    import time
+    # One run of k*n molecules, split into k replicates, vs. k
+    # separate runs of n molecules:
+    edges = np.linspace(0, 10, 6)
+    def experiment(f):
+        f.phototransition('ground', 'excited', intensity=0.5,
+                          polarization_xyz=(1, 0, 0))
+        f.time_evolve(10)
+    experiment(Fluorophores(1000, diffusion_time=3)) # Warm up Numba
+    start = time.perf_counter()
+    separate = []
+    for i in range(k):
+        f = Fluorophores(n, diffusion_time=3, record_transitions=False,
+                         seed=i)
+        d = PolarizedDetector('excited', 'ground')
+        f.add_detector(d)
+        experiment(f)
+        separate.append((d.counts_x, d.counts_y))
+    separate = np.array(separate)
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore for %i separate runs'%(
+        1e9*(end - start) / (k*n), k))
+    start = time.perf_counter()
+    f = Fluorophores(k*n, diffusion_time=3, seed=k)
+    d = PolarizedDetector('excited', 'ground', replicates=k)
+    h = TimeHistogramDetector('excited', 'ground', edges, replicates=k)
+    for detector in (d, h):
+        f.add_detector(detector)
+    experiment(f)
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per fluorophore for one run, split %i ways'%(
+        1e9*(end - start) / (k*n), k))
+    together = np.stack((d.counts_x, d.counts_y), axis=1)
+    assert together.shape == separate.shape
+    # Same means, same replicate-to-replicate scatter:
+    mean, std = separate.mean(0), separate.std(0, ddof=1)
+    assert np.all(abs(together.mean(0) - mean) < 5*std/np.sqrt(k))
+    ratio = together.std(0, ddof=1) / std
+    assert np.all((0.3 < ratio) & (ratio < 3))
+    print('Replicate x counts: %0.1f +/- %0.1f separate,'%(mean[0], std[0]),
+          '%0.1f +/- %0.1f split'%(together[:, 0].mean(),
+                                   together[:, 0].std(ddof=1)))
+    # The event log agrees with the detectors, for any replicate count
+    # we choose after the run:
+    x, y, z, t, replicate = f.get_xyzt_at_transitions(
+        'excited', 'ground', replicates=k)
+    hist = np.array([np.histogram(t[replicate == r], edges)[0]
+                     for r in range(k)])
+    assert np.array_equal(hist, h.counts)
+    x, y, z, t, replicate = f.get_xyzt_at_transitions(
+        'excited', 'ground', replicates=3)
+    assert np.bincount(replicate).sum() == h.counts.sum()
+    # Bootstrap an interval for the polarization ratio:
+    low, high = bootstrap(together, lambda total: total[0] / total[1],
+                          rng=np.random.default_rng(0))
+    ratio = together[:, 0].sum() / together[:, 1].sum()
+    assert low < ratio < high
+    print('x/y ratio %0.4f, 95%% bootstrap interval (%0.4f, %0.4f)'%(
+        ratio, low, high))
+    return None
+
+class ParallelFluorophores:
+    """Like Fluorophores(), but the molecules are split into shards, each
+    simulated by its own Fluorophores() object in its own process.
+
+    Molecules don't interact, so every method call is simply broadcast
+    to every shard, and results are joined back together. Each shard
+    gets an independent random number stream, spawned from 'seed', so
+    runs with the same 'seed' and 'n_workers' are reproducible. With
+    seed=None, 'seed' is drawn from numpy's global random state, so
+    np.random.seed() still makes runs reproducible.
+
+    Example usage:
+
+    with ParallelFluorophores(1e7, diffusion_time=20, n_workers=4) as f:
+        f.phototransition('ground', 'excited', intensity=0.1)
+        f.time_evolve(5)
+        x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+
+    On platforms that 'spawn' new processes (Windows, macOS), create
+    ParallelFluorophores inside an 'if __name__ == "__main__":' block.
+    """
+    def __init__(
+        self,
+        number_of_molecules,
+        diffusion_time,
+        initial_orientations='uniform',
+        state_info=None,
+        initial_state=0,
+        engine='sorted',
+        record_transitions=True,
+        precision='double',
+        n_workers=None,
+        seed=None,
+        species=None,
+        ):
+        n = int(number_of_molecules)
+        if n_workers is None:
+            n_workers = os.cpu_count()
+        n_workers = max(1, min(int(n_workers), n))
+        first_ids = np.linspace(0, n, n_workers + 1).astype('int')
+        diffusion_time = np.asarray(diffusion_time)
+        assert diffusion_time.shape in ((), (1,), (n,))
+        if species is not None:
+            species = np.asarray(species)
+            assert species.shape == (n,)
+        if seed is None: # Like _generator(), follow np.random.seed()
+            seed = np.random.randint(2**32, size=4)
+        seeds = np.random.SeedSequence(seed).spawn(n_workers)
+        self._connections, self._processes = [], []
+        for i in range(n_workers):
+            start, stop = first_ids[i], first_ids[i+1]
+            kwargs = dict(
+                number_of_molecules=stop - start,
+                diffusion_time=(diffusion_time[start:stop]
+                                if diffusion_time.shape == (n,)
+                                else diffusion_time),
+                initial_orientations=initial_orientations,
+                state_info=state_info,
+                initial_state=initial_state,
+                engine=engine,
+                record_transitions=record_transitions,
+                precision=precision,
+                species=None if species is None else species[start:stop])
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=_fluorophores_shard,
+                args=(worker_connection, kwargs, seeds[i], start),
+                daemon=True)
+            process.start()
+            self._connections.append(connection)
+            self._processes.append(process)
+        # Every shard reports whether it started; if any didn't, shut
+        # down the rest and raise its exception here:
+        for status, result in [c.recv() for c in self._connections]:
+            if status == 'error':
+                for process in self._processes:
+                    process.terminate()
+                self._connections, self._processes = [], []
+                raise result
+        return None
+
+    def phototransition(self, *args, **kwargs):
+        self._broadcast('phototransition', *args, **kwargs)
+        return None
+
+    def time_evolve(self, delta_t):
+        self._broadcast('time_evolve', delta_t)
+        return None
+
+    def delete_fluorophores_in_state(self, state):
+        self._broadcast('delete_fluorophores_in_state', state)
+        return None
+
+    def add_detector(self, detector):
+        # Each shard gets its own copy of 'detector'; read the combined
+        # tallies from 'detectors', not from 'detector' itself.
+        self._broadcast('add_detector', detector)
+        return None
+
+    @property
+    def detectors(self):
+        results = self._broadcast('detectors')
+        detectors = results[0] # Already our own copies
+        for shard_detectors in results[1:]:
+            for d, other in zip(detectors, shard_detectors):
+                d._merge(other)
+        return detectors
+
+    def get_xyz_for_state(self, state):
+        results = self._broadcast('get_xyz_for_state', state)
+        return tuple(np.concatenate(r) for r in zip(*results))
+
+    def get_xyzt_at_transitions(self, initial_state, final_state,
+                                since_last_read=False, species=None,
+                                replicates=None):
+        results = self._broadcast('get_xyzt_at_transitions', initial_state,
+                                  final_state, since_last_read, species,
+                                  replicates)
+        return tuple(np.concatenate(r) for r in zip(*results))
+
+    def execute(self, sequence, replicates=None):
+        results = self._broadcast('execute', sequence, replicates)
+        return {name: tuple(np.concatenate(r) for r in
+                            zip(*(readouts[name] for readouts in results)))
+                for name in results[0]}
+
+    def split_by_delay(self, delays, sequence, replicates=None):
+        # Each shard deals its own molecules out to the delays:
+        results = self._broadcast('split_by_delay', delays, sequence,
+                                  replicates)
+        return [{name: tuple(np.concatenate(r) for r in
+                             zip(*(shard[g][name] for shard in results)))
+                 for name in results[0][g]}
+                for g in range(len(results[0]))]
+
+    @property
+    def transition_events(self):
+        # Merged on demand, in the same format as Fluorophores():
+        results = self._broadcast('transition_events')
+        return {k: [a for r in results for a in r[k]] for k in results[0]}
+
+    @property
+    def id(self):
+        return np.concatenate(self._broadcast('id'))
+
+    @property
+    def t(self):
+        return self._broadcast('t')[0]
+
+    @property
+    def state_info(self):
+        return self._broadcast('state_info')[0]
+
+    def _broadcast(self, name, *args, **kwargs):
+        # Every shard works at the same time; then we collect results.
+        assert len(self._connections) > 0, "ParallelFluorophores is closed"
+        for connection in self._connections:
+            connection.send((name, args, kwargs))
+        results = [connection.recv() for connection in self._connections]
+        for status, result in results:
+            if status == 'error':
+                raise result
+        return [result for status, result in results]
+
+    def close(self):
+        for connection, process in zip(self._connections, self._processes):
+            connection.send((None, (), {}))
+            process.join()
+            connection.close()
+        self._connections, self._processes = [], []
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+def _fluorophores_shard(connection, kwargs, seed, first_id):
+    # Runs in a worker process. 'seed' is this shard's own spawned
+    # SeedSequence, so each shard gets an independent stream.
+    try:
+        f = Fluorophores(**kwargs, seed=seed)
+        f.id += f.id.dtype.type(first_id) # Unique across shards
+    except Exception as e: # Tell the parent why, instead of just dying
+        connection.send(('error', e))
+        connection.close()
+        return None
+    connection.send(('ok', None))
+    while True:
+        name, args, kwargs = connection.recv()
+        if name is None: break
+        try:
+            result = getattr(f, name)
+            if callable(result):
+                result = result(*args, **kwargs)
+            connection.send(('ok', result))
+        except Exception as e:
+            connection.send(('error', e))
+    connection.close()
+    return None
+
+def _test_parallel_fluorophores(n=int(1e6), n_workers=2):
+    import time
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited', lifetime=2, final_states='ground')
+    def experiment(f):
+        start = time.perf_counter()
+        f.phototransition('ground', 'excited', intensity=0.2,
+                          polarization_xyz=(1, 0, 0))
+        f.time_evolve(10)
+        x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+        end = time.perf_counter()
+        return end - start, len(t), np.mean(x**2)
+    print()
+    t, counts, x2 = experiment(Fluorophores(n, 5, state_info=state_info))
+    print('%0.1f nanoseconds per fluorophore with Fluorophores()'%(1e9*t / n),
+          '(%i emissions, <x^2>=%0.4f)'%(counts, x2))
+    results = []
+    for rep in range(2):
+        with ParallelFluorophores(n, 5, state_info=state_info,
+                                  n_workers=n_workers, seed=12345) as f:
+            t, counts, x2 = experiment(f)
+            results.append((counts, x2))
+    print('%0.1f nanoseconds per fluorophore with'%(1e9*t / n),
+          'ParallelFluorophores(n_workers=%i)'%(n_workers),
+          '(%i emissions, <x^2>=%0.4f)'%(counts, x2))
+    assert results[0] == results[1], "Same seed, but different results!"
+    print("Same seed, same results:", results[0] == results[1])
+    # With no seed, shards follow numpy's global random state:
+    counts = []
+    for rep in range(2):
+        np.random.seed(7) # Same global seed both times
+        with ParallelFluorophores(int(1e4), 5, state_info=state_info,
+                                  n_workers=n_workers) as f:
+            counts.append(experiment(f)[1:])
+    assert counts[0] == counts[1], "np.random.seed() was ignored!"
+    # Compact precision works across shards, with unique ids:
+    with ParallelFluorophores(n, 5, state_info=state_info, n_workers=n_workers,
+                              precision='compact', seed=12345) as f:
+        t, counts, x2 = experiment(f)
+        assert f.id.dtype == 'uint32'
+        assert np.array_equal(np.sort(f.id), np.arange(n))
+        assert abs(counts - results[0][0]) < 5*np.sqrt(counts)
+    # A shard that can't start raises its own exception here:
+    try:
+        ParallelFluorophores(n, 5, engine='neither', n_workers=n_workers)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError("A broken shard went unnoticed")
+    return None
+
+class PulseSequence:
+    """A description of an experiment: light pulses, dark delays, and
+    readout windows, in time order. Fluorophores.execute() runs it, and
+    so does EnsembleFluorophores.execute(), for the expected results.
+
+    The methods mirror Fluorophores(), so a sequence reads like the
+    loop you'd otherwise write by hand. For example, an SP8 pump-probe:
+
+    seq = PulseSequence()
+    for x in range(16): # 200 ns dwell at 80 MHz rep rate
+        seq.phototransition('ground', 'excited_singlet',
+                            intensity=2, polarization_xyz=(1, 0, 0))
+        seq.time_evolve(12.5)
+    seq.delete_fluorophores_in_state('ground') # performance
+    seq.time_evolve(240e3)
+    seq.readout('probe', 'excited_singlet', 'ground')
+    for x in range(16):
+        seq.phototransition('excited_triplet', 'excited_singlet',
+                            intensity=0.25, polarization_xyz=(0, 1, 0))
+        seq.time_evolve(12.5)
+    x, y, z, t = f.execute(seq)['probe']
+
+    Before it runs, the sequence is compiled for the population's
+    photophysics: back-to-back delays are merged into one time_evolve(),
+    delays where no populated state can spontaneously change just
+    advance the clock, pulses that can't find any molecules to drive
+    are dropped, and back-to-back pulses that drive the same transition
+    are combined into a single pass over the molecules.
+    """
+    def __init__(self):
+        self._ops = []
+        self.readouts = [] # (name, initial_state, final_state, start, stop)
+        self.duration = 0.0
+        return None
+
+    def phototransition(
+        self,
+        initial_state,
+        final_states,
+        state_probabilities=None,
+        intensity=1,
+        polarization_xyz=(0, 0, 1),
+        ):
+        # Same arguments as Fluorophores.phototransition(); we check
+        # them against a FluorophoreStateInfo() when we compile.
+        self._ops.append(('phototransition', (
+            initial_state, final_states, state_probabilities,
+            intensity, polarization_xyz)))
+        return None
+
+    def time_evolve(self, delta_t):
+        assert delta_t > 0
+        self._ops.append(('time_evolve', (delta_t,)))
+        self.duration += delta_t
+        return None
+
+    def delete_fluorophores_in_state(self, state):
+        self._ops.append(('delete', (state,)))
+        return None
+
+    def readout(self, name, initial_state, final_state, duration=np.inf):
+        """Record 'initial_state'->'final_state' transitions from now
+        (the current end of the sequence) until 'duration' later."""
+        assert name not in [r[0] for r in self.readouts]
+        assert duration > 0
+        self.readouts.append((name, initial_state, final_state,
+                              self.duration, self.duration + duration))
+        return None
+
+    def compile(self, state_info, populated=None):
+        """Returns a schedule for Fluorophores.execute(): a list of
+        ('pulse', *args), ('evolve', delta_t), ('advance', delta_t) and
+        ('delete', state) tuples. 'populated' lists the states that
+        molecules might start in (by default, any state).
+        """
+        assert isinstance(state_info, FluorophoreStateInfo)
+        if populated is None:
+            populated = range(len(state_info))
+        populated = set(int(n) for n in populated)
+        schedule, delay = [], 0
+        for op, args in self._ops:
+            if op == 'time_evolve':
+                delay += args[0]
+                populated = _spontaneously_reachable(state_info, populated)
+                continue
+            if op == 'phototransition':
+                args = _sanitize_phototransition(state_info, *args)
+                initial_state, final_states, _, probabilities, fields = args
+                if initial_state not in populated:
+                    continue # Nobody to drive. No op, so delays still merge
+            if delay > 0: # Flush the accumulated delay
+                lifetimes = state_info.lifetimes[list(populated)]
+                if np.all(np.isinf(lifetimes)):
+                    schedule.append(('advance', delay))
+                else:
+                    schedule.append(('evolve', delay))
+                delay = 0
+            if op == 'delete':
+                state = state_info[args[0]].n # Ensure int
+                schedule.append(('delete', state))
+                populated.discard(state)
+            elif op == 'phototransition':
+                populated.update(int(n) for n in final_states)
+                previous = schedule[-1] if len(schedule) > 0 else None
+                if (previous is not None and previous[0] == 'pulse' and
+                    _same_transition(previous[1:5], args[:4])):
+                    # A molecule that survives several pulses in a row
+                    # survives the sum of their effective intensities,
+                    # a quadratic form in its orientation. That form
+                    # has at most 3 eigenvectors, however many pulses.
+                    fields = np.concatenate((previous[5], fields))
+                    w, v = np.linalg.eigh(fields.T @ fields)
+                    keep = w > 1e-12 * w.max()
+                    fields = (np.sqrt(w[keep]) * v[:, keep]).T
+                    schedule[-1] = ('pulse', *args[:4], fields)
+                else:
+                    schedule.append(('pulse', *args))
+        if delay > 0: # Whatever's left at the end
+            lifetimes = state_info.lifetimes[list(populated)]
+            schedule.append(('advance' if np.all(np.isinf(lifetimes))
+                             else 'evolve', delay))
+        return schedule
+
+def _spontaneously_reachable(state_info, populated):
+    # Which states could molecules be in after a delay, if they start
+    # in 'populated'? Infinite-lifetime states stay put.
+    reachable, to_check = set(populated), list(populated)
+    while len(to_check) > 0:
+        state = to_check.pop()
+        if np.isinf(state_info.lifetimes[state]):
+            continue
+        row = slice(*state_info.branch_indptr[state:state+2])
+        for n in state_info.branch_final_states[row]:
+            if int(n) not in reachable:
+                reachable.add(int(n))
+                to_check.append(int(n))
+    return reachable
+
+def _same_transition(a, b):
+    # Can two back-to-back pulses be combined into one? Only if they
+    # drive the same transition. If a driven molecule can land back in
+    # the initial state, later pulses could drive it again, so no.
+    initial_a, final_a, _, probabilities_a = a
+    initial_b, final_b, _, probabilities_b = b
+    if initial_a != initial_b or initial_a in final_a:
+        return False
+    if not np.array_equal(final_a, final_b):
+        return False
+    if probabilities_a is None or probabilities_b is None:
+        return probabilities_a is probabilities_b
+    return np.allclose(probabilities_a, probabilities_b)
+
+def _test_pulse_sequence(n=int(1e6)):
+    import time
+    from math import sin, cos
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited_singlet', lifetime=2,
+                   final_states=['ground', 'excited_triplet'],
+                   probabilities=[0.99, 0.01])
+    state_info.add('excited_triplet', lifetime=1e6,
+                   final_states=['ground'])
+    circular = ((1, 0, 0), (0, 1, 0), (1, 1, 0), (1, -1, 0),
+                (sin(np.pi/8), cos(np.pi/8), 0),
+                (sin(3*np.pi/8), cos(3*np.pi/8), 0),
+                (sin(13*np.pi/8), cos(13*np.pi/8), 0),
+                (sin(15*np.pi/8), cos(15*np.pi/8), 0))
+    # The flow cytometry experiment, as a hand-coded loop...
+    def experiment(f):
+        for x in range(10):
+            f.phototransition('ground', 'excited_singlet', intensity=2,
+                              polarization_xyz=(0, 1, 0))
+            f.time_evolve(5)
+        f.time_evolve(400)
+        if isinstance(f, PulseSequence):
+            f.readout('probe', 'excited_singlet', 'ground')
+        for p in circular:
+            f.phototransition('excited_triplet', 'excited_singlet',
+                              intensity=1, polarization_xyz=p)
+        f.time_evolve(50)
+    # ...and as a pulse sequence:
+    seq = PulseSequence()
+    experiment(seq)
+    schedule = seq.compile(state_info, populated=[0])
+    assert sum(op == 'pulse' for op, *_ in schedule) == 10 + 1
+    assert schedule[-2][5].shape == (2, 3) # 8 probe pulses; 2 fields
+    print()
+    for method in ('loop', 'sequence'):
+        f = Fluorophores(n, diffusion_time=900, state_info=state_info)
+        start = time.perf_counter()
+        if method == 'loop':
+            experiment(f)
+            x, y, z, t = f.get_xyzt_at_transitions('excited_singlet',
+                                                   'ground')
+            probe = t >= f.t - 50
+            x, y = x[probe], y[probe]
+        else:
+            x, y, z, t = f.execute(seq)['probe']
+        end = time.perf_counter()
+        print('%0.1f nanoseconds per fluorophore,'%(1e9*(end-start)/n),
+              method, '(%i probe emissions, <x^2>=%0.3f, <y^2>=%0.3f)'%(
+                  len(x), np.mean(x**2), np.mean(y**2)))
+    # With nothing short-lived around, a delay is just a clock change:
+    state_info = FluorophoreStateInfo()
+    state_info.add('inactive')
+    state_info.add('active')
+    seq = PulseSequence()
+    seq.phototransition('inactive', 'active', intensity=1)
+    seq.time_evolve(1e6)
+    seq.time_evolve(1e6)
+    assert seq.compile(state_info)[1] == ('advance', 2e6)
+    return None
+
+def cache_key(*objects):
+    """A hex digest that identifies 'objects' by their content, plus the
+    source code of this module, so changing the simulator invalidates
+    old results.
+
+    'objects' can be numbers, strings, None, lists, tuples, dicts,
+    numpy arrays, FluorophoreStateInfo() and PulseSequence() objects,
+    SeedSequences, and functions (identified by their name and source
+    code; whatever they read from elsewhere isn't part of the key).
+    """
+    digest = hashlib.sha256(_module_hash().encode())
+    digest.update(json.dumps(_canonical(list(objects))).encode())
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=None) # Read our source code once
+def _module_hash():
+    with open(__file__, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def _canonical(x):
+    # A JSON-able stand-in for 'x' that only depends on its content.
+    if x is None or isinstance(x, (bool, int, float, str)):
+        return x
+    if isinstance(x, np.generic):
+        return _canonical(x.item())
+    if isinstance(x, (list, tuple, range)):
+        return [_canonical(v) for v in x]
+    if isinstance(x, dict):
+        items = [[_canonical(k), _canonical(v)] for k, v in x.items()]
+        return {'dict': sorted(items, key=json.dumps)}
+    if isinstance(x, np.ndarray):
+        x = np.ascontiguousarray(x)
+        return {'ndarray': [x.dtype.str, x.shape,
+                            hashlib.sha256(x.tobytes()).hexdigest()]}
+    if isinstance(x, FluorophoreStateInfo):
+        return {'state_info': _canonical(
+            ([s.name for s in x.list], x.lifetimes, x.branch_indptr,
+             x.branch_final_states, x.branch_probabilities))}
+    if isinstance(x, PulseSequence):
+        return {'pulse_sequence': _canonical((x._ops, x.readouts))}
+    if isinstance(x, np.random.SeedSequence):
+        return {'seed_sequence': _canonical((x.entropy, x.spawn_key))}
+    if callable(x):
+        try:
+            source = inspect.getsource(x)
+        except (OSError, TypeError): # E.g. defined interactively
+            source = None
+        return {'function': [getattr(x, '__module__', None),
+                             getattr(x, '__qualname__', repr(x)), source]}
+    raise TypeError("Can't make a cache key from a %s"%type(x).__name__)
+
+class ResultCache:
+    """Simulation results on disk, one .npz file per cache_key() in
+    'directory', so finished work survives between runs and between
+    scripts.
+
+    A result is a dict of {name: value}, or a list of such dicts (e.g.
+    result rows, like run_sweep() uses). Each value is a scalar (a
+    number, string, bool or None), stored as JSON, or a numeric/string
+    array, stored as-is. Anything else (e.g. an object array) would
+    need pickling to round trip, so put() refuses it.
     """
-    An example usage, showing photoactivation and photoexcitation:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        return None
 
-    state_info = FluorophoreStateInfo()
-    state_info.add('inactive')
-    state_info.add('active')
-    state_info.add('excited', lifetime=2, final_states='active')
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
 
-    f = Fluorophores(
-        number_of_molecules=6,
-        diffusion_time=20,
-        state_info=state_info)
-    f.phototransition('inactive', 'active',
-                      intensity=10, polarization_xyz=(0, 0, 1))
-    f.delete_fluorophores_in_state('inactive')
-    f.phototransition('active', 'excited',
-                      intensity=10, polarization_xyz=(0, 0, 1))
-    f.time_evolve(1)
-    x, y, z, t = f.get_xyzt_at_transitions('excited', 'active')
-    print(len(t) "spontaneous 'excited'->'active' transition(s) occured")
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def get(self, key):
+        """The result stored under 'key', or None if there isn't one."""
+        if key not in self:
+            return None
+        with np.load(self._path(key)) as data:
+            rows = json.loads(str(data['scalars']))
+            for k in data.files:
+                if '/' in k: # Row entries are stored as 'row/name'
+                    i, name = k.split('/', 1)
+                    v = data[k]
+                    rows[int(i)][name] = v.item() if v.ndim == 0 else v
+            return rows if bool(data['is_list']) else rows[0]
+
+    def put(self, key, result):
+        """Store 'result' under 'key'."""
+        is_list = not isinstance(result, dict)
+        rows = list(result) if is_list else [result]
+        arrays, scalars = {}, [{} for row in rows]
+        for i, row in enumerate(rows):
+            for name, value in row.items():
+                assert '/' not in name, "Result names can't contain '/'"
+                if isinstance(value, np.generic):
+                    value = value.item() # numpy scalar -> Python scalar
+                if value is None or isinstance(value, (bool, int, float, str)):
+                    scalars[i][name] = value
+                    continue
+                value = np.asarray(value)
+                assert value.dtype.kind in 'biufcUS', (
+                    "Can't store %r=%r in a ResultCache; values must be"
+                    " scalars or numeric/string arrays"%(name, value))
+                arrays['%i/%s'%(i, name)] = value
+        arrays['scalars'] = np.array(json.dumps(scalars))
+        arrays['is_list'] = np.array(is_list)
+        # Write then rename, so a crash never leaves a partial result:
+        temporary = self._path(key) + '.%i.tmp'%os.getpid()
+        with open(temporary, 'wb') as file:
+            np.savez(file, **arrays)
+        os.replace(temporary, self._path(key))
+        return None
+
+    def call(self, function, *args, **kwargs):
+        """function(*args, **kwargs), from the cache if we've already
+        computed it. Only deterministic calls (e.g. with a fixed seed)
+        give the same result as recomputing."""
+        key = cache_key(function, args, kwargs)
+        result = self.get(key)
+        if result is None:
+            result = function(*args, **kwargs)
+            self.put(key, result)
+        return result
+
+def run_sweep(
+    simulate,
+    parameter_grid,
+    output_path,
+    n_workers=None,
+    seed=None,
+    cache_dir=None,
+    ):
+    """Run simulate(**parameters) for every combination of parameters in
+    'parameter_grid', spread across a pool of worker processes.
+
+    'parameter_grid' is a dict of {name: list of values}, e.g.:
+        {'diffusion_time_ns': [450, 900], 'delay_ns': [100, 200, 400],
+         'replicate': range(9)}
+    'simulate' returns one result row (a dict), or a list of rows. As
+    soon as a point finishes, its rows are appended to the .csv file at
+    'output_path', with the parameters as the leading columns, and then
+    the point is logged as finished in 'output_path' + '.done'.
+
+    If 'output_path' already holds results (e.g. from a sweep that
+    crashed), points logged as finished are skipped, so rerunning the
+    same sweep picks up where it left off. Rows from any other point
+    (e.g. one that crashed partway through writing its rows) are
+    dropped, and the point runs again. (A .csv file without a .done
+    file, from an older version of run_sweep(), is trusted as is.)
+
+    Each point seeds the global random state of its worker from its own
+    SeedSequence, made from 'seed' and the point's parameters, so a
+    point's result doesn't depend on which worker runs it, when, or
+    what else is in the grid. Fluorophores() created with the default
+    seed=None seed themselves from that global state.
+
+    If 'cache_dir' isn't None, every finished point is also stored in a
+    ResultCache() there, keyed by 'simulate' (its source code), the
+    point, 'seed' and this module's source code. Any sweep that asks
+    for the same point again, even with a different grid or output
+    file, reuses it instead of running it. With seed=None, a cached
+    point was one random draw, just like a fresh run would be.
+
+    'simulate' is sent to the worker processes, so it must be defined
+    at the top level of a module. On platforms that 'spawn' new
+    processes (Windows, macOS), call run_sweep() inside an
+    'if __name__ == "__main__":' block.
+    """
+    names = list(parameter_grid.keys())
+    points = [dict(zip(names, values)) for values in
+              itertools.product(*(parameter_grid[k] for k in names))]
+    entropy = np.random.SeedSequence(seed).entropy
+    seeds = [np.random.SeedSequence(entropy, spawn_key=_point_spawn_key(p))
+             for p in points]
+    # Which points are already finished? A point's rows go in the .csv
+    # file first, then its label goes in the .done file, so a crash
+    # anywhere in between leaves the point unfinished:
+    done_path = output_path + '.done'
+    label = lambda point: json.dumps([str(point[k]) for k in names])
+    header, finished = None, set()
+    if not os.path.exists(output_path):
+        # Start with an empty file, so the .done file always has a
+        # .csv file to go with it, even if no point has rows yet:
+        open(output_path, 'w').close()
+    with open(output_path, newline='') as file:
+        reader = csv.DictReader(file)
+        header = reader.fieldnames # None until some point has rows
+        rows = list(reader)
+    if os.path.exists(done_path):
+        with open(done_path) as file: # Ignore a partially written label
+            finished = set(line[:-1] for line in file if line.endswith('\n'))
+    elif header is not None: # Results from before we kept a .done file
+        finished = set(label(row) for row in rows)
+    if header is not None:
+        missing = [k for k in names if k not in header]
+        assert not missing, (
+            "%s has no column for %s; it doesn't hold results from this"
+            " parameter grid"%(output_path, ', '.join(map(repr, missing))))
+        kept = [row for row in rows if label(row) in finished]
+        if len(kept) < len(rows): # Drop rows of unfinished points
+            temporary = output_path + '.%i.tmp'%os.getpid()
+            with open(temporary, 'w', newline='') as file:
+                writer = csv.DictWriter(file, header)
+                writer.writeheader()
+                writer.writerows(kept)
+            os.replace(temporary, output_path)
+    with open(done_path, 'w') as file: # Tidy, or start afresh
+        file.writelines(point + '\n' for point in sorted(finished))
+    tasks = [(simulate, point, s) for point, s in zip(points, seeds)
+             if label(point) not in finished]
+    cached = [] # Points somebody already ran, maybe in another sweep
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir)
+        key = lambda point: cache_key(simulate, point, seed)
+        cached = [(task[1], cache.get(key(task[1])))
+                  for task in tasks if key(task[1]) in cache]
+        tasks = [task for task in tasks if key(task[1]) not in cache]
+    print("Sweep: %i points to run,"%(len(tasks)),
+          "%i already finished,"%(len(points) - len(tasks) - len(cached)),
+          "%i cached"%(len(cached)))
+    if n_workers == 1: # Handy for debugging
+        results = map(_run_sweep_point, tasks)
+    else:
+        pool = multiprocessing.Pool(n_workers)
+        results = pool.imap_unordered(_run_sweep_point, tasks)
+    try:
+        for point, rows in itertools.chain(cached, results):
+            if cache_dir is not None and key(point) not in cache:
+                cache.put(key(point), rows)
+            rows = [{**point, **row} for row in rows]
+            # All of a point's rows in one append (after the header, if
+            # these are the first rows), then mark it done. A point with
+            # no rows is just marked done:
+            buffer = io.StringIO(newline='')
+            if rows:
+                if header is None:
+                    header = list(rows[0].keys())
+                    csv.writer(buffer).writerow(header)
+                csv.DictWriter(buffer, header).writerows(rows)
+            for path, text in ((output_path, buffer.getvalue()),
+                               (done_path, label(point) + '\n')):
+                with open(path, 'a', newline='') as file:
+                    file.write(text)
+                    file.flush()
+                    os.fsync(file.fileno())
+    finally:
+        if n_workers != 1:
+            pool.terminate()
+    return None
+
+def _point_spawn_key(point):
+    # Four 32-bit words that identify a point by its parameters:
+    digest = hashlib.sha256(json.dumps(_canonical(point)).encode())
+    return tuple(int(digest.hexdigest()[i:i+8], 16) for i in range(0, 32, 8))
+
+def _run_sweep_point(task):
+    simulate, point, seed = task
+    np.random.seed(seed.generate_state(4))
+    rows = simulate(**point)
+    if isinstance(rows, dict):
+        rows = [rows]
+    return point, rows
+
+def _test_run_sweep_simulation(diffusion_time, intensity, replicate):
+    f = Fluorophores(1e4, diffusion_time)
+    f.phototransition('ground', 'excited', intensity=intensity)
+    f.time_evolve(5)
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+    return [{'axis': 'x', 'counts': len(t), 'mean_squared': np.mean(x**2)},
+            {'axis': 'z', 'counts': len(t), 'mean_squared': np.mean(z**2)}]
+
+def _test_run_sweep_empty_first(replicate):
+    return [] if replicate == 0 else {'value': 10*replicate}
+
+def _test_run_sweep(output_path='test_run_sweep.csv'):
+    import time
+    for path in (output_path, output_path + '.done'):
+        if os.path.exists(path):
+            os.remove(path)
+    grid = {'diffusion_time': [1, 10], 'intensity': [0.1, 1, 10],
+            'replicate': range(3)}
+    print()
+    start = time.perf_counter()
+    run_sweep(_test_run_sweep_simulation, grid, output_path, seed=0)
+    end = time.perf_counter()
+    print("%0.2f seconds for a %i-point sweep"%(end - start, 2*3*3))
+    # Pretend we crashed partway through writing the 4th point's two
+    # rows, then resume:
+    with open(output_path) as file:
+        lines = file.readlines()
+    with open(output_path + '.done') as file:
+        done = file.readlines()
+    with open(output_path, 'w') as file:
+        file.writelines(lines[:8]) # The header, then 3.5 points
+        file.write(lines[8][:5]) # A partially written row
+    with open(output_path + '.done', 'w') as file:
+        file.writelines(done[:3])
+    run_sweep(_test_run_sweep_simulation, grid, output_path, seed=0)
+    with open(output_path) as file:
+        resumed_lines = file.readlines()
+    assert sorted(resumed_lines) == sorted(lines)
+    print("Resumed sweep matches the original sweep:",
+          sorted(resumed_lines) == sorted(lines))
+    # A .csv file from before we kept a .done file counts as finished:
+    os.remove(output_path + '.done')
+    run_sweep(_test_run_sweep_simulation, grid, output_path, seed=0)
+    with open(output_path + '.done') as file:
+        assert len(file.readlines()) == 2*3*3
+    # Results from some other grid aren't mistaken for ours:
+    grid['laser_power'] = [1]
+    try:
+        run_sweep(_test_run_sweep_simulation, grid, output_path, seed=0)
+        assert False, "run_sweep() should have refused the old results"
+    except AssertionError as e:
+        assert "no column for 'laser_power'" in str(e)
+    # A point can have no rows, even the first one to finish, and it
+    # still counts as finished:
+    os.remove(output_path)
+    os.remove(output_path + '.done')
+    for i in range(2):
+        run_sweep(_test_run_sweep_empty_first, {'replicate': range(3)},
+                  output_path, n_workers=1)
+        with open(output_path) as file:
+            assert file.read().split() == ['replicate,value', '1,10', '2,20']
+        with open(output_path + '.done') as file:
+            assert len(file.readlines()) == 3
+    os.remove(output_path)
+    os.remove(output_path + '.done')
+    return None
+
+def _test_result_cache():
+    import shutil
+    import tempfile
+    import time
+    # Keys depend on content, not identity:
+    def photophysics(lifetime):
+        state_info = FluorophoreStateInfo()
+        state_info.add('ground')
+        state_info.add('excited', lifetime=lifetime, final_states='ground')
+        return state_info
+    seq = PulseSequence()
+    seq.phototransition('ground', 'excited', intensity=0.5)
+    seq.readout('probe', 'excited', 'ground')
+    seq.time_evolve(10)
+    key = cache_key(photophysics(2), seq, {'n': 1e4, 'seed': 0})
+    assert key == cache_key(photophysics(2), seq, {'seed': 0, 'n': 1e4})
+    assert key != cache_key(photophysics(3), seq, {'n': 1e4, 'seed': 0})
+    assert key != cache_key(photophysics(2), seq, {'n': 1e4, 'seed': 1})
+    directory = tempfile.mkdtemp()
+    try:
+        cache = ResultCache(os.path.join(directory, 'cache'))
+        # Results round trip, as a dict or as a list of rows:
+        result = {'counts': 12, 'ratio': 0.5, 'hist': np.arange(3)}
+        cache.put(key, result)
+        assert cache.get(key)['counts'] == 12
+        assert np.array_equal(cache.get(key)['hist'], np.arange(3))
+        cache.put(key, [result, {'counts': 7}])
+        assert cache.get(key)[1] == {'counts': 7}
+        # ...including scalars that numpy would have to pickle:
+        result = {'label': 'dim', 'fit': None, 'ok': True,
+                  'n': np.int64(3), 'names': np.array(['a', 'bc'])}
+        cache.put(key, result)
+        again = cache.get(key)
+        assert again['names'].tolist() == ['a', 'bc']
+        del again['names'], result['names']
+        assert again == result and type(again['n']) is int
+        try: # ...but values that can't round trip are refused:
+            cache.put(key, {'ragged': np.array([[1], [2, 3]], dtype=object)})
+            assert False, "put() should have refused an object array"
+        except AssertionError as e:
+            assert 'ragged' in str(e)
+        assert cache.get(key)['label'] == 'dim' # Old result still there
+        assert cache.get(cache_key('nothing')) is None
+        # A seeded simulation only runs once:
+        def simulate(state_info, sequence, seed):
+            f = Fluorophores(int(1e5), 3, state_info=state_info, seed=seed)
+            x, y, z, t = f.execute(sequence)['probe']
+            return {'counts': len(t)}
+        start = time.perf_counter()
+        first = cache.call(simulate, photophysics(2), seq, seed=0)
+        middle = time.perf_counter()
+        again = cache.call(simulate, photophysics(2), seq, seed=0)
+        end = time.perf_counter()
+        assert first == again
+        print('%0.1f ms to simulate, %0.1f ms to reuse the result'%(
+            1e3*(middle - start), 1e3*(end - middle)))
+        # Sweeps with overlapping grids share finished points, and get
+        # the same rows they'd get by running them:
+        paths = [os.path.join(directory, '%s.csv'%name)
+                 for name in ('first', 'second', 'uncached')]
+        cache_dir = os.path.join(directory, 'sweep_cache')
+        grid = {'diffusion_time': [1, 10], 'intensity': [0.1, 1],
+                'replicate': range(2)}
+        run_sweep(_test_run_sweep_simulation, grid, paths[0], seed=0,
+                  cache_dir=cache_dir)
+        grid['replicate'] = range(3) # Only the new replicates should run
+        run_sweep(_test_run_sweep_simulation, grid, paths[1], seed=0,
+                  cache_dir=cache_dir)
+        run_sweep(_test_run_sweep_simulation, grid, paths[2], seed=0)
+        rows = []
+        for path in paths:
+            with open(path) as file:
+                rows.append(sorted(file.readlines()))
+        assert set(rows[0]) <= set(rows[1])
+        assert rows[1] == rows[2]
+        print("Cached sweep matches an uncached sweep:", rows[1] == rows[2])
+    finally:
+        shutil.rmtree(directory)
+    return None
+
+class EnsembleFluorophores:
+    """A deterministic counterpart to Fluorophores(): instead of
+    simulating molecules one at a time, we track the expected
+    orientation distribution of the molecules in each state.
+
+    Each state's distribution is expanded in real spherical harmonics,
+    up to order 'max_order'. Tumbling decays order 'l' like
+    exp(-l(l+1)t/(2*diffusion_time)), and spontaneous transitions mix
+    states without changing orientations, so time evolution is exact,
+    via one small matrix exponential per order. Phototransitions
+    multiply by each molecule's chance of being driven, which isn't a
+    polynomial in the orientation, so they couple every order; we keep
+    the orders up to 'max_order'. The low orders that most measurements
+    depend on converge quickly. We do the multiply in real space, on a
+    grid that's evenly spaced in azimuth and Gauss-Legendre in z, with
+    fast spherical transforms (an FFT in azimuth, then a small matrix
+    per azimuthal order) to get there and back.
+
+    Everything we measure (populations, <x^2>, polarized photon counts)
+    only needs orders 0 and 2, so we report expected counts and second
+    moments, with no Monte Carlo noise, in milliseconds:
+
+    e = EnsembleFluorophores(1e6, diffusion_time=20)
+    e.phototransition('ground', 'excited', intensity=0.1)
+    e.time_evolve(5)
+    count, moments = e.get_moments_at_transitions('excited', 'ground')
+    print(moments[0, 0] / count) # Like np.mean(x**2) for Fluorophores()
+
+    execute() runs a PulseSequence(), like Fluorophores.execute(), and
+    returns the expected (count, moments) for each readout window, so
+    you can check Monte Carlo noise against the exact means.
+
+    Orientations only matter to the extent that they're even functions,
+    so odd orders are dropped. 'diffusion_time' is one number.
     """
     def __init__(
         self,
@@ -61,31 +2862,65 @@ class Fluorophores:
         initial_orientations='uniform',
         state_info=None,
         initial_state=0,
-        ):        
-        self.orientations = Orientations(number_of_molecules,
-                                         diffusion_time,
-                                         initial_orientations)
+        max_order=12,
+        ):
+        assert number_of_molecules >= 0
+        diffusion_time = float(diffusion_time)
+        assert diffusion_time > 0
+        self.diffusion_time = diffusion_time
         if state_info is None: # Default to the simplest photophysics
             state_info = FluorophoreStateInfo()
             state_info.add('ground')
             state_info.add('excited', lifetime=1, final_states='ground')
         assert isinstance(state_info, FluorophoreStateInfo)
         self.state_info = state_info
-
-        assert initial_state in state_info # Also raises an exception if invalid
-        self.states = np.full(self.orientations.n, initial_state, dtype='uint')
-        self.transition_times = exponential(
-            self.state_info[initial_state].lifetime, self.orientations.n)
-
-        # The order of molecules isn't preserved, so we give them unique id's:
-        self.id = np.arange(self.orientations.n, dtype='int')
-
-        # We record molecular orientation and time for each spontaneous
-        # transition. We use this information to simulate measurements,
-        # since spontaneous transitions (e.g. excited->ground) are often
-        # associated with emitting light:
-        self.transition_events = {
-            k: [] for k in ('x', 'y', 'z', 't', 'initial_state', 'final_state')}
+        assert initial_state in state_info
+        self.t = 0.0
+        # A quadrature grid on the sphere: Gauss-Legendre in z, evenly
+        # spaced in azimuth. Its weights integrate products of
+        # harmonics (and smooth functions of orientation) accurately.
+        max_order = 2 * (int(max_order) // 2) # Even orders only
+        cos_th, w = np.polynomial.legendre.leggauss(max_order + 16)
+        num_ph = 2*len(cos_th)
+        ph = np.linspace(0, 2*np.pi, num_ph, endpoint=False)
+        sin_th = np.sqrt(1 - cos_th**2)
+        self._xyz = np.stack(np.broadcast_arrays(
+            np.outer(sin_th, np.cos(ph)), np.outer(sin_th, np.sin(ph)),
+            cos_th[:, None])) # Shape (3, z points, azimuth points)
+        # For each azimuthal order m: the orders l that have it, the
+        # normalized associated Legendre functions at our z points, and
+        # where the cos(m phi) and sin(m phi) coefficients live in our
+        # coefficient vectors (ordered by l, then m = -l...l):
+        legendre = _normalized_legendre(max_order, cos_th)
+        self._azimuthal = []
+        for m in range(max_order + 1):
+            l = np.arange(m + (m % 2), max_order + 1, 2) # Even l >= m
+            p = np.stack([legendre[li, m] for li in l], axis=-1)
+            if m > 0:
+                p *= np.sqrt(2) # Real harmonics: sqrt(2) cos, sqrt(2) sin
+            offset = l*(l - 1)//2 + l # Index of (l, m=0)
+            self._azimuthal.append((p, p * w[:, None], offset + m, offset - m))
+        self._order = np.concatenate(
+            [np.full(2*l + 1, l) for l in range(0, max_order + 1, 2)])
+        self._ph_weight = 2*np.pi / num_ph
+        # Integrals of each basis function times 1, and times u u^T:
+        self._count = self._analyze(np.ones(self._xyz.shape[1:]))
+        self._moments = np.array([[self._analyze(a * b) for b in self._xyz]
+                                  for a in self._xyz]).transpose(2, 0, 1)
+        # Expected number of molecules per unit solid angle, in each
+        # state, expanded in harmonics:
+        num_states = len(state_info)
+        self.c = np.zeros((num_states, len(self._order)))
+        n = state_info[initial_state].n
+        if initial_orientations == 'uniform':
+            self.c[n, 0] = number_of_molecules / np.sqrt(4*np.pi)
+        elif initial_orientations == 'polar': # Everybody at the north pole
+            self.c[n] = number_of_molecules * _real_spherical_harmonics(
+                max_order, *np.array([[0.], [0.], [1.]]))[0][0]
+        else:
+            raise ValueError(initial_orientations)
+        # The time integral of 'c', for counting spontaneous transitions:
+        self._integrated_c = np.zeros_like(self.c)
         return None
 
     def phototransition(
@@ -96,232 +2931,387 @@ class Fluorophores:
         intensity=1,                # Saturation units
         polarization_xyz=(0, 0, 1), # Only the direction matters
         ):
-        if len(self.id) == 0: return None # No molecules, don't bother
-        # Input sanitization
-        assert initial_state in self.state_info
-        initial_state = self.state_info[initial_state].n # Ensure int
-        final_states, lifetimes = self.state_info.n_and_lifetime(final_states)
-        if final_states.shape == (1,):
-            assert state_probabilities is None
-        else:
-            state_probabilities = np.asarray(state_probabilities, 'float')
-            assert state_probabilities.shape == final_states.shape
-            assert np.all(state_probabilities > 0)
-            state_probabilities /= state_probabilities.sum() # Sums to 1
-        assert intensity > 0
-        polarization_xyz = np.asarray(polarization_xyz, dtype='float')
-        assert polarization_xyz.shape == (3,)
-        polarization_xyz /= np.linalg.norm(polarization_xyz) # Unit vector
-        # A linearly polarized pulse of light, oriented in an arbitrary
-        # direction, drives molecules to change their state. The
-        # 'effective intensity' for each molecule varies like the square
-        # of the cosine of the angle between the light's polarization
-        # direction and the molecular orientation.
-        i = (self.states == initial_state) # Who's in the initial state?
-        px, py, pz, = np.sqrt(intensity) * polarization_xyz
-        o = self.orientations # Temporary short nickname
-        effective_intensity = (px*o.x[i] + py*o.y[i] + pz*o.z[i])**2 # Dot prod.
-        selection_prob = 1 - 2**(-effective_intensity) # Saturation units
-        selected = uniform(0, 1, len(selection_prob)) <= selection_prob
-        # Every photoselected molecule now changes to a new state. If
-        # multiple 'final_states' are specified, the new state is
-        # randomly selected according to 'state_probabilities'. New
-        # 'transition_times' are randomly drawn for each new state from
-        # an exponential distribution given by 'lifetimes'.
-        t = o.t[i][selected] # The current time
-        tr_t = self.transition_times[i] # A copy of relevant transition times
+        self._phototransition(*_sanitize_phototransition(
+            self.state_info, initial_state, final_states, state_probabilities,
+            intensity, polarization_xyz))
+        return None
+
+    def _phototransition(
+        self,
+        initial_state,  # Integer
+        final_states,   # 1D array of integers
+        lifetimes,      # Unused; spontaneous transitions know them
+        state_probabilities, # None, or 1D array of floats that sums to 1
+        fields,         # Shape (k, 3): sqrt(intensity) * polarization_xyz
+        ):
         if state_probabilities is None:
-            self.states[i] = np.where(selected, final_states, self.states[i])
-            tr_t[selected] = t + exponential(lifetimes, t.shape)
-        else:
-            which_state = np.random.choice(
-                np.arange(len(final_states), dtype='int'),
-                size=t.shape, p=state_probabilities)
-            ss = self.states[i] # A copy of the relevant states
-            ss[selected] = final_states[which_state]
-            self.states[i] = ss
-            tr_t[selected] = t + exponential(lifetimes[which_state])
-        self.transition_times[i] = tr_t
+            state_probabilities = np.ones(1)
+        # Same saturation model as Fluorophores.phototransition(), on
+        # our grid. Project (chance of being driven) x (distribution)
+        # back onto our harmonics:
+        effective_intensity = np.zeros(self._xyz.shape[1:])
+        for f in fields:
+            effective_intensity += np.tensordot(f, self._xyz, axes=1)**2
+        selection_prob = 1 - 2**(-effective_intensity)
+        driven = self._analyze(selection_prob *
+                               self._synthesize(self.c[initial_state]))
+        self.c[initial_state] -= driven
+        for final_state, p in zip(final_states, state_probabilities):
+            self.c[final_state] += p * driven
         return None
 
+    def _synthesize(self, c):
+        # Harmonic coefficients -> values on our grid. For each m, sum
+        # over l to get the cos(m phi) and sin(m phi) amplitudes at each
+        # z, then one inverse real FFT sums over m.
+        num_ph = self._xyz.shape[2]
+        spectrum = np.zeros((self._xyz.shape[1], num_ph//2 + 1), 'complex')
+        for m, (p, _, cos_idx, sin_idx) in enumerate(self._azimuthal):
+            a = p @ c[cos_idx]
+            if m == 0:
+                spectrum[:, 0] = num_ph * a
+            else:
+                spectrum[:, m] = (num_ph/2) * (a - 1j*(p @ c[sin_idx]))
+        return np.fft.irfft(spectrum, num_ph, axis=1)
+
+    def _analyze(self, values):
+        # Values on our grid -> harmonic coefficients, by quadrature:
+        # an FFT in azimuth, then Gauss-Legendre weights in z.
+        spectrum = np.fft.rfft(values, axis=1) * self._ph_weight
+        c = np.zeros(len(self._order))
+        for m, (_, pw, cos_idx, sin_idx) in enumerate(self._azimuthal):
+            c[cos_idx] = spectrum[:, m].real @ pw
+            if m > 0:
+                c[sin_idx] = -spectrum[:, m].imag @ pw
+        return c
+
     def time_evolve(self, delta_t):
-        if len(self.id) == 0: return None # No molecules, don't bother
         assert delta_t > 0
-        o = self.orientations # Local nickname
-        assert np.isclose(o.t.min(), o.t.max()) # Orientations are synchronized
-        target_time = o.t[0] + delta_t
-        while np.any(o.t < target_time):
-            # How much shall we step each molecule in time?
-            dt = np.minimum(target_time, self.transition_times) - o.t
-            idx = self._sort_by(dt)
-            dt = dt if idx is None else dt[idx] # Skip if dt is already sorted
-            s = slice(np.searchsorted(dt, 0, 'right'), None) # Skip dt == 0
-            # Update the orientations
-            o.x[s], o.y[s], o.z[s] = safe_diffusive_step(
-                o.x[s], o.y[s], o.z[s], (dt/o.diffusion_time)[s])
-            o.t[s] += dt[s]
-            # Calculate and record spontaneous transitions
-            transitioning = (o.t >= self.transition_times)
-            states = self.states[transitioning] # Copy of states that change
-            if states.size == 0: continue # No states change; skip ahead.
-            t = o.t[transitioning]
-            self.transition_events['initial_state'].append(states)
-            self.transition_events['t'            ].append(t)
-            self.transition_events['x'            ].append(o.x[transitioning])
-            self.transition_events['y'            ].append(o.y[transitioning])
-            self.transition_events['z'            ].append(o.z[transitioning])
-            idx = np.argsort(states)
-            states = states[idx] # A sorted copy of the states that change
-            t = t[idx]
-            transition_times = np.empty(len(states), dtype='float')
-            state_slices = [slice(np.searchsorted(states, initial_state, 'left'),
-                                  np.searchsorted(states, initial_state, 'right'))
-                            for initial_state in range(len(self.state_info))]
-            for initial_state, s in enumerate(state_slices):
-                if s.start == s.stop: continue
-                fs = self.state_info[initial_state].final_states
-                final_states, lifetimes = self.state_info.n_and_lifetime(fs)
-                probabilities = self.state_info[initial_state].probabilities
-                which_final = np.random.choice(
-                    np.arange(len(final_states), dtype='int'),
-                    size=(s.stop-s.start), p=probabilities)
-                states[s] = final_states[which_final]
-                transition_times[s] = t[s] + exponential(lifetimes[which_final])
-            # Undo our sorting of states and transition times, update originals
-            idx_rev = np.empty_like(idx)
-            idx_rev[idx] = np.arange(len(idx), dtype=idx.dtype)
-            final_states = states[idx_rev]
-            self.transition_events['final_state'].append(final_states)
-            self.states[          transitioning] = final_states
-            self.transition_times[transitioning] = transition_times[idx_rev]
+        # Spontaneous transitions: dc/dt = rates @ c, for every order
+        rates = np.zeros((len(self.state_info),) * 2)
+        s = self.state_info # Local nickname
+        for i in range(len(s)):
+            if np.isinf(s.lifetimes[i]): continue
+            row = slice(*s.branch_indptr[i:i+2])
+            rates[i, i] -= 1 / s.lifetimes[i]
+            np.add.at(rates[:, i], s.branch_final_states[row].astype('intp'),
+                      s.branch_probabilities[row] / s.lifetimes[i])
+        # ...plus tumbling, which decays each order at its own rate. The
+        # exponential of [[A, 1], [0, 0]] holds both exp(A t) and its
+        # integral, which we need to count transitions:
+        num_states = rates.shape[0]
+        augmented = np.zeros((2*num_states, 2*num_states))
+        augmented[:num_states, num_states:] = np.eye(num_states)
+        for l in np.unique(self._order):
+            augmented[:num_states, :num_states] = rates - np.eye(num_states) * (
+                l*(l + 1) / (2*self.diffusion_time))
+            e = _expm(augmented * delta_t)
+            basis = (self._order == l)
+            c = self.c[:, basis]
+            self._integrated_c[:, basis] += e[:num_states, num_states:] @ c
+            self.c[:, basis] = e[:num_states, :num_states] @ c
+        self.t += delta_t
         return None
 
-    def get_xyz_for_state(self, state):
+    def delete_fluorophores_in_state(self, state):
         assert state in self.state_info
-        state = self.state_info[state].n # Ensure int
-        idx = (self.states == state)
-        o = self.orientations # Local nickname
-        return o.x[idx], o.y[idx], o.z[idx]
+        self.c[self.state_info[state].n] = 0
+        return None
 
-    def get_xyzt_at_transitions(self, initial_state, final_state):
-        assert initial_state in self.state_info
-        assert final_state in self.state_info
-        # We built 'self.transition_events' by appending 1D numpy arrays
-        # to lists. Now's a good time to join each list of arrays into
-        # a single array:
-        if len(self.transition_events['t']) == 0: # No transitions yet
-               return np.zeros(0), np.zeros(0), np.zeros(0), np.zeros(0)
-        if len(self.transition_events['t']) > 1:
-            for k, v in self.transition_events.items():
-                self.transition_events[k] = [np.concatenate(v)]
-        # Select only the records that correspond to a particular transition:
-        e = self.transition_events # Local nickname
-        tr = ((e['initial_state'][0] == self.state_info[initial_state].n) &
-              (e[  'final_state'][0] == self.state_info[  final_state].n))
-        x, y, z, t = e['x'][0][tr], e['y'][0][tr], e['z'][0][tr], e['t'][0][tr]
-        return x, y, z, t
+    def execute(self, sequence):
+        """Run a PulseSequence(), starting from the current time.
 
-    def delete_fluorophores_in_state(self, state):
-        if len(self.id) == 0: return None # No molecules, don't bother
+        Returns a dict of {name: (count, moments)}, one entry per
+        readout window in the sequence, like get_moments_at_transitions()
+        but restricted to transitions inside the window.
+        """
+        assert isinstance(sequence, PulseSequence)
+        # We need the running transition totals at every window edge,
+        # so we split delays there:
+        edges = sorted(set(e for r in sequence.readouts for e in r[3:5]
+                           if np.isfinite(e)))
+        totals, elapsed = {}, 0
+        def evolve_to(target):
+            nonlocal elapsed
+            for edge in edges + [target]:
+                if elapsed < edge <= target:
+                    self.time_evolve(edge - elapsed)
+                    elapsed = edge
+                if edge == elapsed and edge not in totals:
+                    totals[edge] = self._integrated_c.copy()
+        evolve_to(0)
+        populated = np.flatnonzero(self.c @ self._count != 0)
+        for op, *args in sequence.compile(self.state_info, populated):
+            if op == 'pulse':
+                self._phototransition(*args)
+            elif op in ('evolve', 'advance'): # Tumbling goes on anyway
+                evolve_to(elapsed + args[0])
+            elif op == 'delete':
+                self.delete_fluorophores_in_state(*args)
+        readouts = {}
+        for name, initial_state, final_state, start, stop in sequence.readouts:
+            before = totals.get(start, self._integrated_c)
+            after = totals.get(stop, self._integrated_c)
+            readouts[name] = self._transition_moments(
+                initial_state, final_state, after - before)
+        return readouts
+
+    def get_moments_for_state(self, state):
+        """The expected number of molecules in 'state', and the expected
+        sum of u u^T over them, where u = (x, y, z) is each molecule's
+        orientation. Divide to get averages like <x^2>."""
         assert state in self.state_info
-        state = self.state_info[state].n # Convert to int
-        idx = (self.states != state)
-        self.states = self.states[idx]
-        self.transition_times = self.transition_times[idx]
-        o = self.orientations # Local nickname
-        o.x, o.y, o.z, o.t = o.x[idx], o.y[idx], o.z[idx], o.t[idx]
-        if o.diffusion_time.shape == (o.n,):
-            o.diffusion_time = o.diffusion_time[idx]
-        o.n = len(o.t)
-        self.id = self.id[idx]
-        return None
+        c = self.c[self.state_info[state].n]
+        return c @ self._count, np.tensordot(c, self._moments, axes=1)
 
-    def _sort_by(self, x):
-        x = np.asarray(x)
-        assert x.shape == self.id.shape
-        x_is_sorted = np.all(np.diff(x) >= 0)
-        if x_is_sorted:
-            return None
-        idx = np.argsort(x)
-        self.states = self.states[idx]
-        self.transition_times = self.transition_times[idx]
-        o = self.orientations # Local nickname
-        o.x, o.y, o.z, o.t = o.x[idx], o.y[idx], o.z[idx], o.t[idx]
-        if o.diffusion_time.size == o.n:
-            o.diffusion_time = o.diffusion_time[idx]
-        self.id = self.id[idx]
-        return idx
+    def get_moments_at_transitions(self, initial_state, final_state):
+        """The expected number of spontaneous transitions from
+        'initial_state' to 'final_state' so far, and the expected sum
+        of u u^T over the orientations of the molecules as they made
+        them. For polarized detection along 'axis' (paraxial), the
+        expected counts are axis @ moments @ axis."""
+        return self._transition_moments(initial_state, final_state,
+                                        self._integrated_c)
 
-def _test_fluorophores_speed(n=int(1e6)):
-    import time
-    t = []
-    for i in range(10):
-        start = time.perf_counter()
-        f = Fluorophores(number_of_molecules=n, diffusion_time=1)
-        end = time.perf_counter()
-        t.append(end-start)
-    print('\n%0.1f nanoseconds per'%(1e9*np.mean(t) / f.orientations.n),
-          "fluorophore created by Fluorophores()")
+    def _transition_moments(self, initial_state, final_state, integrated_c):
+        # The rate of initial->final transitions is proportional to the
+        # initial state's population, so its time integral counts them.
+        s = self.state_info # Local nickname
+        i, f = s[initial_state].n, s[final_state].n
+        row = slice(*s.branch_indptr[i:i+2])
+        p = s.branch_probabilities[row][s.branch_final_states[row] == f].sum()
+        c = integrated_c[i] * p / s.lifetimes[i] # 0 if infinite
+        return c @ self._count, np.tensordot(c, self._moments, axes=1)
 
-    f = Fluorophores(number_of_molecules=n, diffusion_time=1)
+def _real_spherical_harmonics(max_order, x, y, z):
+    # Orthonormal real spherical harmonics of even order l <= max_order,
+    # at unit vectors (x, y, z). Returns an array of shape (points,
+    # basis functions), and the order 'l' of each basis function.
+    p = _normalized_legendre(max_order, z)
+    ph = np.arctan2(y, x)
+    harmonics, order = [], []
+    for l in range(0, max_order + 1, 2):
+        for m in range(-l, l + 1):
+            if m == 0:
+                harmonics.append(p[l, 0])
+            elif m > 0:
+                harmonics.append(np.sqrt(2) * np.cos(m*ph) * p[l, m])
+            else:
+                harmonics.append(np.sqrt(2) * np.sin(-m*ph) * p[l, -m])
+            order.append(l)
+    return np.stack(harmonics, axis=-1), np.array(order)
+
+def _normalized_legendre(max_order, cos_th):
+    # The associated Legendre functions P_l^m(cos_th), normalized so
+    # that P_l^m(cos_th) * exp(i m phi) is orthonormal on the sphere,
+    # as a dict of {(l, m): values}, for 0 <= m <= l <= max_order. We
+    # use the usual stable recurrences in l, for each m.
+    cos_th = np.asarray(cos_th, dtype='float64')
+    sin_th = np.sqrt(np.maximum(1 - cos_th**2, 0))
+    p = {(0, 0): np.full(cos_th.shape, np.sqrt(1 / (4*np.pi)))}
+    for m in range(max_order + 1):
+        if m > 0:
+            p[m, m] = -np.sqrt((2*m + 1) / (2*m)) * sin_th * p[m-1, m-1]
+        if m < max_order:
+            p[m+1, m] = np.sqrt(2*m + 3) * cos_th * p[m, m]
+        for l in range(m + 2, max_order + 1):
+            a = np.sqrt((4*l*l - 1) / (l*l - m*m))
+            b = np.sqrt(((l - 1)**2 - m*m) / (4*(l - 1)**2 - 1))
+            p[l, m] = a * (cos_th * p[l-1, m] - b * p[l-2, m])
+    return p
+
+def _expm(a):
+    # Matrix exponential. Scipy's, if we have it; otherwise scale
+    # 'a' down until it's small, sum the Taylor series, and square
+    # back up.
+    if expm is not None:
+        return expm(a)
+    norm = np.abs(a).sum(axis=0).max()
+    squarings = max(0, int(np.ceil(np.log2(norm))) + 1) if norm > 0 else 0
+    a = a / 2**squarings
+    result, term = np.eye(len(a)), np.eye(len(a))
+    for k in range(1, 18):
+        term = term @ a / k
+        result += term
+    for i in range(squarings):
+        result = result @ result
+    return result
+
+def _test_ensemble_fluorophores(n=int(1e6)):
+    import time
+    # With no photophysics, the second moments relax toward isotropic
+    # exactly like exp(-3 t / diffusion_time):
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited')
+    e = EnsembleFluorophores(1, 20, state_info=state_info)
+    e.phototransition('ground', 'excited', intensity=0.5)
+    e.delete_fluorophores_in_state('ground')
+    count_0, moments_0 = e.get_moments_for_state('excited')
+    e.time_evolve(10)
+    count, moments = e.get_moments_for_state('excited')
+    assert np.isclose(count, count_0)
+    assert np.isclose(moments[2, 2]/count - 1/3,
+                      (moments_0[2, 2]/count_0 - 1/3) * np.exp(-3*10/20))
+    # A pump-probe experiment with a triplet state, vs. Monte Carlo:
+    state_info = FluorophoreStateInfo()
+    state_info.add('ground')
+    state_info.add('excited', lifetime=2, final_states=['ground', 'triplet'],
+                   probabilities=[0.8, 0.2])
+    state_info.add('triplet', lifetime=50, final_states='ground')
+    def experiment(f):
+        f.phototransition('ground', 'excited', intensity=2,
+                          polarization_xyz=(0, 0, 1))
+        f.time_evolve(10)
+        f.phototransition('ground', 'excited', intensity=1,
+                          polarization_xyz=(1, 0, 0))
+        f.time_evolve(30)
     start = time.perf_counter()
-    f.phototransition('ground', 'excited')
+    e = EnsembleFluorophores(n, 20, state_info=state_info)
+    experiment(e)
     end = time.perf_counter()
-    t = end - start
-    print('%0.1f nanoseconds per'%(1e9*t / f.orientations.n),
-          "fluorophore phototransitioning")
-    
-    dt = 5
-    f = Fluorophores(number_of_molecules=n, diffusion_time=1)
+    count, moments = e.get_moments_at_transitions('excited', 'ground')
+    print('%0.1f milliseconds with EnsembleFluorophores()'%(
+        1e3*(end - start)), '(%0.1f emissions, x^2 sum %0.1f, y^2 sum %0.1f)'%(
+            count, moments[0, 0], moments[1, 1]))
     start = time.perf_counter()
-    f.time_evolve(dt)
+    f = Fluorophores(n, 20, state_info=state_info, seed=0)
+    experiment(f)
     end = time.perf_counter()
-    t = end - start
-    print('%0.1f nanoseconds per'%(1e9*t / f.orientations.n),
-          "fluorophore time evolving for %0.1f diffusion times"%(
-              dt/f.orientations.diffusion_time))
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
+    print('%0.1f milliseconds with Fluorophores()'%(1e3*(end - start)),
+          '(%i emissions, x^2 sum %0.1f, y^2 sum %0.1f)'%(
+              len(t), np.sum(x**2), np.sum(y**2)))
+    for expected, observed in ((count, len(t)),
+                               (moments[0, 0], np.sum(x**2)),
+                               (moments[1, 1], np.sum(y**2))):
+        assert abs(observed - expected) < 5*np.sqrt(expected)
+    count, moments = e.get_moments_for_state('triplet')
+    assert abs(np.count_nonzero(f.states == 2) - count) < 5*np.sqrt(count)
+    # Both run the same PulseSequence(), with readout windows that start
+    # and stop partway through delays:
+    seq = PulseSequence()
+    seq.phototransition('ground', 'excited', intensity=0.5,
+                        polarization_xyz=(1, 0, 0))
+    seq.readout('early', 'excited', 'ground', duration=1)
+    seq.time_evolve(3)
+    seq.readout('late', 'excited', 'ground')
+    seq.time_evolve(20)
+    seq.phototransition('triplet', 'ground', intensity=1)
+    expected = EnsembleFluorophores(n, 20, state_info=state_info).execute(seq)
+    observed = Fluorophores(n, 20, state_info=state_info, seed=1).execute(seq)
+    for name in ('early', 'late'):
+        count, moments = expected[name]
+        x, y, z, t = observed[name]
+        print("Readout '%s': %0.1f expected emissions, %i observed"%(
+            name, count, len(t)))
+        for expected_sum, observed_sum in (
+            (count, len(t)), (moments[0, 0], np.sum(x**2)),
+            (moments[1, 1], np.sum(y**2)), (moments[0, 1], np.sum(x*y))):
+            assert abs(observed_sum - expected_sum) < 5*np.sqrt(count)
     return None
 
-def _test_fluorophores_anisotropy_decay_plot(n=int(1e8)):
-    try:
-        import matplotlib.pyplot as plt
-    except ImportError:
-        print("Matplotlib import failed; no graphical test of Fluorophores()")
+def _test_species(n=int(5e5)):
+    import time
+    # Two species in one object: small, fast-tumbling molecules with a
+    # high triplet yield, and big, slow ones with a low triplet yield.
+    def photophysics(triplet_yield):
+        state_info = FluorophoreStateInfo()
+        state_info.add('ground')
+        state_info.add('excited', lifetime=2,
+                       final_states=['ground', 'triplet'],
+                       probabilities=[1 - triplet_yield, triplet_yield])
+        state_info.add('triplet', lifetime=50, final_states='ground')
+        return state_info
+    state_info = [photophysics(0.2), photophysics(0.05)]
+    diffusion_times = (20, 200)
+    species = np.repeat([0, 1], n)
+    def experiment(f):
+        f.phototransition('ground', 'excited', intensity=0.5,
+                          polarization_xyz=(0, 0, 1))
+        f.delete_fluorophores_in_state('ground')
+        if isinstance(f, Fluorophores): # Labels move with their molecules
+            assert np.array_equal(f.species, species[f.id])
+        f.time_evolve(10)
+        f.phototransition('ground', 'excited', intensity=1,
+                          polarization_xyz=(1, 0, 0))
+        f.time_evolve(30)
+    start = time.perf_counter()
+    f = Fluorophores(2*n, np.repeat(diffusion_times, n),
+                     state_info=state_info, species=species, seed=0)
+    detectors = [TimeHistogramDetector('excited', 'ground', [0, 10, 40],
+                                       species=s) for s in (None, 0, 1)]
+    for d in detectors:
+        f.add_detector(d)
+    experiment(f)
+    end = time.perf_counter()
+    print('%0.1f nanoseconds per molecule for a two-species mixture'%(
+        1e9*(end - start) / (2*n)))
+    assert np.array_equal(f.species, species[f.id]) # Still, after sorting
+    total = detectors[0].counts
+    assert np.array_equal(detectors[1].counts + detectors[2].counts, total)
+    for s in (0, 1):
+        # Each species should match its own deterministic ensemble:
+        e = EnsembleFluorophores(n, diffusion_times[s],
+                                 state_info=state_info[s])
+        experiment(e)
+        count, moments = e.get_moments_at_transitions('excited', 'ground')
+        x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground',
+                                               species=s)
+        print('Species %i: %0.1f expected emissions, %i observed'%(
+            s, count, len(t)))
+        assert detectors[s+1].counts.sum() == len(t)
+        for expected, observed in ((count, len(t)),
+                                   (moments[0, 0], np.sum(x**2)),
+                                   (moments[2, 2], np.sum(z**2))):
+            assert abs(observed - expected) < 5*np.sqrt(count)
+        count, moments = e.get_moments_for_state('triplet')
+        observed = np.count_nonzero((f.states == 2) & (f.species == s))
+        assert abs(observed - count) < 5*np.sqrt(count)
+    # Per-species reads have their own 'since_last_read' bookmarks:
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground',
+                                           since_last_read=True, species=0)
+    assert len(t) == detectors[1].counts.sum()
+    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground',
+                                           since_last_read=True)
+    assert len(t) == total.sum()
+    return None
+
+class _CalendarQueue:
+    """A minimal bucketed priority queue (a "calendar queue") of molecule
+    indices, keyed by event time. Events are grouped into buckets of
+    width 'bucket_width'; pop() returns the end time of the earliest
+    nonempty bucket, and every index in that bucket (in no particular
+    order).
+    """
+    def __init__(self, start_time, bucket_width):
+        assert bucket_width > 0
+        self.start_time = start_time
+        self.bucket_width = bucket_width
+        self.buckets = {}
+        self.heap = []
+
+    def push(self, idx, t):
+        if len(idx) == 0: return None
+        which = ((t - self.start_time) // self.bucket_width).astype('int64')
+        order = np.argsort(which, kind='stable')
+        idx, which = idx[order], which[order]
+        starts = np.flatnonzero(np.diff(which, prepend=which[0] - 1))
+        for b, chunk in zip(which[starts], np.split(idx, starts[1:])):
+            b = int(b)
+            if b not in self.buckets:
+                self.buckets[b] = []
+                heapq.heappush(self.heap, b)
+            self.buckets[b].append(chunk)
         return None
 
-    print("\nSimulating classic anisotropy decay...", sep='', end='')
-    f = Fluorophores(n, diffusion_time=1)
-    f.phototransition('ground', 'excited',
-                      intensity=0.05, polarization_xyz=(1,0,0))
-    while f.orientations.n > 0:
-        print('.', sep='', end='')
-        f.delete_fluorophores_in_state('ground')
-        f.time_evolve(0.3)
-    print("done.")
-    x, y, z, t = f.get_xyzt_at_transitions('excited', 'ground')
-    p_x, p_y = x**2, y**2 # Probabilities of landing in channel x or y
-    r = uniform(0, 1, size=len(t))
-    in_channel_x = (r < p_x)
-    in_channel_y = (p_x <= r) & (r < p_x + p_y)
-    t_x, t_y = t[in_channel_x], t[in_channel_y]
-    bins = np.linspace(0, 3, 200)
-    bin_centers = (bins[1:] + bins[:-1])/2
-    (hist_x, _), (hist_y, _) = np.histogram(t_x, bins),  np.histogram(t_y, bins)
+    def pop(self):
+        b = heapq.heappop(self.heap)
+        bucket_end = self.start_time + (b + 1)*self.bucket_width
+        return bucket_end, np.concatenate(self.buckets.pop(b))
 
-    print("Saving results in test_classic_anisotropy_decay.png...", end='')
-    plt.figure()
-    plt.plot(bin_centers, hist_x, '.-', label=r'$\parallel$ polarization')
-    plt.plot(bin_centers, hist_y, '.-', label=r'$\perp$ polarization')
-    plt.title(
-        "Simulation of classic time-resolved anisotropy decay\n" +
-        r"$\tau_f$=%0.1f, $\tau_d$=%0.1f"%(f.state_info['excited'].lifetime,
-                                           f.orientations.diffusion_time))
-    plt.xlabel(r"Time (t/$\tau_f$)")
-    plt.ylabel("Photons per time bin")
-    plt.legend(); plt.grid('on')
-    plt.savefig("test_classic_anisotropy_decay.png"); plt.close()
-    print("done.")
-    return None
+    def __len__(self):
+        return len(self.heap)
 
 class FluorophoreStateInfo:
     def __init__(self):
@@ -350,14 +3340,56 @@ class FluorophoreStateInfo:
                 if not final_state in self.dict:
                     self.orphan_state = (state.name, final_state)
                     self.valid = False
+        if self.valid:
+            self._compile()
+        return None
+
+    def _compile(self):
+        # The hot loops shouldn't need names, FluorophoreState objects
+        # or per-state Python loops, so we compile the states into
+        # read-only arrays, indexed by state number:
+        #  'lifetimes': each state's lifetime.
+        #  'branch_indptr', 'branch_final_states', 'branch_probabilities':
+        #      a CSR-style branching matrix. Row 'n' (state n's final
+        #      states and their probabilities) is the slice
+        #      branch_indptr[n]:branch_indptr[n+1].
+        self.lifetimes = np.array([s.lifetime for s in self.list], 'float')
+        self.branch_indptr = np.cumsum(
+            [0] + [len(s.final_states) for s in self.list])
+        self.branch_final_states = np.array(
+            [self.num[f] for s in self.list for f in s.final_states], 'uint')
+        self.branch_probabilities = np.concatenate(
+            [s.probabilities for s in self.list] + [np.zeros(0)])
+        # For branch(), each row's cumulative probabilities:
+        self._branch_cdf = np.concatenate(
+            [np.cumsum(s.probabilities) for s in self.list] + [np.zeros(0)])
+        self._branch_cdf[self.branch_indptr[1:] - 1] = 1 # No roundoff
+        self._max_branches = max([len(s.final_states) for s in self.list],
+                                 default=0)
+        for a in (self.lifetimes, self.branch_indptr, self.branch_final_states,
+                  self.branch_probabilities, self._branch_cdf):
+            a.flags.writeable = False
         return None
 
+    def branch(self, initial_states, r):
+        """Final states and their lifetimes for molecules leaving
+        'initial_states' (an array of integers), picked by 'r', uniform
+        random draws in [0, 1), one per molecule."""
+        # Molecule i's entry in the branching matrix is the first one in
+        # its row whose cumulative probability exceeds r[i]. Start
+        # everybody at the start of their row, and step along. Each row
+        # ends at 1, so nobody steps past the end of their own row:
+        which = self.branch_indptr.take(initial_states)
+        for step in range(self._max_branches - 1):
+            which += (r >= self._branch_cdf.take(which))
+        final_states = self.branch_final_states[which]
+        return final_states, self.lifetimes[final_states]
+
     def n_and_lifetime(self, states):
         if isinstance(states, int) or isinstance(states, str):
             states = [states]
-        n        = np.asarray([self[s].n        for s in states], 'uint')
-        lifetime = np.asarray([self[s].lifetime for s in states], 'float')
-        return n, lifetime
+        n = np.asarray([self[s].n for s in states], 'uint')
+        return n, self.lifetimes[n]
 
     def __getitem__(self, x):
         if not self.valid:
@@ -426,6 +3458,8 @@ class Orientations:
         number_of_molecules,
         diffusion_time,
         initial_orientations='uniform',
+        dtype='float64',
+        seed=None,
         ):
         """A class to simulate the orientations of an ensemble of freely
         rotating molecules, effectively a random walk on a sphere.
@@ -433,70 +3467,143 @@ class Orientations:
         Time evolution consists of rotational diffusion of orientation.
         You get to choose the "diffusion_time" (roughly, how long it
         takes the molecules to scramble their orientations).
+
+        'dtype' sets the precision of x, y and z; 'float32' halves their
+        memory. Every diffusive step renormalizes, so rounding errors
+        don't accumulate. Times are always 'float64'.
+
+        Random draws come from self.rng, a numpy.random.Generator made
+        from 'seed' (see _generator()).
         """
         assert number_of_molecules >= 1
+        self.rng = _generator(seed)
         self.n = int(number_of_molecules)
         self.t = np.zeros(self.n, 'float64')
         diffusion_time = np.asarray(diffusion_time)
         assert diffusion_time.shape in ((), (1,), (self.n,))
         assert np.all(diffusion_time > 0)
         self.diffusion_time = diffusion_time
+        assert dtype in ('float64', 'float32')
+        self.dtype = dtype
         assert initial_orientations in ('uniform', 'polar')
         if initial_orientations == 'uniform':
-            # Generate random points on a sphere:
-            sin_ph, cos_ph = sin_cos(uniform(0, 2*np.pi, self.n), '0,2pi')
-            cos_th = uniform(-1, 1, self.n)
-            sin_th = np.sqrt(1 - cos_th*cos_th)
-            self.x = sin_th * cos_ph
-            self.y = sin_th * sin_ph
-            self.z = cos_th
+            self.x, self.y, self.z = uniform_orientations(
+                self.n, dtype, self.rng)
         elif initial_orientations == 'polar':
             # Everybody starts at the north pole:
-            self.x = np.zeros(self.n)
-            self.y = np.zeros(self.n)
-            self.z = np.ones( self.n)
+            self.x = np.zeros(self.n, dtype)
+            self.y = np.zeros(self.n, dtype)
+            self.z = np.ones( self.n, dtype)
+        return None
+
+    def diffusion_time_of(self, idx):
+        # 'diffusion_time' is either one number, or one per molecule
+        if self.diffusion_time.size == 1:
+            return self.diffusion_time
+        return self.diffusion_time[idx]
+
+    def propagate_to(self, t, idx=None):
+        """Rotationally diffuse the molecules indexed by 'idx' (default:
+        all of them) from their own times 'self.t' to time 't'.
+
+        Each molecule takes one combined step, however long ago it was
+        last updated, so it's cheap to let molecules sit idle and only
+        catch them up when somebody needs their orientation.
+        """
+        idx = np.arange(self.n) if idx is None else np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        t = np.broadcast_to(t, idx.shape)
+        stale = (t > self.t[idx])
+        idx, t = idx[stale], t[stale]
+        if idx.size == 0: return None # Everybody is already up to date
+        self.x[idx], self.y[idx], self.z[idx] = safe_diffusive_step(
+            self.x[idx], self.y[idx], self.z[idx],
+            (t - self.t[idx]) / self.diffusion_time_of(idx),
+            overwrite_xyz=True, # These are copies anyway
+            rng=self.rng)
+        self.t[idx] = t
         return None
 
     def time_evolve(self, delta_t):
         delta_t = np.asarray(delta_t)
         assert delta_t.shape in ((), (1,), (self.n,))
         assert np.all(delta_t > 0)        
-        self.x, self.y, self.z = safe_diffusive_step(
+        x, y, z = safe_diffusive_step(
             x=self.x, y=self.y, z=self.z,
-            normalized_time_step=delta_t/self.diffusion_time)
+            normalized_time_step=delta_t/self.diffusion_time,
+            overwrite_xyz=True,
+            rng=self.rng)
+        # Some steps return new (double precision) arrays; copy them back
+        # into our own buffers, which keeps our dtype and our memory:
+        for a, b in ((self.x, x), (self.y, y), (self.z, z)):
+            if a is not b:
+                a[...] = b
         self.t += delta_t
         return None
 
+def _generator(seed=None):
+    # A numpy.random.Generator from 'seed': an int, a SeedSequence, or a
+    # Generator (which we use as-is, sharing its stream). With no seed,
+    # we draw one from numpy's global random state, so np.random.seed()
+    # still makes runs reproducible.
+    if seed is None:
+        seed = np.random.randint(2**32, size=4)
+    return np.random.default_rng(seed)
+
+def uniform_orientations(n, dtype='float64', rng=None):
+    # Generate random points on a sphere:
+    rng = np.random if rng is None else rng
+    sin_ph, cos_ph = sin_cos(rng.uniform(0, 2*np.pi, n), '0,2pi')
+    cos_th = rng.uniform(-1, 1, n)
+    sin_th = np.sqrt(1 - cos_th*cos_th)
+    return tuple(a.astype(dtype, copy=False)
+                 for a in (sin_th * cos_ph, sin_th * sin_ph, cos_th))
+
 def safe_diffusive_step(
     x, y, z,
     normalized_time_step,
     max_safe_step=0.5, # Don't count on this, could be wrong
+    decorrelation_threshold=20, # Leftover correlation ~exp(-20) ~ 2e-9
+    overwrite_xyz=False,
+    rng=None,
     ):
-    num_steps, remainder = np.divmod(normalized_time_step, max_safe_step)
-    num_steps = num_steps.astype('uint64') # Always an integer
-    num_steps_min, num_steps_max = num_steps.min(), num_steps.max()
-    if num_steps_min == num_steps_max: # Scalar time step
-        for _ in range(num_steps_max):
-            x, y, z = diffusive_step(x, y, z, max_safe_step)
-    else: # Vector time step
-        assert len(normalized_time_step) == len(x)
-        t_is_sorted = np.all(np.diff(normalized_time_step) >= 0)
-        if not t_is_sorted: # Sorted xyz makes selecting unfinished stuff fast
-            idx = np.argsort(num_steps)
-            x, y, z = x[idx], y[idx], z[idx]
-            num_steps = num_steps[idx]
-        which_step = 1
-        while True:
-            first_unfinished = np.searchsorted(num_steps, which_step)
-            if first_unfinished == len(num_steps): # We're done taking steps
-                break
-            s = slice(first_unfinished, None)
-            x[s], y[s], z[s] = diffusive_step(x[s], y[s], z[s], max_safe_step)
-            which_step += 1
-    # Finally, take our 'remainder' step:
-    if remainder.max() > 0:
-        x, y, z = diffusive_step(x, y, z, remainder)
-    return x, y, z
+    """Rotationally diffuse x, y, z by 'normalized_time_step' in one go.
+
+    The Ghosh propagator is fast, but only accurate for short steps. If
+    any step is longer than 'max_safe_step', we draw from the exact
+    propagator instead, which handles any step size in a single call.
+
+    Molecules that step longer than 'decorrelation_threshold' have
+    forgotten where they started, so we skip the propagator entirely
+    and draw them uniformly on the sphere.
+
+    If 'overwrite_xyz' is True, short steps are taken in place with
+    fused_diffusive_step(), which saves a lot of memory traffic, but
+    x, y and z may be clobbered.
+
+    Random draws come from 'rng', a numpy.random.Generator (default:
+    numpy's global random state).
+    """
+    normalized_time_step = np.asarray(normalized_time_step)
+    decorrelated = (normalized_time_step > decorrelation_threshold)
+    if np.all(decorrelated):
+        return uniform_orientations(len(x), x.dtype, rng)
+    if np.any(decorrelated):
+        x_f, y_f, z_f = np.empty_like(x), np.empty_like(y), np.empty_like(z)
+        x_f[decorrelated], y_f[decorrelated], z_f[decorrelated] = (
+            uniform_orientations(np.count_nonzero(decorrelated), x.dtype, rng))
+        correlated = ~decorrelated
+        x_f[correlated], y_f[correlated], z_f[correlated] = safe_diffusive_step(
+            x[correlated], y[correlated], z[correlated],
+            normalized_time_step[correlated], max_safe_step, rng=rng)
+        return x_f, y_f, z_f
+    if normalized_time_step.max() <= max_safe_step:
+        if overwrite_xyz:
+            return fused_diffusive_step(x, y, z, normalized_time_step,
+                                        rng=rng)
+        return diffusive_step(x, y, z, normalized_time_step, 'ghosh', rng)
+    return diffusive_step(x, y, z, normalized_time_step, 'exact', rng)
 
 def _test_safe_diffusive_step(n=int(1e5)):
     import time
@@ -504,6 +3611,7 @@ def _test_safe_diffusive_step(n=int(1e5)):
     print()
     for tstep in (np.array(5),
                   exponential(size=n, scale=5),
+                  np.array(25),
                   ):
         t = []
         for i in range(10):
@@ -515,17 +3623,137 @@ def _test_safe_diffusive_step(n=int(1e5)):
               "safe_diffusive_step(normalized_time_step=%.1f +/- %.1f)"%(
                   tstep.mean(), tstep.std()))
 
-def diffusive_step(x, y, z, normalized_time_step, propagator='ghosh'):
+def diffusive_step(x, y, z, normalized_time_step, propagator='ghosh',
+                   rng=None):
     assert len(x) == len(y) == len(z)
     angle_step = np.sqrt(2*normalized_time_step)
     assert angle_step.shape in ((), (1,), x.shape)
     angle_step = np.broadcast_to(angle_step, x.shape)
-    assert propagator in ('ghosh', 'gaussian')
-    prop = ghosh_propagator if propagator == 'ghosh' else gaussian_propagator
-    theta_d = prop(angle_step)
-    phi_d = uniform(0, 2*np.pi, len(angle_step))
+    assert propagator in ('ghosh', 'gaussian', 'exact')
+    prop = {'ghosh': ghosh_propagator,
+            'gaussian': gaussian_propagator,
+            'exact': exact_propagator}[propagator]
+    theta_d = prop(angle_step, rng)
+    rng = np.random if rng is None else rng
+    phi_d = rng.uniform(0, 2*np.pi, len(angle_step))
     return polar_displacement(x, y, z, theta_d, phi_d)
 
+def fused_diffusive_step(x, y, z, normalized_time_step, method=None,
+                         rng=None):
+    """Equivalent to diffusive_step(..., propagator='ghosh'), but updates
+    x, y and z in place instead of allocating a dozen temporary arrays.
+
+    'method' is 'numba' (the default, if Numba is installed), which does
+    the rejection sampling, rotation and renormalization for each
+    molecule in a single compiled pass, or 'numpy', which does the same
+    math chunk by chunk, through a few small scratch buffers.
+
+    Numba draws from 'rng' directly, so it needs a Generator; if 'rng'
+    is None, we make one from numpy's global random state.
+    """
+    if method is None:
+        method = 'numpy' if njit is None else 'numba'
+    assert method in ('numba', 'numpy')
+    assert len(x) == len(y) == len(z)
+    angle_step = np.sqrt(2*np.asarray(normalized_time_step, dtype='float64'))
+    assert angle_step.shape in ((), (1,), x.shape)
+    if method == 'numba':
+        assert njit is not None, "Numba import failed; use method='numpy'"
+        _numba_ghosh_step(x, y, z, np.atleast_1d(angle_step),
+                          _generator() if rng is None else rng)
+    elif method == 'numpy':
+        _numpy_ghosh_step(x, y, z, np.broadcast_to(angle_step, x.shape), rng)
+    return x, y, z
+
+def _numba_ghosh_step(x, y, z, angle_step, rng):
+    # Same math as ghosh_propagator() and polar_displacement(), one
+    # molecule at a time:
+    for i in range(x.shape[0]):
+        sigma = angle_step[0] if angle_step.shape[0] == 1 else angle_step[i]
+        sigma = max(sigma, 1e-12)
+        will_draw_pi = np.exp(-(np.pi / sigma)**2)
+        while True: # Rejection sampling
+            theta = sigma * np.sqrt(-np.log(rng.uniform(will_draw_pi, 1)))
+            if rng.random() <= np.sqrt(np.sin(theta) / theta):
+                break
+        phi = rng.uniform(0, 2*np.pi)
+        sin_th = np.sin(theta)
+        x_d, y_d, z_d = sin_th*np.cos(phi), sin_th*np.sin(phi), np.cos(theta)
+        xi, yi, zi = x[i], y[i], z[i]
+        if zi > -1 + 5e-2:
+            ovr_1pz = 1 / (1 + zi)
+            xx, yy, xy = xi*xi*ovr_1pz, yi*yi*ovr_1pz, xi*yi*ovr_1pz
+        else: # Numerically stable near the south pole
+            phi_i = np.arctan2(yi, xi)
+            sin_ph, cos_ph = np.sin(phi_i), np.cos(phi_i)
+            xx, yy, xy = ((1 - zi)*cos_ph*cos_ph, (1 - zi)*sin_ph*sin_ph,
+                          (1 - zi)*sin_ph*cos_ph)
+        x_f = x_d*(zi + yy) - y_d*xy + z_d*xi
+        y_f = -x_d*xy + y_d*(zi + xx) + z_d*yi
+        z_f = -x_d*xi - y_d*yi + z_d*zi
+        r = np.sqrt(x_f*x_f + y_f*y_f + z_f*z_f)
+        x[i], y[i], z[i] = x_f/r, y_f/r, z_f/r
+    return None
+
+if njit is not None:
+    _numba_ghosh_step = njit(nogil=True)(_numba_ghosh_step)
+
+def _numpy_ghosh_step(x, y, z, angle_step, rng=None, chunk_size=2**15):
+    # Work through the particles in cache-sized chunks, so the scratch
+    # arrays stay small no matter how big the population gets, and are
+    # freed as soon as we return.
+    n = len(x)
+    rng = np.random if rng is None else rng
+    scratch = [np.empty(min(n, chunk_size)) for _ in range(5)]
+    for i in range(0, n, chunk_size):
+        s = slice(i, min(i + chunk_size, n))
+        _numpy_ghosh_chunk(x[s], y[s], z[s], angle_step[s], rng,
+                           [buffer[:s.stop - i] for buffer in scratch])
+    return None
+
+def _numpy_ghosh_chunk(x, y, z, angle_step, rng, scratch):
+    n = len(x)
+    theta_d = ghosh_propagator(angle_step, rng)
+    phi_d = rng.uniform(0, 2*np.pi, n)
+    a, b, c, d, e = scratch
+    # Displacement from the north pole, in (c, d, theta_d):
+    np.sin(theta_d, out=e)
+    np.cos(phi_d, out=c); np.multiply(c, e, out=c)      # x_d
+    np.sin(phi_d, out=d); np.multiply(d, e, out=d)      # y_d
+    np.cos(theta_d, out=theta_d)                        # z_d
+    # Rotate back to each particle's actual position, like
+    # polar_displacement(). Instead of dividing by (1+z), which is
+    # unstable near the south pole, we use (1-z)/(x^2 + y^2) there,
+    # selected element-wise instead of with fancy indexing:
+    np.multiply(x, x, out=a); np.multiply(y, y, out=b); np.add(a, b, out=e)
+    np.add(e, 1e-300, out=e); np.subtract(1, z, out=phi_d)
+    np.divide(phi_d, e, out=e)                          # (1-z)/(x^2+y^2)
+    with np.errstate(divide='ignore'): # In case z = -1
+        np.add(1, z, out=phi_d); np.divide(1, phi_d, out=phi_d) # 1/(1+z)
+    np.copyto(e, phi_d, where=(z >= 0))                 # e = 'ovr_1pz'
+    np.multiply(a, e, out=a)                            # xx/(1+z)
+    np.multiply(b, e, out=b)                            # yy/(1+z)
+    np.multiply(x, e, out=e); np.multiply(y, e, out=e)  # xy/(1+z)
+    # x_f in phi_d:
+    np.add(z, b, out=phi_d); np.multiply(c, phi_d, out=phi_d)
+    np.multiply(d, e, out=b); np.subtract(phi_d, b, out=phi_d)
+    np.multiply(theta_d, x, out=b); np.add(phi_d, b, out=phi_d)
+    # y_f in a:
+    np.add(z, a, out=a); np.multiply(d, a, out=a)
+    np.multiply(c, e, out=b); np.subtract(a, b, out=a)
+    np.multiply(theta_d, y, out=b); np.add(a, b, out=a)
+    # z_f in theta_d:
+    np.multiply(theta_d, z, out=theta_d)
+    np.multiply(c, x, out=b); np.subtract(theta_d, b, out=theta_d)
+    np.multiply(d, y, out=b); np.subtract(theta_d, b, out=theta_d)
+    # Renormalize, and write the results in place:
+    np.multiply(phi_d, phi_d, out=b); np.multiply(a, a, out=c)
+    np.add(b, c, out=b); np.multiply(theta_d, theta_d, out=c)
+    np.add(b, c, out=b); np.sqrt(b, out=b)
+    np.divide(phi_d, b, out=x); np.divide(a, b, out=y)
+    np.divide(theta_d, b, out=z)
+    return None
+
 def _test_diffusive_step_speed(n=int(1e5)):
     import time
     x, y, z = np.zeros(n), np.zeros(n), np.ones(n)
@@ -540,6 +3768,34 @@ def _test_diffusive_step_speed(n=int(1e5)):
             t[prop].append(end - start)
         print('%0.1f'%(1e9*np.mean(t[prop]) / n),
               "nanoseconds per diffusive_step('%s')"%(prop))
+    methods = ('numpy',) if njit is None else ('numpy', 'numba')
+    for method in methods:
+        fused_diffusive_step(x.copy(), y.copy(), z.copy(), 0.1, method) # Warm up
+        t[method] = []
+        for i in range(10):
+            xf, yf, zf = x.copy(), y.copy(), z.copy()
+            start = time.perf_counter()
+            fused_diffusive_step(xf, yf, zf, 0.1, method)
+            end = time.perf_counter()
+            t[method].append(end - start)
+        print('%0.1f'%(1e9*np.mean(t[method]) / n),
+              "nanoseconds per fused_diffusive_step(method='%s')"%(method))
+    if njit is None:
+        print("(Numba import failed; no timing for method='numba')")
+    # Both methods should agree with diffusive_step() on average:
+    x, y, z = uniform_orientations(n)
+    x_mean = [diffusive_step(x, y, z, 0.3)[0].mean()]
+    for method in methods:
+        x_mean.append(
+            fused_diffusive_step(x.copy(), y.copy(), z.copy(), 0.3, method)[0].mean())
+    print("Mean x after a step:", ', '.join('%0.4f'%m for m in x_mean),
+          "(should agree within ~%0.4f)"%(2/np.sqrt(n)))
+    # The numpy method works in chunks; the ragged last one must be fine:
+    xf, yf, zf = fused_diffusive_step(x.copy(), y.copy(), z.copy(),
+                                      exponential(size=n), 'numpy')
+    assert np.allclose(xf**2 + yf**2 + zf**2, 1)
+    assert not np.any(xf == x[0]) # Everybody moved
+    return None
 
 def _test_diffusive_step_accuracy(n=int(1e5)):
     x, y, z = np.zeros(n), np.zeros(n), np.ones(n)
@@ -559,7 +3815,7 @@ def _test_diffusive_step_accuracy(n=int(1e5)):
         zc = (bin_edges[:-1] + bin_edges[1:]) / 2
         return zc, hist
 
-    results = {'gaussian': {}, 'ghosh': {}}
+    results = {'gaussian': {}, 'ghosh': {}, 'exact': {}}
     propagators = results.keys()
     step_numbers = (1, 2, 3, 10, 40, 200)
     num_molecules = 0
@@ -585,10 +3841,17 @@ def _test_diffusive_step_accuracy(n=int(1e5)):
         fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(12, 6))
         for prop in propagators:
             for i, num_steps in enumerate(step_numbers):
-                fmt = '-C%i'%i if prop == 'gaussian' else '--C%i'%i
+                fmt = {'gaussian': '-C%i', 'ghosh': '--C%i', 'exact': ':C%i'}[
+                    prop]%i
                 label='%s %i steps'%(prop, num_steps)
                 ax1.plot(zc, results[prop][num_steps],       fmt, label=label)
                 ax2.plot(zc, results[prop][num_steps] - ref, fmt, label=label)
+        # The exact answer, straight from the Legendre series:
+        edges = np.linspace(0, np.pi, 31)
+        cdf = _exact_propagator_cdf(np.cos(edges), normalized_time=0.5)
+        expected = num_molecules * (cdf[:-1] - cdf[1:])
+        ax1.plot(zc, expected,       '-k', lw=0.5, label='Legendre series')
+        ax2.plot(zc, expected - ref, '-k', lw=0.5, label='Legendre series')
         fig.suptitle("Number of molecules: %0.2e"%num_molecules)
         ax1.set_title("Propagator result")
         ax2.set_title("Result minus ref. (Ghosh %i steps)"%(max(step_numbers)))
@@ -602,7 +3865,7 @@ def _test_diffusive_step_accuracy(n=int(1e5)):
     print("done.")
     return None
 
-def ghosh_propagator(step_sizes):
+def ghosh_propagator(step_sizes, rng=None):
     """Draw random angular displacements from the "new" propagator for
     diffusion on a sphere, as described by Ghosh et al. in arXiv:1303.1278.
 
@@ -619,7 +3882,11 @@ def ghosh_propagator(step_sizes):
     Return value is a 1d numpy array the same shape as 'step_sizes',
     with each entry drawn from a distribution determined by the
     corresponding entry of 'step_sizes'.
+
+    Random draws come from 'rng', a numpy.random.Generator (default:
+    numpy's global random state).
     """
+    rng = np.random if rng is None else rng
     min_step_sizes = np.min(step_sizes)
     assert min_step_sizes >= 0
     if min_step_sizes == 0:
@@ -634,12 +3901,12 @@ def ghosh_propagator(step_sizes):
         # bother drawing values that will exceed pi.
         will_draw_pi = np.exp(-(np.pi / steps)**2)
         candidates = steps * np.sqrt(-np.log(
-            uniform(will_draw_pi, 1, len(steps))))
+            rng.uniform(will_draw_pi, 1, len(steps))))
         # To convert draws from our upper bound distribution to our desired
         # distribution, reject samples stochastically by the ratio of the
         # desired distribution to the upper bound distribution,
         # which is sqrt(sin(x)/x).
-        rejected = (uniform(0, 1, candidates.shape) >
+        rejected = (rng.uniform(0, 1, candidates.shape) >
                     np.sqrt(np.sin(candidates) / candidates))
         # Update results
         if first_iteration:
@@ -652,7 +3919,7 @@ def ghosh_propagator(step_sizes):
         if len(tbd) == 0: break # We've set every element of the result
     return result
 
-def gaussian_propagator(step_sizes):
+def gaussian_propagator(step_sizes, rng=None):
     """Draw random angular displacements from the Gaussian propagator for
     diffusion on a sphere, as described by Ghosh et al. in arXiv:1303.1278.
 
@@ -671,16 +3938,140 @@ def gaussian_propagator(step_sizes):
     yielding equivalent results with fewer, larger steps.
     """
     # Calculate draws via inverse transform sampling.
-    result = step_sizes * np.sqrt(-np.log(uniform(0, 1, len(step_sizes))))
+    rng = np.random if rng is None else rng
+    result = step_sizes * np.sqrt(-np.log(rng.uniform(0, 1, len(step_sizes))))
+    return result
+
+def exact_propagator(step_sizes, rng=None):
+    """Draw random angular displacements from the exact propagator for
+    rotational diffusion on a sphere, for any size of time step.
+
+    The exact distribution of cos(beta) after a normalized time 'tau' is
+    a Legendre series:
+        p(cos(beta)) = sum_l (2l+1)/2 * exp(-l(l+1)*tau/2) * P_l(cos(beta))
+
+    We tabulate the inverse of its cumulative distribution on a grid of
+    'tau' values (once, the first time we're called), and draw by
+    inverse transform sampling with bilinear interpolation. Small steps
+    need a huge number of Legendre terms, so we fall back to the Ghosh
+    propagator for them. Huge steps have forgotten where they started,
+    so we draw them uniformly on the sphere.
+
+    'step_sizes' is a 1d numpy array of nonnegative floating point
+    numbers ('sigma' in ghosh_propagator(), so tau = sigma**2 / 2).
+
+    Return value is a 1d numpy array the same shape as 'step_sizes',
+    with each entry drawn from a distribution determined by the
+    corresponding entry of 'step_sizes'.
+    """
+    global _exact_propagator_table
+    if _exact_propagator_table is None:
+        _exact_propagator_table = _build_exact_propagator_table()
+    log_tau_grid, cos_beta_table = _exact_propagator_table
+    rng = np.random if rng is None else rng
+    step_sizes = np.asarray(step_sizes, dtype='float64')
+    log_tau = np.log(np.maximum(step_sizes, 1e-300)**2 / 2)
+    short = log_tau < log_tau_grid[0]
+    long = log_tau > log_tau_grid[-1]
+    result = np.empty(step_sizes.shape)
+    if np.any(short):
+        result[short] = ghosh_propagator(step_sizes[short], rng)
+    if np.any(long):
+        result[long] = np.arccos(rng.uniform(-1, 1, np.count_nonzero(long)))
+    tabulated = ~(short | long)
+    if np.any(tabulated):
+        # Fractional row (which tau) and column (which quantile):
+        num_rows, num_cols = cos_beta_table.shape
+        row = np.interp(log_tau[tabulated], log_tau_grid, np.arange(num_rows))
+        col = rng.uniform(0, num_cols - 1, np.count_nonzero(tabulated))
+        r, c = np.minimum(row.astype('int'), num_rows - 2), col.astype('int')
+        r_f, c_f = row - r, col - c
+        c = np.minimum(c, num_cols - 2)
+        cos_beta = ((1 - r_f) * ((1 - c_f)*cos_beta_table[r,     c] +
+                                 (    c_f)*cos_beta_table[r,     c + 1]) +
+                    (    r_f) * ((1 - c_f)*cos_beta_table[r + 1, c] +
+                                 (    c_f)*cos_beta_table[r + 1, c + 1]))
+        result[tabulated] = np.arccos(np.clip(cos_beta, -1, 1))
     return result
 
+_exact_propagator_table = None # Built by exact_propagator() when needed
+
+def _build_exact_propagator_table(
+    min_normalized_time=0.1,
+    max_normalized_time=40,
+    num_times=256,
+    num_quantiles=2049,
+    ):
+    # Each row of the table holds cos(beta) at evenly spaced quantiles
+    # of the exact distribution, for one (log-spaced) normalized time.
+    log_tau_grid = np.linspace(np.log(min_normalized_time),
+                               np.log(max_normalized_time), num_times)
+    beta = np.linspace(0, np.pi, 8193)
+    cos_beta = np.cos(beta) # Decreasing, so the cdf increases along beta
+    quantiles = np.linspace(0, 1, num_quantiles)
+    cos_beta_table = np.empty((num_times, num_quantiles))
+    for i, log_tau in enumerate(log_tau_grid):
+        survival = _exact_propagator_cdf(cos_beta, np.exp(log_tau)) # P(>cos)
+        survival = np.minimum.accumulate(np.clip(survival, 0, 1))
+        cos_beta_table[i, :] = np.interp(quantiles, 1 - survival, cos_beta)
+    return log_tau_grid, cos_beta_table
+
+def _exact_propagator_cdf(cos_beta, normalized_time, max_order=64):
+    """The cumulative distribution P(cos(beta') <= cos_beta) of the exact
+    propagator after 'normalized_time', summed up to Legendre order
+    'max_order'. We use:
+        integral_{-1}^{c} P_l(u) du = (P_{l+1}(c) - P_{l-1}(c)) / (2l+1)
+    """
+    c = np.asarray(cos_beta, dtype='float64')
+    cdf = (1 + c) / 2
+    p_prev, p = np.ones_like(c), c.copy() # P_0, P_1
+    legendre = [p_prev, p]
+    for l in range(1, max_order + 1): # Recurrence for P_{l+1}
+        p_prev, p = p, ((2*l + 1)*c*p - l*p_prev) / (l + 1)
+        legendre.append(p)
+    for l in range(1, max_order + 1):
+        decay = np.exp(-l*(l + 1)*normalized_time/2)
+        if decay < 1e-17: break
+        cdf += decay * (legendre[l + 1] - legendre[l - 1]) / 2
+    return cdf
+
+def _test_exact_propagator(n=int(1e6)):
+    # The mean of P_l(cos(beta)) after a normalized time 'tau' should
+    # decay like exp(-l(l+1)*tau/2):
+    # |P1| and |P2| are at most 1, so their means have a standard
+    # error of at most 1/sqrt(n).
+    rng = np.random.default_rng(0)
+    tolerance = 5 / np.sqrt(n)
+    def moments(propagator, tau):
+        c = np.cos(propagator(np.full(n, np.sqrt(2*tau)), rng))
+        return c.mean(), ((3*c*c - 1)/2).mean()
+    print()
+    for tau in (0.05, 0.3, 0.5, 2, 5, 50):
+        p1, p2 = moments(exact_propagator, tau)
+        print("tau=%5.2f:"%tau,
+              "<P1>=%0.4f (expect %0.4f),"%(p1, np.exp(-tau)),
+              "<P2>=%0.4f (expect %0.4f)"%(p2, np.exp(-3*tau)),
+              "+/- %0.4f"%(1/np.sqrt(n)))
+        assert abs(p1 - np.exp(-tau)) < tolerance
+        assert abs(p2 - np.exp(-3*tau)) < tolerance
+    # For small (but tabulated) steps, the Ghosh propagator is accurate
+    # too, so the two should agree:
+    for tau in (0.1, 0.2, 0.3):
+        exact, ghosh = moments(exact_propagator, tau), moments(
+            ghosh_propagator, tau)
+        assert np.all(abs(np.subtract(exact, ghosh)) < tolerance)
+    print("exact_propagator() matches theory, and ghosh_propagator()")
+    return None
+
 def _test_propagators(n=int(1e6)):
     import time
     step_sizes = 0.1 * np.ones(n, dtype='float64')
+    exact_propagator(np.ones(1)) # Build its lookup table before timing
     print()
     t = {}
     for propagator, method in ((gaussian_propagator, 'gaussian'),
-                               (ghosh_propagator,    'ghosh'   )):
+                               (ghosh_propagator,    'ghosh'   ),
+                               (exact_propagator,    'exact'   )):
         t[method] = []
         for i in range(10):
             start = time.perf_counter()
@@ -776,6 +4167,35 @@ def _test_polar_displacement(n=int(1e6), dtype='float64', norm=True):
               "for polar_displacement(method='%s')"%(method))        
     return None
 
+def _test_compact_precision(n=int(1e5), steps=1000):
+    # One step, in single precision:
+    _test_polar_displacement(n, dtype='float32')
+    # Many steps: each step renormalizes, so rounding errors shouldn't
+    # pile up, and molecules should lose their orientation at the same
+    # rate as in double precision: <z> decays like exp(-t/diffusion_time)
+    for dtype in ('float64', 'float32'):
+        o = Orientations(n, diffusion_time=1, initial_orientations='polar',
+                         dtype=dtype)
+        for i in range(steps):
+            o.time_evolve(1 / steps)
+        assert o.x.dtype == o.y.dtype == o.z.dtype == dtype
+        radial_error = np.abs(1 - (o.x*o.x + o.y*o.y + o.z*o.z))
+        mean_z = np.mean(o.z, dtype='float64')
+        print("%0.3e maximum  radial error,"%(radial_error.max()),
+              "<z>=%0.4f (expected %0.4f)"%(mean_z, np.exp(-1)),
+              "after %i steps with %s orientations"%(steps, dtype))
+        assert radial_error.max() < 1e-6
+        assert abs(mean_z - np.exp(-1)) < 6 / np.sqrt(3*n)
+    # How much memory does each molecule take?
+    for precision in ('double', 'compact'):
+        f = Fluorophores(n, diffusion_time=1, precision=precision)
+        o = f._orientations
+        nbytes = sum(a.nbytes for a in (f.states, f.transition_times, f.id,
+                                        o.x, o.y, o.z, o.t))
+        print("%i bytes per molecule with"%(nbytes / n),
+              "Fluorophores(precision='%s')"%(precision))
+    return None
+
 def to_xyz(theta, phi, method='ugly'):
     """Convert spherical polar angles to unit-length Cartesian coordinates
     """
@@ -915,10 +4335,29 @@ if __name__ == '__main__':
     _test_sin_cos()
     _test_to_xyz()
     _test_polar_displacement()
+    _test_compact_precision()
     _test_propagators()
+    _test_exact_propagator()
     _test_diffusive_step_speed()
     _test_safe_diffusive_step()
     _test_fluorophores_speed()
+    _test_fluorophores_engines()
+    _test_seeding()
+    _test_branching()
+    _test_parallel_fluorophores()
+    _test_pulse_sequence()
+    _test_since_last_read()
+    _test_in_place_compaction()
+    _test_incremental_sort()
+    _test_fork()
+    _test_split_by_delay()
+    _test_detect_photons()
+    _test_detectors()
+    _test_replicates()
+    _test_run_sweep()
+    _test_result_cache()
+    _test_ensemble_fluorophores()
+    _test_species()
     _test_fluorophores_anisotropy_decay_plot()
     try:
         _test_diffusive_step_accuracy()
@@ -1,7 +1,8 @@
-from numpy.random import uniform
 import numpy as np
 import matplotlib.pyplot as plt
-from fluorophore_rotational_diffusion import Fluorophores, FluorophoreStateInfo
+from fluorophore_rotational_diffusion import (Fluorophores,
+                                              FluorophoreStateInfo,
+                                              detect_photons)
 
 # Set up the fluorophores object and run the simulation
 tumbling_time_ns = 90
@@ -12,7 +13,8 @@ state_info.add('excited', lifetime=fluorescence_lifetime_ns,
                final_states='ground')
 a = Fluorophores(number_of_molecules=5e7,
                  diffusion_time=tumbling_time_ns,
-                 state_info=state_info)
+                 state_info=state_info,
+                 precision='compact') # Saves memory with this many molecules
 
 a.phototransition('ground', 'excited',
                   intensity=0.01, polarization_xyz=(1, 0, 0))
@@ -23,12 +25,9 @@ for i in range(10):
 
 # Calculate steady-state anisotropy
 x, y, z, t = a.get_xyzt_at_transitions('excited', 'ground')
-p_x, p_y = x**2, y**2 # Probabilities of landing in channel x or y
-r = uniform(0, 1, size=len(t))
-in_channel_x = (r < p_x)
-in_channel_y = (p_x <= r) & (r < p_x + p_y)
-total_x = sum(in_channel_x)
-total_y = sum(in_channel_y)
+# Photons land in channel x with probability x**2, and in channel y
+# with probability y**2:
+total_x, total_y = detect_photons(x, y, z)
 polarization = (total_x - total_y) / (total_x + total_y)
 print('')
 print('Total x (parallel) counts:', total_x)
@@ -37,10 +36,9 @@ print('Polarization: {:0.2f}'.format(polarization))
 # Sample output from this code (your results will vary slightly)
 
 # Calculate time-resolved anisotropy
-t_x, t_y = t[in_channel_x], t[in_channel_y]
 bins = np.linspace(0, 5*fluorescence_lifetime_ns, 200)
 bin_centers = (bins[1:] + bins[:-1])/2
-(hist_x, _), (hist_y, _) = np.histogram(t_x, bins),  np.histogram(t_y, bins)
+hist_x, hist_y = detect_photons(x, y, z, t, time_edges=bins).T
 
 print("Saving results in test_classic_anisotropy_decay.png...", end='')
 plt.figure()